@@ -0,0 +1,239 @@
+# File: utils/alerts.py - Threshold, hysteresis and rate-of-change alerting
+
+import bisect
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+CONDITIONS = ('above', 'below', 'rate_above', 'rate_below')
+
+# Window in seconds over which rate-of-change rules measure the trend
+DEFAULT_RATE_WINDOW = 300
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class _SortedRules:
+    """Rule ids kept sorted by a numeric key"""
+
+    def __init__(self):
+        self.keys = []
+        self.ids = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, rule_id):
+        i = bisect.bisect_right(self.keys, key)
+        self.keys.insert(i, key)
+        self.ids.insert(i, rule_id)
+
+    def remove(self, key, rule_id):
+        i = bisect.bisect_left(self.keys, key)
+        while self.ids[i] != rule_id:
+            i += 1
+        del self.keys[i]
+        del self.ids[i]
+
+    def below(self, x):
+        """Get ids whose key is less than x"""
+        return self.ids[:bisect.bisect_left(self.keys, x)]
+
+    def above(self, x):
+        """Get ids whose key is greater than x"""
+        return self.ids[bisect.bisect_right(self.keys, x):]
+
+class _Rule:
+    def __init__(self, spec):
+        self.spec = dict(spec)
+        self.id = str(spec['id'])
+        self.sensor_id = spec['sensor_id']
+        self.condition = spec.get('condition', 'above')
+        if self.condition not in CONDITIONS:
+            raise ValueError(f'Unknown alert condition {self.condition}')
+        self.threshold = float(spec['threshold'])
+        self.hysteresis = abs(float(spec.get('hysteresis', 0)))
+        self.min_duration = float(spec.get('min_duration', 0))
+        self.window = float(spec.get('window', DEFAULT_RATE_WINDOW))
+        self.severity = spec.get('severity', 'warning')
+
+        # 'below' rules are evaluated as 'above' on the negated signal
+        self.sign = 1 if self.condition in ('above', 'rate_above') else -1
+        self.signal = (self.sensor_id, self.window if self.condition.startswith('rate') else None)
+        self.trigger_key = self.sign * self.threshold
+        self.clear_key = self.trigger_key - self.hysteresis
+
+        self.state = 'idle'
+        self.since = None
+        self.fired_at = None
+        self.value = None
+
+class _SignalIndex:
+    """Rules on one signal and direction, indexed by state and threshold"""
+
+    def __init__(self):
+        self.idle = _SortedRules()
+        self.active = _SortedRules()
+        self.pending = set()
+
+class AlertEngine:
+    """Evaluates alert rules against incoming readings
+
+    A rule spec is a dict with an id, a sensor_id, a condition ('above',
+    'below', 'rate_above' or 'rate_below'), a threshold and optionally:
+    hysteresis (how far back past the threshold the signal must go to
+    clear), min_duration (seconds the condition must hold before firing),
+    window (seconds of trend for rate rules, whose threshold is in units
+    per minute), severity and message.
+
+    Rules are indexed per signal and direction in lists sorted by trigger
+    and clear level, so a reading costs a bisection plus the rules that
+    actually change state, not a pass over every rule. Rate signals come
+    from rate_source(sensor_id, window_seconds), returning units per
+    minute or None.
+    """
+
+    def __init__(self, rules=None, rate_source=None):
+        self.rate_source = rate_source
+        self.rules = {}
+        self._signals = {}
+        self._lock = threading.Lock()
+        self.stats = {'evaluations': 0, 'fired': 0, 'cleared': 0}
+        self.load_rules(rules or [])
+
+    def load_rules(self, specs):
+        """Replace the rule set, keeping the state of unchanged rules"""
+        rules = {}
+        for spec in specs:
+            if not spec.get('enabled', True):
+                continue
+            try:
+                rule = _Rule(spec)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.error(f'Skipping invalid alert rule {spec.get("id")}: {str(e)}')
+                continue
+            previous = self.rules.get(rule.id)
+            if previous and previous.spec == rule.spec:
+                rule = previous
+            rules[rule.id] = rule
+
+        with self._lock:
+            self.rules = rules
+            indexes = {}
+            for rule in rules.values():
+                index = indexes.setdefault((rule.signal, rule.sign), _SignalIndex())
+                if rule.state == 'active':
+                    index.active.add(rule.clear_key, rule.id)
+                else:
+                    index.idle.add(rule.trigger_key, rule.id)
+                    if rule.state == 'pending':
+                        index.pending.add(rule.id)
+
+            # sensor_id -> [(rate window or None, [(sign, index), ...])]
+            signals = {}
+            for (signal, sign), index in indexes.items():
+                sensor_id, window = signal
+                entries = signals.setdefault(sensor_id, {})
+                entries.setdefault(window, []).append((sign, index))
+            self._signals = {sensor_id: list(entries.items()) for sensor_id, entries in signals.items()}
+
+    def evaluate(self, readings, timestamp):
+        """Evaluate a {sensor_id: value} dict taken at timestamp
+
+        Returns the alerts that fired or cleared, as dicts.
+        """
+        alerts = []
+        with self._lock:
+            # Walk whichever side is smaller: the readings or the sensors with rules
+            if len(readings) <= len(self._signals):
+                pairs = ((sensor_id, self._signals.get(sensor_id)) for sensor_id in readings)
+            else:
+                pairs = self._signals.items()
+
+            for sensor_id, signals in pairs:
+                value = readings.get(sensor_id)
+                if not signals or not _is_number(value):
+                    continue
+                for window, indexes in signals:
+                    x = value
+                    if window is not None:
+                        x = self.rate_source(sensor_id, window) if self.rate_source else None
+                        if x is None:
+                            continue
+                    for sign, index in indexes:
+                        self._evaluate_index(index, sign * x, x, value, timestamp, alerts)
+            self.stats['evaluations'] += 1
+        return alerts
+
+    def _evaluate_index(self, index, x, signal_value, value, timestamp, alerts):
+        """Move rules between idle, pending and active for a signal value x"""
+        # Pending rules whose condition lapsed go back to waiting
+        if index.pending:
+            for rule_id in list(index.pending):
+                rule = self.rules[rule_id]
+                if x <= rule.trigger_key:
+                    index.pending.discard(rule_id)
+                    rule.state, rule.since = 'idle', None
+
+        # Idle rules whose threshold the signal is beyond start their timer
+        idle = index.idle
+        for rule_id in idle.ids[:bisect.bisect_left(idle.keys, x)]:
+            rule = self.rules[rule_id]
+            if rule.state == 'idle':
+                rule.state, rule.since = 'pending', timestamp
+                index.pending.add(rule_id)
+
+        if index.pending:
+            for rule_id in list(index.pending):
+                rule = self.rules[rule_id]
+                if timestamp - rule.since >= rule.min_duration:
+                    index.pending.discard(rule_id)
+                    idle.remove(rule.trigger_key, rule_id)
+                    index.active.add(rule.clear_key, rule_id)
+                    rule.state, rule.fired_at, rule.value = 'active', timestamp, signal_value
+                    self.stats['fired'] += 1
+                    alerts.append(self._alert(rule, 'firing', signal_value, value, timestamp))
+
+        # Active rules clear once the signal is back past threshold - hysteresis
+        active = index.active
+        if active.keys and active.keys[-1] > x:
+            for rule_id in active.above(x):
+                rule = self.rules[rule_id]
+                active.remove(rule.clear_key, rule_id)
+                idle.add(rule.trigger_key, rule_id)
+                rule.state, rule.since = 'idle', None
+                self.stats['cleared'] += 1
+                alerts.append(self._alert(rule, 'cleared', signal_value, value, timestamp))
+
+    def _alert(self, rule, state, signal_value, value, timestamp):
+        return {
+            'rule_id': rule.id,
+            'sensor_id': rule.sensor_id,
+            'state': state,
+            'condition': rule.condition,
+            'threshold': rule.threshold,
+            'value': signal_value,
+            'reading': value,
+            'severity': rule.severity,
+            'zone': rule.spec.get('zone'),
+            'message': rule.spec.get('message', ''),
+            'timestamp': timestamp
+        }
+
+    def active(self):
+        """Get the alerts currently firing"""
+        with self._lock:
+            return [
+                self._alert(rule, 'firing', rule.value, None, rule.fired_at)
+                for rule in self.rules.values() if rule.state == 'active'
+            ]
+
+    def get_stats(self):
+        """Get evaluation counts and the number of rules by state"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['rules'] = len(self.rules)
+            for state in ('idle', 'pending', 'active'):
+                stats[state] = sum(1 for rule in self.rules.values() if rule.state == state)
+            return stats
@@ -0,0 +1,211 @@
+# File: utils/broadcast.py - Delta-encoded, rate-limited state broadcasting
+
+import asyncio
+import json
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_RATE = 1.0
+DEFAULT_KEYFRAME_INTERVAL = 60
+
+_MISSING = object()
+
+def _payload_size(message):
+    """Approximate the bytes a message takes on the wire as JSON"""
+    return len(json.dumps(message, separators=(',', ':'), default=str))
+
+class _Client:
+    def __init__(self, now):
+        self.sent = {}
+        self.seq = 0
+        self.last_sent = 0.0
+        self.last_keyframe = None
+        self.connected_at = now
+        self.bytes_sent = 0
+        self.messages = 0
+
+class DeltaBroadcaster:
+    """Tracks shared state and what each client has seen of it
+
+    update() merges changes into the state. collect() returns the messages
+    due to each client: a keyframe with the whole state on connect, on
+    request and every keyframe_interval seconds, otherwise a delta of the
+    fields that differ from what that client last received. Each delta
+    carries the client's sequence number and the one it builds on, so a
+    client that notices a gap asks for a resync. A client gets at most
+    max_rate messages per second; changes in between are coalesced.
+
+    The broadcaster does no transport of its own: start() runs a thread
+    that hands collect()'s output to a send(sid, message) callable, or
+    callers can drive collect() themselves.
+    """
+
+    def __init__(self, max_rate=DEFAULT_MAX_RATE, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL):
+        self.max_rate = max_rate
+        self.keyframe_interval = keyframe_interval
+        self.state = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._totals = {
+            'bytes_sent': 0,
+            'messages': 0,
+            'full_state_bytes': 0,
+            'client_seconds': 0.0
+        }
+        self._stop = threading.Event()
+        self._thread = None
+        self._async_running = False
+        self._start_lock = threading.Lock()
+
+    @property
+    def pump_interval(self):
+        """How often collect() should be called to honour max_rate"""
+        return 1.0 / self.max_rate if self.max_rate else 1.0
+
+    def start(self, send):
+        """Start sending due messages with send(sid, message); idempotent"""
+        with self._start_lock:
+            if self._async_running or (self._thread and self._thread.is_alive()):
+                return False
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(send,),
+                                            name='broadcast', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        """Stop the sending thread"""
+        self._stop.set()
+
+    async def run_async(self, send):
+        """Send due messages with await send(sid, message) from the current event loop
+
+        The asyncio counterpart of start(). Returns False at once if the
+        sending thread or another run_async is active; stop() or
+        cancelling the task ends it.
+        """
+        with self._start_lock:
+            if self._async_running or (self._thread and self._thread.is_alive()):
+                return False
+            self._stop.clear()
+            self._async_running = True
+
+        try:
+            while not self._stop.is_set():
+                for sid, message in self.collect():
+                    try:
+                        await send(sid, message)
+                    except Exception as e:
+                        logger.error(f'Error sending broadcast to {sid}: {str(e)}')
+                await asyncio.sleep(self.pump_interval)
+        finally:
+            self._async_running = False
+        return True
+
+    def _run(self, send):
+        """Send due messages every pump_interval until stopped"""
+        while not self._stop.is_set():
+            for sid, message in self.collect():
+                try:
+                    send(sid, message)
+                except Exception as e:
+                    logger.error(f'Error sending broadcast to {sid}: {str(e)}')
+            self._stop.wait(self.pump_interval)
+
+    def update(self, changes):
+        """Merge changed fields into the shared state"""
+        if not changes:
+            return
+        with self._lock:
+            self.state.update(changes)
+            # What sending the whole state to every client, as before, would cost
+            self._totals['full_state_bytes'] += _payload_size(self.state) * len(self._clients)
+
+    def add_client(self, sid, now=None):
+        """Register a client; it receives a keyframe on the next collect()"""
+        with self._lock:
+            self._clients[sid] = _Client(now if now is not None else time.time())
+
+    def remove_client(self, sid, now=None):
+        """Forget a disconnected client"""
+        now = now if now is not None else time.time()
+        with self._lock:
+            client = self._clients.pop(sid, None)
+            if client:
+                self._totals['client_seconds'] += now - client.connected_at
+
+    def request_resync(self, sid):
+        """Send the client a keyframe on the next collect()"""
+        with self._lock:
+            client = self._clients.get(sid)
+            if client:
+                client.last_keyframe = None
+                client.last_sent = 0.0
+
+    def collect(self, now=None):
+        """Build the messages due now as a list of (sid, message)"""
+        now = now if now is not None else time.time()
+        outgoing = []
+        with self._lock:
+            for sid, client in self._clients.items():
+                if self.max_rate and now - client.last_sent < 1.0 / self.max_rate:
+                    continue
+
+                if client.last_keyframe is None or now - client.last_keyframe >= self.keyframe_interval:
+                    message = {'type': 'keyframe', 'seq': client.seq + 1, 'state': dict(self.state)}
+                    client.last_keyframe = now
+                else:
+                    changes = {
+                        key: value for key, value in self.state.items()
+                        if client.sent.get(key, _MISSING) != value
+                    }
+                    removed = [key for key in client.sent if key not in self.state]
+                    if not changes and not removed:
+                        continue
+                    message = {
+                        'type': 'delta',
+                        'seq': client.seq + 1,
+                        'base': client.seq,
+                        'changes': changes,
+                        'removed': removed
+                    }
+
+                client.seq += 1
+                client.sent = dict(self.state)
+                client.last_sent = now
+
+                size = _payload_size(message)
+                client.bytes_sent += size
+                client.messages += 1
+                self._totals['bytes_sent'] += size
+                self._totals['messages'] += 1
+                outgoing.append((sid, message))
+        return outgoing
+
+    def get_stats(self, now=None):
+        """Get traffic totals and bytes per client per minute, before and after"""
+        now = now if now is not None else time.time()
+        with self._lock:
+            totals = dict(self._totals)
+            client_seconds = totals.pop('client_seconds') + sum(
+                now - client.connected_at for client in self._clients.values())
+            clients = {
+                sid: {
+                    'messages': client.messages,
+                    'bytes_sent': client.bytes_sent,
+                    'bytes_per_minute': client.bytes_sent * 60 / max(now - client.connected_at, 1)
+                }
+                for sid, client in self._clients.items()
+            }
+
+        client_minutes = max(client_seconds / 60, 1 / 60)
+        totals.update({
+            'connected_clients': len(clients),
+            'bytes_per_client_minute': totals['bytes_sent'] / client_minutes,
+            'full_state_bytes_per_client_minute': totals['full_state_bytes'] / client_minutes,
+            'clients': clients
+        })
+        return totals
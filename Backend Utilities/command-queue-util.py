@@ -0,0 +1,243 @@
+# File: utils/command_queue.py - Durable, idempotent queue of actuator commands
+
+import collections
+import threading
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+SUPERSEDED = 'superseded'
+EXPIRED = 'expired'
+
+# Commands still queued this long after they were submitted are not
+# replayed after a restart; nobody is waiting for them any more
+MAX_REPLAY_AGE = 300
+
+# Finished commands are kept in the journal this long for polling
+JOURNAL_RETENTION = 7 * 86400
+# Old finished commands are pruned at most this often, as commands finish
+PRUNE_INTERVAL = 3600
+
+class CommandQueue:
+    """Runs actuator commands one at a time on a dedicated worker thread
+
+    submit() journals a command and returns its record at once; the
+    worker calls execute(command), which returns a dict with a 'status'
+    of 'success' or 'error' (or raises), and records the outcome.
+    Listeners registered with add_listener get every record as its status
+    changes.
+
+    Commands may carry an idempotency key: submitting the same key again
+    returns the original command instead of queuing another. A command for
+    an actuator that already has a command waiting supersedes it, and an
+    identical command is coalesced into the waiting one, so a burst of
+    clicks drives the actuator once. target(command) names the actuator.
+
+    On start, commands journaled as queued are replayed unless older than
+    max_replay_age. Commands that were running when the process died are
+    marked failed rather than run twice, since a dosing pump or watering
+    cycle is not safe to repeat blindly.
+
+    Finished commands are deleted from the journal JOURNAL_RETENTION after
+    they finish, checked on start and then as commands finish.
+    """
+
+    def __init__(self, db, execute, target=None, max_replay_age=MAX_REPLAY_AGE):
+        self.db = db
+        self.execute = execute
+        self.target = target or (lambda command: None)
+        self.max_replay_age = max_replay_age
+
+        self._queue = collections.deque()
+        self._waiting = {}  # target -> queued command record
+        self._records = {}  # id -> record, for queued and running commands
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_prune = 0
+        self.stats = {
+            'submitted': 0,
+            'coalesced': 0,
+            'superseded': 0,
+            'duplicates': 0,
+            'succeeded': 0,
+            'failed': 0,
+            'replayed': 0
+        }
+
+    def add_listener(self, listener):
+        """Call listener(record) whenever a command changes status"""
+        self._listeners.append(listener)
+
+    def _notify(self, record):
+        for listener in self._listeners:
+            try:
+                listener(dict(record))
+            except Exception as e:
+                logger.error(f'Error in command listener: {str(e)}')
+
+    def start(self):
+        """Replay the journal and start the worker; calling it again does nothing"""
+        if self._thread and self._thread.is_alive():
+            return False
+        self._stop.clear()
+        self._replay()
+        self._thread = threading.Thread(target=self._run, name='command-queue', daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self, timeout=10):
+        """Stop the worker; queued commands stay journaled for the next start"""
+        self._stop.set()
+        with self._ready:
+            self._ready.notify_all()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def _replay(self):
+        """Requeue journaled commands left over from a previous run"""
+        now = time.time()
+        self._prune(now)
+        for record in self.db.get_unfinished_commands():
+            if record['status'] == RUNNING:
+                self._finish(record, FAILED, {'status': 'error', 'message': 'Interrupted by restart'})
+            elif now - record['created_at'] > self.max_replay_age:
+                self._finish(record, EXPIRED, {'status': 'error', 'message': 'Expired before it could run'})
+            else:
+                with self._lock:
+                    self._enqueue(record)
+                self.stats['replayed'] += 1
+        if self.stats['replayed']:
+            logger.info(f'Replayed {self.stats["replayed"]} queued commands')
+
+    def _enqueue(self, record):
+        self._queue.append(record['id'])
+        self._records[record['id']] = record
+        if record['target'] is not None:
+            self._waiting[record['target']] = record
+        self._ready.notify()
+
+    def submit(self, command, idempotency_key=None):
+        """Queue a command, returning its record
+
+        The record's 'coalesced' flag is set when an existing command was
+        returned instead of a new one being queued.
+        """
+        if idempotency_key:
+            existing = self.get(idempotency_key=idempotency_key)
+            if existing:
+                self.stats['duplicates'] += 1
+                return dict(existing, coalesced=True)
+
+        target = self.target(command)
+        with self._lock:
+            waiting = self._waiting.get(target) if target is not None else None
+            if waiting and waiting['command'] == command:
+                self.stats['coalesced'] += 1
+                return dict(waiting, coalesced=True)
+
+        now = time.time()
+        record = {
+            'id': uuid.uuid4().hex,
+            'idempotency_key': idempotency_key or None,
+            'target': target,
+            'command': command,
+            'status': QUEUED,
+            'result': None,
+            'created_at': now,
+            'updated_at': now
+        }
+        # Journal before acknowledging, so an accepted command survives a
+        # crash; outside the lock, so the worker isn't held up by the write
+        if not self.db.save_command(record):
+            # A concurrent request may have journaled the same key first
+            existing = self.db.get_command(idempotency_key=idempotency_key) if idempotency_key else None
+            if existing:
+                self.stats['duplicates'] += 1
+                return dict(existing, coalesced=True)
+            raise RuntimeError('Could not journal command')
+
+        with self._lock:
+            # Whatever waits for the target now, which may have changed
+            # while the command was being journaled
+            superseded = self._waiting.get(target) if target is not None else None
+            if superseded:
+                self._queue.remove(superseded['id'])
+                self.stats['superseded'] += 1
+            self._enqueue(record)
+            self.stats['submitted'] += 1
+
+        if superseded:
+            self._finish(superseded, SUPERSEDED, {'status': 'error', 'message': f'Superseded by {record["id"]}'})
+        self._notify(record)
+        return dict(record, coalesced=False)
+
+    def get(self, command_id=None, idempotency_key=None):
+        """Get a command record by id or idempotency key, or None"""
+        with self._lock:
+            if command_id in self._records:
+                return dict(self._records[command_id])
+        return self.db.get_command(command_id=command_id, idempotency_key=idempotency_key)
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._ready:
+                while not self._queue and not self._stop.is_set():
+                    self._ready.wait()
+                if self._stop.is_set():
+                    return
+                record = self._records[self._queue.popleft()]
+                if self._waiting.get(record['target']) is record:
+                    del self._waiting[record['target']]
+
+            # Journal the start before acting, so a crash mid-command marks
+            # it failed on restart instead of replaying it
+            if not self.db.update_command(record['id'], RUNNING):
+                self.stats['failed'] += 1
+                self._finish(record, FAILED, {'status': 'error', 'message': 'Could not journal command start'})
+                continue
+            with self._lock:
+                record['status'] = RUNNING
+                record['updated_at'] = time.time()
+            self._notify(record)
+
+            try:
+                result = self.execute(record['command'])
+            except Exception as e:
+                logger.error(f'Error executing command {record["id"]}: {str(e)}')
+                result = {'status': 'error', 'message': str(e)}
+
+            succeeded = isinstance(result, dict) and result.get('status') == 'success'
+            self.stats['succeeded' if succeeded else 'failed'] += 1
+            self._finish(record, SUCCEEDED if succeeded else FAILED, result)
+
+    def _finish(self, record, status, result):
+        """Record a command's final status and notify listeners"""
+        record.update(status=status, result=result, updated_at=time.time())
+        self.db.update_command(record['id'], status, result)
+        with self._lock:
+            self._records.pop(record['id'], None)
+        self._notify(record)
+        self._prune(record['updated_at'])
+
+    def _prune(self, now):
+        """Delete old finished commands, at most once per PRUNE_INTERVAL"""
+        if now - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        self.db.delete_finished_commands_before(now - JOURNAL_RETENTION)
+
+    def get_stats(self):
+        """Get submission counters and the queue depth"""
+        stats = dict(self.stats)
+        with self._lock:
+            stats['queued'] = len(self._queue)
+        return stats
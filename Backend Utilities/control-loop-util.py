@@ -0,0 +1,338 @@
+# File: utils/control_loop.py - Multi-rate control loop with concurrent sensor reads
+
+import asyncio
+import heapq
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PERIOD = 5.0
+DEFAULT_SENSOR_TIMEOUT = 2.0
+
+# Tasks falling due within this window of each other run in the same tick
+BATCH_WINDOW = 0.01
+
+SENSOR = 0
+CONTROLLER = 1
+
+class ControlLoop:
+    """Reads sensors concurrently and runs controllers, each at its own rate
+
+    sensor_readers maps a sensor name to a callable returning either a dict
+    of readings or a single value (stored under the sensor name). Each read
+    has its own deadline; a sensor that misses it or fails contributes its
+    last known good readings instead, and a read that is still running is
+    not started again until it returns.
+
+    controllers is a list of (name, update) pairs called with the merged
+    latest sensor data, and stages a list of (name, callable) run after them
+    (for storage and broadcasting) with the merged data and the readings
+    taken in that tick.
+
+    Every sensor and controller has a period (sensor_periods and
+    controller_periods, falling back to period) and sits in a priority queue
+    ordered by its next due time. The loop sleeps until the earliest task is
+    due and runs everything due together. Each task follows its own fixed
+    timeline, so slow ticks don't make it drift; slots missed entirely are
+    skipped rather than run back to back.
+    """
+
+    def __init__(self, sensor_readers, controllers, stages=None, period=DEFAULT_PERIOD,
+                 sensor_timeouts=None, default_timeout=DEFAULT_SENSOR_TIMEOUT,
+                 sensor_periods=None, controller_periods=None):
+        self.sensor_readers = dict(sensor_readers)
+        self.controllers = list(controllers)
+        self.stages = list(stages or [])
+        self.period = period
+        self.sensor_timeouts = dict(sensor_timeouts or {})
+        self.default_timeout = default_timeout
+        self.sensor_periods = dict(sensor_periods or {})
+        self.controller_periods = dict(controller_periods or {})
+
+        self.sensor_data = {}
+        self.sensor_status = {}
+        self.last_timings = {}
+        self.stats = {
+            'ticks': 0,
+            'overruns': 0,
+            'skipped_ticks': 0,
+            'sensor_timeouts': 0,
+            'sensor_errors': 0,
+            'last_jitter': 0.0,
+            'max_jitter': 0.0
+        }
+
+        self._tick_listeners = []
+        self._last_good_at = {}
+        self._pending = {}
+        self._overdue = set()
+        self._queue = []
+        self._reschedule = True
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(self.sensor_readers)),
+                                            thread_name_prefix='sensor')
+        self._stop = threading.Event()
+        self._thread = None
+        self._async_running = False
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start the loop thread; calling it again while running does nothing"""
+        with self._start_lock:
+            if self.is_running():
+                return False
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name='control-loop', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self, timeout=None):
+        """Stop the loop and wait for the current tick to finish"""
+        self._stop.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def is_running(self):
+        """Check whether the loop is running, in its thread or on an event loop"""
+        return self._async_running or bool(self._thread and self._thread.is_alive())
+
+    def set_periods(self, sensor_periods=None, controller_periods=None):
+        """Change task periods; the schedule is rebuilt before the next tick"""
+        if sensor_periods is not None:
+            self.sensor_periods = dict(sensor_periods)
+        if controller_periods is not None:
+            self.controller_periods = dict(controller_periods)
+        self._reschedule = True
+
+    def set_sensor_readers(self, sensor_readers):
+        """Replace the sensor readers; the schedule is rebuilt before the next tick
+
+        For readers that are only known once the hardware has been probed.
+        Reads already in flight finish on the previous workers.
+        """
+        executor = self._executor
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(sensor_readers)),
+                                            thread_name_prefix='sensor')
+        self.sensor_readers = dict(sensor_readers)
+        self._reschedule = True
+        executor.shutdown(wait=False)
+
+    def add_tick_listener(self, callback):
+        """Call callback(timings) after every tick with its per-stage durations"""
+        self._tick_listeners.append(callback)
+
+    def _period_for(self, kind, name):
+        """Get the period of a sensor or controller task in seconds"""
+        periods = self.sensor_periods if kind == SENSOR else self.controller_periods
+        return periods.get(name) or self.period
+
+    def _build_schedule(self, now):
+        """Put every task in the queue, all due immediately"""
+        self._queue = [(now, SENSOR, name) for name in self.sensor_readers]
+        self._queue += [(now, CONTROLLER, name) for name, _ in self.controllers]
+        heapq.heapify(self._queue)
+        self._reschedule = False
+
+    def _pop_due(self, now):
+        """Pop every task due by now, rescheduling each on its own timeline"""
+        sensors, controllers = [], []
+        jitter = now - self._queue[0][0]
+        while self._queue and self._queue[0][0] <= now + BATCH_WINDOW:
+            due, kind, name = heapq.heappop(self._queue)
+            (sensors if kind == SENSOR else controllers).append(name)
+
+            period = self._period_for(kind, name)
+            next_due = due + period
+            if next_due <= now:
+                # Overran into the next slot(s): skip them instead of bursting
+                missed = int((now - next_due) // period) + 1
+                self.stats['overruns'] += 1
+                self.stats['skipped_ticks'] += missed
+                next_due += missed * period
+            heapq.heappush(self._queue, (next_due, kind, name))
+
+        self.stats['last_jitter'] = jitter
+        self.stats['max_jitter'] = max(self.stats['max_jitter'], jitter)
+        return sensors, controllers
+
+    def run(self):
+        """Run due tasks until stopped"""
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if self._reschedule:
+                self._build_schedule(now)
+            if not self._queue:
+                self._stop.wait(self.period)
+                continue
+
+            wait = self._queue[0][0] - now
+            if wait > 0:
+                self._stop.wait(wait)
+                continue
+
+            sensors, controllers = self._pop_due(now)
+            try:
+                self.tick(sensors, controllers)
+            except Exception as e:
+                logger.error(f'Error in control loop tick: {str(e)}')
+
+    async def run_async(self, executor=None):
+        """Run due tasks from the current asyncio event loop until stopped
+
+        The asyncio counterpart of start(): scheduling happens on the event
+        loop and each tick runs in executor (the loop's default when None),
+        so sensor reads, controllers and storage never block it. Returns
+        False at once if the loop is already running, in a thread or on an
+        event loop; stop() or cancelling the task ends it.
+        """
+        with self._start_lock:
+            if self.is_running():
+                return False
+            self._stop.clear()
+            self._async_running = True
+
+        loop = asyncio.get_running_loop()
+        try:
+            while not self._stop.is_set():
+                now = time.monotonic()
+                if self._reschedule:
+                    self._build_schedule(now)
+                if not self._queue:
+                    await asyncio.sleep(self.period)
+                    continue
+
+                wait = self._queue[0][0] - now
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+
+                sensors, controllers = self._pop_due(now)
+                try:
+                    await loop.run_in_executor(executor, self.tick, sensors, controllers)
+                except Exception as e:
+                    logger.error(f'Error in control loop tick: {str(e)}')
+        finally:
+            self._async_running = False
+        return True
+
+    def tick(self, sensors=None, controllers=None):
+        """Run one tick: read sensors, update controllers, run stages
+
+        sensors and controllers name the tasks to run; None runs all of them.
+        """
+        timings = {}
+
+        start = time.monotonic()
+        fresh = self.read_sensors(sensors) if sensors is None or sensors else {}
+        timings['sensors'] = time.monotonic() - start
+        sensor_data = dict(self.sensor_data)
+
+        for name, update in self.controllers:
+            if controllers is not None and name not in controllers:
+                continue
+            stage_start = time.monotonic()
+            try:
+                update(sensor_data)
+            except Exception as e:
+                logger.error(f'Error updating {name} controller: {str(e)}')
+            timings[f'controller.{name}'] = time.monotonic() - stage_start
+
+        # Storage and broadcasting only have work when something was read
+        if fresh:
+            for name, stage in self.stages:
+                stage_start = time.monotonic()
+                try:
+                    stage(sensor_data, fresh)
+                except Exception as e:
+                    logger.error(f'Error in control loop stage {name}: {str(e)}')
+                timings[name] = time.monotonic() - stage_start
+
+        timings['total'] = time.monotonic() - start
+        self.last_timings = timings
+        self.stats['ticks'] += 1
+        for callback in self._tick_listeners:
+            try:
+                callback(timings)
+            except Exception as e:
+                logger.error(f'Error in tick listener: {str(e)}')
+        return sensor_data
+
+    def read_sensors(self, names=None):
+        """Read sensors concurrently, each against its own deadline
+
+        Returns the readings taken in this call and merges them into
+        sensor_data, where sensors that failed keep their last good values.
+        A read that finishes after its deadline is picked up on the sensor's
+        next turn.
+        """
+        start = time.monotonic()
+        names = list(self.sensor_readers) if names is None else names
+
+        late = {}
+        for name in names:
+            # A read that hung past its deadline keeps its worker; don't
+            # queue another one behind it
+            future = self._pending.get(name)
+            if future is not None and not future.done():
+                continue
+            if future is not None and name in self._overdue:
+                late[name] = future
+            self._pending[name] = self._executor.submit(self.sensor_readers[name])
+
+        sensor_data = {}
+        for name in sorted(names, key=self._timeout_for):
+            future = self._pending[name]
+            remaining = start + self._timeout_for(name) - time.monotonic()
+            try:
+                values = self._as_readings(name, future.result(timeout=max(0.0, remaining)))
+                self._overdue.discard(name)
+            except Exception as e:
+                if future.done():
+                    self.stats['sensor_errors'] += 1
+                    logger.error(f'Error reading sensor {name}: {str(e)}')
+                else:
+                    self.stats['sensor_timeouts'] += 1
+                    self._overdue.add(name)
+                    logger.warning(f'Sensor {name} missed its {self._timeout_for(name)}s deadline')
+
+                values = None
+                if name in late and late[name].exception() is None:
+                    values = self._as_readings(name, late[name].result())
+
+            if values is None:
+                # The last good readings stay in the merged sensor_data
+                read_at = self._last_good_at.get(name)
+                self.sensor_status[name] = {
+                    'ok': False,
+                    'age': time.time() - read_at if read_at else None
+                }
+            else:
+                self._last_good_at[name] = time.time()
+                self.sensor_status[name] = {'ok': True, 'age': 0.0}
+                sensor_data.update(values)
+
+        merged = dict(self.sensor_data)
+        merged.update(sensor_data)
+        self.sensor_data = merged
+        return sensor_data
+
+    def _as_readings(self, name, result):
+        """Normalise a reader's result to a dict of readings"""
+        return result if isinstance(result, dict) else {name: result}
+
+    def _timeout_for(self, name):
+        """Get the read deadline for a sensor in seconds"""
+        return self.sensor_timeouts.get(name, self.default_timeout)
+
+    def get_stats(self):
+        """Get loop statistics, per-stage timings and sensor status"""
+        stats = dict(self.stats)
+        stats['running'] = self.is_running()
+        stats['period'] = self.period
+        stats['sensor_periods'] = {name: self._period_for(SENSOR, name) for name in self.sensor_readers}
+        stats['controller_periods'] = {name: self._period_for(CONTROLLER, name) for name, _ in self.controllers}
+        stats['last_timings'] = dict(self.last_timings)
+        stats['sensor_status'] = dict(self.sensor_status)
+        return stats
@@ -0,0 +1,52 @@
+# File: utils/convert_storage.py - Convert stored sensor readings between rows and chunks
+#
+# Moves a database's sensor readings to the compressed hourly chunks of
+# utils/series_codec.py, or back to one row per reading, and records the
+# format so the app keeps using it. Stop the app first: conversion runs a
+# day of readings per transaction and takes a while on a large database.
+# The open hour stays in rows either way. --vacuum returns the freed pages
+# to the filesystem afterwards.
+#
+# Usage: python3 -m utils.convert_storage --to chunks [--db vertical_farm.db] [--vacuum]
+
+import argparse
+import logging
+import sqlite3
+import sys
+import time
+
+from utils.database import STORAGE_FORMATS, Database
+
+def describe(stats):
+    return (f'{stats.get("rows", 0)} rows, {stats.get("chunk_readings", 0)} readings in '
+            f'{stats.get("chunks", 0)} chunks, {stats.get("database_size", 0) / 1e6:.1f} MB')
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert stored sensor readings between rows and chunks')
+    parser.add_argument('--db', default='vertical_farm.db')
+    parser.add_argument('--to', required=True, choices=STORAGE_FORMATS)
+    parser.add_argument('--vacuum', action='store_true', help='VACUUM the database afterwards')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    db = Database(args.db)
+    print(f'before: {db.storage_format}, {describe(db.get_storage_stats())}')
+
+    start = time.time()
+    if not db.set_storage_format(args.to):
+        db.close()
+        sys.exit(1)
+    print(f'converted to {args.to} in {time.time() - start:.1f}s')
+    db.close()
+
+    if args.vacuum:
+        conn = sqlite3.connect(args.db)
+        conn.execute('VACUUM')
+        conn.close()
+
+    db = Database(args.db)
+    print(f'after: {db.storage_format}, {describe(db.get_storage_stats())}')
+    db.close()
+
+if __name__ == '__main__':
+    main()
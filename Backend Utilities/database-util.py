@@ -1,224 +1,1377 @@
 # File: utils/database.py - Database handling
 
+import collections
+import copy
 import json
 import os
+import queue
 import sqlite3
+import threading
 import time
 import logging
+from contextlib import contextmanager
+
+from utils import series_codec
 
 logger = logging.getLogger(__name__)
 
+# Marks a setting that is known to be absent from the settings cache
+_MISSING = object()
+# Returned by settings cache lookups for a setting not cached yet; None is
+# a setting stored as JSON null
+_NOT_CACHED = object()
+
+# Connection tuning - WAL lets dashboard reads run alongside the writer and
+# synchronous=NORMAL only fsyncs at checkpoints instead of on every commit
+DEFAULT_POOL_SIZE = 4
+CONNECTION_TIMEOUT = 30
+CACHE_SIZE_KB = 8192
+STATEMENT_CACHE_SIZE = 256
+
+# Sensor reading write buffer - readings are flushed in one transaction once
+# the buffer holds WRITE_BUFFER_SIZE rows or its oldest row is older than
+# WRITE_BUFFER_MAX_AGE seconds. WRITE_BUFFER_LIMIT bounds memory if the SD
+# card falls behind: writers flush synchronously, then the oldest are dropped
+WRITE_BUFFER_SIZE = 200
+WRITE_BUFFER_MAX_AGE = 10
+WRITE_BUFFER_LIMIT = 5000
+
+# Rollup tiers (bucket sizes in seconds) maintained from sensor_readings.
+# History queries use raw rows while they fit the point budget and fall back
+# to the finest tier that does, so long ranges cost the same as short ones
+ROLLUP_RESOLUTIONS = (60, 900, 3600)
+RAW_SAMPLE_INTERVAL = 5
+DEFAULT_POINT_BUDGET = 500
+
+# Stored readings are sample-and-hold (utils/deadband.py): a value holds
+# until the sensor's next point, so rollup averages are weighted by how long
+# each value held. The deadband heartbeat keeps gaps to max_silence (300s
+# by default); a gap longer than MAX_HOLD is missing data, such as the app
+# being stopped, and its value is only held for MAX_HOLD seconds
+MAX_HOLD = 3600
+
+# Rows deleted per transaction when pruning, so the write lock is held briefly
+PRUNE_CHUNK_SIZE = 2000
+
+# Rows fetched at a time when streaming history for export
+EXPORT_BATCH_SIZE = 1000
+
+# Events returned per page by get_events_page at most
+MAX_EVENTS_PAGE = 500
+
+# With storage_format 'chunks', each sensor's readings for an hour are packed
+# into one compressed blob (utils/series_codec.py) once the hour has been
+# over for CHUNK_GRACE seconds; until then they are rows as usual. Packing
+# and unpacking commit COMPACT_WINDOW seconds or CHUNK_BATCH_SIZE chunks at
+# a time
+STORAGE_FORMATS = ('rows', 'chunks')
+CHUNK_SECONDS = 3600
+CHUNK_GRACE = 300
+COMPACT_WINDOW = 86400
+CHUNK_BATCH_SIZE = 48
+
+def _migrate_structured_events(cursor):
+    """Add structured event columns, normalise details to JSON and index them"""
+    cursor.execute("ALTER TABLE events ADD COLUMN severity TEXT NOT NULL DEFAULT 'info'")
+    cursor.execute('ALTER TABLE events ADD COLUMN source TEXT')
+    cursor.execute('ALTER TABLE events ADD COLUMN zone TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_events_severity_time ON events (severity, timestamp)')
+    
+    # Plain-text details become JSON strings, so every row can be embedded
+    # in a response as-is
+    cursor.execute('UPDATE events SET details = json_quote(details) WHERE details IS NULL OR NOT json_valid(details)')
+    
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE events_fts USING fts5(details, content='events', content_rowid='id')")
+    except sqlite3.OperationalError as e:
+        logger.warning(f'Full-text event search unavailable, falling back to LIKE: {str(e)}')
+        return
+    
+    cursor.execute('''
+    CREATE TRIGGER events_fts_insert AFTER INSERT ON events BEGIN
+        INSERT INTO events_fts (rowid, details) VALUES (new.id, new.details);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER events_fts_delete AFTER DELETE ON events BEGIN
+        INSERT INTO events_fts (events_fts, rowid, details) VALUES ('delete', old.id, old.details);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER events_fts_update AFTER UPDATE OF details ON events BEGIN
+        INSERT INTO events_fts (events_fts, rowid, details) VALUES ('delete', old.id, old.details);
+        INSERT INTO events_fts (rowid, details) VALUES (new.id, new.details);
+    END
+    ''')
+    cursor.execute("INSERT INTO events_fts (events_fts) VALUES ('rebuild')")
+
+def _profile_metadata(profile):
+    """Get the columns indexed alongside a growing profile's JSON"""
+    if not isinstance(profile, dict):
+        profile = {}
+    stages = profile.get('stages')
+    if not isinstance(stages, list):
+        stages = []
+    days = [stage.get('days') for stage in stages if isinstance(stage, dict)]
+    return {
+        'crop': profile.get('crop'),
+        'stage_count': len(stages),
+        'total_days': sum(d for d in days if isinstance(d, (int, float)) and not isinstance(d, bool))
+    }
+
+def _migrate_profile_index(cursor):
+    """Add growing profile metadata columns, filled from the stored JSON, and index them"""
+    cursor.execute('ALTER TABLE growing_profiles ADD COLUMN crop TEXT')
+    cursor.execute('ALTER TABLE growing_profiles ADD COLUMN stage_count INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE growing_profiles ADD COLUMN total_days REAL NOT NULL DEFAULT 0')
+    
+    cursor.execute('SELECT id, profile_data FROM growing_profiles')
+    for profile_id, profile_data in cursor.fetchall():
+        try:
+            metadata = _profile_metadata(json.loads(profile_data))
+        except (TypeError, ValueError):
+            continue
+        cursor.execute(
+            'UPDATE growing_profiles SET crop = ?, stage_count = ?, total_days = ? WHERE id = ?',
+            (metadata['crop'], metadata['stage_count'], metadata['total_days'], profile_id)
+        )
+    
+    # Listings are answered from the index alone, without reading the JSON
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_growing_profiles_name
+    ON growing_profiles (name, crop, stage_count, total_days, created_at, updated_at)
+    ''')
+
+# Schema migrations, applied in order by _initialize_db. The version reached
+# is stored in the settings table under 'schema_version'. Each migration is
+# a list of SQL statements or a callable taking a cursor. Never edit a
+# released migration - add a new one instead
+MIGRATIONS = [
+    (1, 'Single-column indexes', [
+        'CREATE INDEX IF NOT EXISTS idx_sensor_readings_sensor_id ON sensor_readings (sensor_id)',
+        'CREATE INDEX IF NOT EXISTS idx_sensor_readings_timestamp ON sensor_readings (timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_events_timestamp ON events (timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_events_type ON events (event_type)'
+    ]),
+    (2, 'Composite covering indexes for per-sensor and per-type range queries', [
+        # Covers sensor_id filter, timestamp range/order and the value column,
+        # so recent readings are answered from the index alone
+        'CREATE INDEX IF NOT EXISTS idx_sensor_readings_sensor_time ON sensor_readings (sensor_id, timestamp, value)',
+        'DROP INDEX IF EXISTS idx_sensor_readings_sensor_id',
+        'CREATE INDEX IF NOT EXISTS idx_events_type_time ON events (event_type, timestamp)',
+        'DROP INDEX IF EXISTS idx_events_type'
+    ]),
+    (3, 'Structured event columns, JSON details and full-text search', _migrate_structured_events),
+    (4, 'Journal for queued actuator commands', [
+        '''CREATE TABLE IF NOT EXISTS command_journal (
+            id TEXT PRIMARY KEY,
+            idempotency_key TEXT UNIQUE,
+            target TEXT,
+            command TEXT NOT NULL,
+            status TEXT NOT NULL,
+            result TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_command_journal_status ON command_journal (status, created_at)'
+    ]),
+    (5, 'Growing profile metadata columns for listings', _migrate_profile_index),
+    (6, 'Compressed hourly chunks of sensor readings', [
+        '''CREATE TABLE IF NOT EXISTS sensor_chunks (
+            sensor_id TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            first_timestamp INTEGER NOT NULL,
+            last_timestamp INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (sensor_id, hour)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_sensor_chunks_hour ON sensor_chunks (hour, first_timestamp)'
+    ]),
+    # Buckets from before this migration keep their point average until
+    # rebuild_rollups is run
+    (7, 'Time-weighted sums in sensor rollups', [
+        'ALTER TABLE sensor_rollups ADD COLUMN held_sum REAL NOT NULL DEFAULT 0',
+        'ALTER TABLE sensor_rollups ADD COLUMN held_seconds INTEGER NOT NULL DEFAULT 0'
+    ])
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Queries whose plans are checked by check_query_plans
+RECENT_READINGS_SQL = '''
+SELECT timestamp, value FROM sensor_readings
+WHERE sensor_id = ? AND timestamp > ?
+ORDER BY timestamp ASC
+'''
+
+PREVIOUS_READING_SQL = '''
+SELECT timestamp, value FROM sensor_readings
+WHERE sensor_id = ? AND timestamp <= ?
+ORDER BY timestamp DESC LIMIT 1
+'''
+
+HISTORY_RAW_SQL = '''
+SELECT timestamp, value, value, value, 1 FROM sensor_readings
+WHERE sensor_id = ? AND timestamp > ? AND timestamp <= ?
+ORDER BY timestamp ASC
+'''
+
+RANGE_READINGS_SQL = '''
+SELECT timestamp, value FROM sensor_readings
+WHERE sensor_id = ? AND timestamp > ? AND timestamp <= ?
+ORDER BY timestamp ASC
+'''
+
+CHUNKS_SQL = '''
+SELECT data FROM sensor_chunks
+WHERE sensor_id = ? AND hour > ? AND hour <= ?
+ORDER BY hour ASC
+'''
+
+PREVIOUS_CHUNK_SQL = '''
+SELECT data FROM sensor_chunks
+WHERE sensor_id = ? AND hour <= ? AND first_timestamp <= ?
+ORDER BY hour DESC LIMIT 1
+'''
+
+# The average is time-weighted; buckets with no time credited yet (the
+# newest point's, until the next point arrives) average their points
+HISTORY_ROLLUP_SQL = '''
+SELECT bucket - bucket % ?,
+       CASE WHEN sum(held_seconds) > 0 THEN sum(held_sum) / sum(held_seconds)
+            ELSE sum(sum_value) / sum(count) END,
+       min(min_value), max(max_value), sum(count)
+FROM sensor_rollups
+WHERE resolution = ? AND sensor_id = ? AND bucket > ? AND bucket <= ?
+GROUP BY bucket - bucket % ?
+ORDER BY 1 ASC
+'''
+
+RECENT_EVENTS_BY_TYPE_SQL = '''
+SELECT timestamp, event_type, details FROM events
+WHERE event_type = ?
+ORDER BY timestamp DESC LIMIT ?
+'''
+
+RECENT_EVENTS_SQL = '''
+SELECT timestamp, event_type, details FROM events
+ORDER BY timestamp DESC LIMIT ?
+'''
+
+# One event as a JSON object built by SQLite, embedding details unparsed
+EVENT_JSON_SQL = '''
+SELECT json_object('id', id, 'timestamp', timestamp, 'event_type', event_type,
+                   'severity', severity, 'source', source, 'zone', zone,
+                   'details', json(details)),
+       timestamp, id
+FROM events
+'''
+
+EVENTS_PAGE_SQL = EVENT_JSON_SQL + '''
+WHERE (timestamp, id) < (?, ?)
+ORDER BY timestamp DESC, id DESC LIMIT ?
+'''
+
+EVENTS_PAGE_BY_TYPE_SQL = EVENT_JSON_SQL + '''
+WHERE event_type = ? AND (timestamp, id) < (?, ?)
+ORDER BY timestamp DESC, id DESC LIMIT ?
+'''
+
+GROWING_PROFILES_SQL = '''
+SELECT id, name, crop, stage_count, total_days, created_at, updated_at
+FROM growing_profiles
+ORDER BY name
+'''
+
+INSERT_EVENT_SQL = '''
+INSERT INTO events (timestamp, event_type, details, severity, source, zone)
+VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+# Expected plans: (name, sql, params, text that must appear, text that must not).
+# A quick check run after migrations; tests/test_query_plans.py asserts the
+# plan of every statement Database runs, including SQL built at run time
+QUERY_PLAN_EXPECTATIONS = [
+    ('get_setting', 'SELECT value FROM settings WHERE id = ?', ('x',),
+     'USING INDEX sqlite_autoindex_settings_1', 'SCAN'),
+    ('get_recent_sensor_readings', RECENT_READINGS_SQL, ('x', 0),
+     'USING COVERING INDEX idx_sensor_readings_sensor_time', 'TEMP B-TREE'),
+    ('get_sensor_history previous', PREVIOUS_READING_SQL, ('x', 0),
+     'USING COVERING INDEX idx_sensor_readings_sensor_time', 'TEMP B-TREE'),
+    ('get_sensor_history raw', HISTORY_RAW_SQL, ('x', 0, 1),
+     'USING COVERING INDEX idx_sensor_readings_sensor_time', 'TEMP B-TREE'),
+    ('get_sensor_history raw range', RANGE_READINGS_SQL, ('x', 0, 1),
+     'USING COVERING INDEX idx_sensor_readings_sensor_time', 'TEMP B-TREE'),
+    ('sensor chunks', CHUNKS_SQL, ('x', 0, 1),
+     'USING PRIMARY KEY (sensor_id=? AND hour>? AND hour<?)', 'TEMP B-TREE'),
+    ('sensor chunks previous', PREVIOUS_CHUNK_SQL, ('x', 0, 0),
+     'USING PRIMARY KEY (sensor_id=? AND hour<?)', 'TEMP B-TREE'),
+    ('get_sensor_history rollup', HISTORY_ROLLUP_SQL, (60, 60, 'x', 0, 1, 60),
+     'USING PRIMARY KEY (resolution=? AND sensor_id=? AND bucket>? AND bucket<?)', 'SCAN'),
+    ('get_recent_events by type', RECENT_EVENTS_BY_TYPE_SQL, ('x', 1),
+     'USING INDEX idx_events_type_time', 'TEMP B-TREE'),
+    ('get_recent_events', RECENT_EVENTS_SQL, (1,),
+     'USING INDEX idx_events_timestamp', 'TEMP B-TREE'),
+    ('get_events_page', EVENTS_PAGE_SQL, (1, 1, 1),
+     'USING INDEX idx_events_timestamp', 'TEMP B-TREE'),
+    ('get_events_page by type', EVENTS_PAGE_BY_TYPE_SQL, ('x', 1, 1, 1),
+     'USING INDEX idx_events_type_time', 'TEMP B-TREE'),
+    ('get_growing_profiles', GROWING_PROFILES_SQL, (),
+     'USING COVERING INDEX idx_growing_profiles_name', 'TEMP B-TREE'),
+    ('get_growing_profile', 'SELECT profile_data FROM growing_profiles WHERE id = ?', (1,),
+     'USING INTEGER PRIMARY KEY', 'SCAN'),
+    ('delete_sensor_readings_before',
+     'SELECT id FROM sensor_readings WHERE timestamp < ? AND sensor_id = ? LIMIT ?', (0, 'x', 1),
+     'USING COVERING INDEX idx_sensor_readings_sensor_time', 'SCAN'),
+    ('delete_events_before', 'SELECT id FROM events WHERE timestamp < ? LIMIT ?', (0, 1),
+     'USING COVERING INDEX idx_events_timestamp', 'SCAN'),
+    ('get_oldest_timestamp', 'SELECT min(timestamp) FROM sensor_readings', (),
+     'USING COVERING INDEX idx_sensor_readings_timestamp', None),
+    ('get_sensor_readings_between',
+     'SELECT timestamp, sensor_id, value FROM sensor_readings WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp ASC',
+     (0, 1), 'USING INDEX idx_sensor_readings_timestamp', 'TEMP B-TREE'),
+    ('sensor chunks between', 'SELECT sensor_id, data FROM sensor_chunks WHERE hour > ? AND hour < ?',
+     (0, 1), 'USING INDEX idx_sensor_chunks_hour (hour>? AND hour<?)', 'SCAN'),
+    ('prune sensor chunks',
+     'SELECT sensor_id, hour, last_timestamp, count, data FROM sensor_chunks '
+     'WHERE first_timestamp < ? AND hour < ? LIMIT ?', (0, 0, 1),
+     'USING INDEX idx_sensor_chunks_hour (hour<?)', 'SCAN')
+]
+
+def history_resolution(span, max_points=DEFAULT_POINT_BUDGET, resolution=None):
+    """Pick a history resolution and the rollup tier to read it from
+    
+    An explicit resolution must be 0 (raw readings) or a multiple of the
+    finest rollup tier, or ValueError is raised; otherwise the resolution
+    is chosen to fit max_points. Returns (resolution, tier), with tier 0 for
+    raw readings. utils/ring_buffer.py validates with it too.
+    """
+    if resolution is not None:
+        resolution = int(resolution)
+        if resolution == 0:
+            return 0, 0
+        tiers = [r for r in ROLLUP_RESOLUTIONS if resolution % r == 0]
+        if resolution < 0 or not tiers:
+            raise ValueError(f'Resolution must be 0 or a multiple of {ROLLUP_RESOLUTIONS[0]} seconds')
+        return resolution, tiers[-1]
+    
+    max_points = max(int(max_points), 1)
+    if span / RAW_SAMPLE_INTERVAL <= max_points:
+        return 0, 0
+    # Finest tier that fits the budget, or the coarsest tier regrouped
+    # into wider buckets when even that is too dense
+    tier = next((r for r in ROLLUP_RESOLUTIONS if span / r <= max_points),
+                ROLLUP_RESOLUTIONS[-1])
+    return tier * max(1, -(-span // (tier * max_points))), tier
+
 class Database:
-    def __init__(self, db_path='vertical_farm.db'):
+    def __init__(self, db_path='vertical_farm.db', pool_size=DEFAULT_POOL_SIZE, storage_format=None):
         self.db_path = db_path
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        self._pool_lock = threading.Lock()
+        self._open_connections = []
+        self._write_buffer = collections.deque()
+        self._buffer_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._buffer_oldest = None
+        self._flushing = ()
+        self._held = {}
+        self._buffer_stats = {
+            'flushed': 0,
+            'dropped': 0,
+            'flush_errors': 0,
+            'last_flush_rows': 0,
+            'last_flush_duration': 0.0
+        }
+        self._flush_stop = threading.Event()
+        self._flush_thread = None
+        self._settings_cache = {}
+        self._settings_lock = threading.Lock()
+        self._setting_subscribers = collections.defaultdict(list)
+        self.recent_cache = None
+        self.has_event_search = False
+        self._write_listeners = []
+        self.storage_format = 'rows'
+        self._compacted_before = None
         self._initialize_db()
+        
+        # The format is kept in settings; passing one converts the database
+        self.storage_format = self._get_setting('storage_format', 'rows')
+        if storage_format is not None and storage_format != self.storage_format:
+            self.set_storage_format(storage_format)
+    
+    def _create_connection(self):
+        """Open a new tuned SQLite connection"""
+        # check_same_thread is off because pooled connections move between
+        # threads; the pool guarantees only one thread uses each at a time
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=CONNECTION_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        # Lets retention return freed pages to the filesystem a few at a
+        # time. Must precede journal_mode, and only affects new databases
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute(f'PRAGMA busy_timeout={CONNECTION_TIMEOUT * 1000}')
+        return conn
+    
+    @contextmanager
+    def _connection(self):
+        """Check a connection out of the pool for the duration of a block"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._pool_lock:
+                if len(self._open_connections) < self.pool_size:
+                    conn = self._create_connection()
+                    self._open_connections.append(conn)
+            if conn is None:
+                # Pool exhausted, wait for another thread to hand one back
+                conn = self._pool.get(timeout=CONNECTION_TIMEOUT)
+        
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._pool.put(conn)
+    
+    def close(self):
+        """Flush buffered readings and close all pooled connections"""
+        self._flush_stop.set()
+        if self._flush_thread and self._flush_thread is not threading.current_thread():
+            self._flush_thread.join(timeout=WRITE_BUFFER_MAX_AGE)
+        self.flush()
+        
+        with self._pool_lock:
+            for conn in self._open_connections:
+                try:
+                    conn.close()
+                except Exception as e:
+                    logger.error(f'Error closing database connection: {str(e)}')
+            self._open_connections = []
+            self._pool = queue.LifoQueue()
     
     def _initialize_db(self):
         """Initialize the database if it doesn't exist"""
         try:
             # Create database tables if they don't exist
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Settings table
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                id TEXT PRIMARY KEY,
-                value TEXT,
-                updated_at INTEGER
-            )
-            ''')
-            
-            # Sensor readings table
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sensor_readings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp INTEGER,
-                sensor_id TEXT,
-                value REAL
-            )
-            ''')
-            
-            # Events table
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS events (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp INTEGER,
-                event_type TEXT,
-                details TEXT
-            )
-            ''')
-            
-            # Growing profiles table
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS growing_profiles (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT,
-                profile_data TEXT,
-                created_at INTEGER,
-                updated_at INTEGER
-            )
-            ''')
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                # A database already at the latest schema version needs no DDL,
+                # and its query plans were checked when it was migrated
+                if self._stored_schema_version(cursor) == SCHEMA_VERSION:
+                    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'events_fts'")
+                    self.has_event_search = cursor.fetchone() is not None
+                    logger.info(f'Database schema is current (version {SCHEMA_VERSION})')
+                    return
+                
+                # Settings table
+                cursor.execute('''
+                CREATE TABLE IF NOT EXISTS settings (
+                    id TEXT PRIMARY KEY,
+                    value TEXT,
+                    updated_at INTEGER
+                )
+                ''')
+                
+                # Sensor readings table
+                cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sensor_readings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp INTEGER,
+                    sensor_id TEXT,
+                    value REAL
+                )
+                ''')
+                
+                # Sensor rollups table (min/max/sum/count per time bucket)
+                cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sensor_rollups (
+                    resolution INTEGER,
+                    sensor_id TEXT,
+                    bucket INTEGER,
+                    min_value REAL,
+                    max_value REAL,
+                    sum_value REAL,
+                    count INTEGER,
+                    PRIMARY KEY (resolution, sensor_id, bucket)
+                ) WITHOUT ROWID
+                ''')
+                
+                # Events table
+                cursor.execute('''
+                CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp INTEGER,
+                    event_type TEXT,
+                    details TEXT
+                )
+                ''')
+                
+                # Growing profiles table
+                cursor.execute('''
+                CREATE TABLE IF NOT EXISTS growing_profiles (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT,
+                    profile_data TEXT,
+                    created_at INTEGER,
+                    updated_at INTEGER
+                )
+                ''')
+                
+                conn.commit()
+                
+                # Indexes and later schema changes are versioned migrations
+                self._apply_migrations(conn)
+                
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'events_fts'")
+                self.has_event_search = cursor.fetchone() is not None
             
-            # Create indexes for faster queries
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sensor_readings_sensor_id ON sensor_readings (sensor_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sensor_readings_timestamp ON sensor_readings (timestamp)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_events_timestamp ON events (timestamp)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_events_type ON events (event_type)')
+            for problem in self.check_query_plans():
+                logger.warning(f'Query plan regression: {problem}')
             
-            conn.commit()
-            conn.close()
             logger.info('Database initialized successfully')
         except Exception as e:
             logger.error(f'Error initializing database: {str(e)}')
             raise
     
-    def _save_setting(self, setting_id, value):
-        """Save a setting to the database"""
+    def _stored_schema_version(self, cursor):
+        """Read the schema version, or 0 if the settings table doesn't exist yet"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            cursor.execute("SELECT value FROM settings WHERE id = 'schema_version'")
+        except sqlite3.OperationalError:
+            return 0
+        result = cursor.fetchone()
+        return int(result[0]) if result else 0
+    
+    def _apply_migrations(self, conn):
+        """Apply schema migrations newer than the stored schema version
+        
+        Each migration runs in its own explicit transaction with its
+        schema_version update. sqlite3 doesn't open a transaction for DDL on
+        its own, so without BEGIN every ALTER or CREATE would commit at once
+        and a migration failing partway would be left half-applied.
+        """
+        cursor = conn.cursor()
+        version = self._stored_schema_version(cursor)
+        
+        for migration_version, description, migration in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            
+            logger.info(f'Applying database migration {migration_version}: {description}')
+            cursor.execute('BEGIN')
+            try:
+                if callable(migration):
+                    migration(cursor)
+                else:
+                    for statement in migration:
+                        cursor.execute(statement)
+                
+                cursor.execute('''
+                INSERT OR REPLACE INTO settings (id, value, updated_at)
+                VALUES ('schema_version', ?, ?)
+                ''', (str(migration_version), int(time.time())))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    
+    def get_schema_version(self):
+        """Get the schema version the database has been migrated to"""
+        return int(self._get_setting('schema_version', 0))
+    
+    def explain_query_plan(self, sql, params=()):
+        """Get the EXPLAIN QUERY PLAN detail lines for a query"""
+        with self._connection() as conn:
             cursor = conn.cursor()
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return [row[3] for row in cursor.fetchall()]
+    
+    def check_query_plans(self):
+        """Check every query in QUERY_PLAN_EXPECTATIONS, returning a list of problems"""
+        problems = []
+        for name, sql, params, required, forbidden in QUERY_PLAN_EXPECTATIONS:
+            try:
+                plan = ' | '.join(self.explain_query_plan(sql, params))
+            except Exception as e:
+                problems.append(f'{name}: {str(e)}')
+                continue
             
-            # Convert value to JSON if it's not a string
-            if not isinstance(value, str):
-                value = json.dumps(value)
+            if required and required not in plan:
+                problems.append(f'{name}: expected "{required}", got "{plan}"')
+            if forbidden and forbidden in plan:
+                problems.append(f'{name}: unexpected "{forbidden}" in "{plan}"')
+        return problems
+    
+    def _save_setting(self, setting_id, value):
+        """Save a setting to the database and update the settings cache"""
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                # Convert value to JSON if it's not a string
+                if not isinstance(value, str):
+                    value = json.dumps(value)
+                
+                # Update or insert the setting
+                cursor.execute('''
+                INSERT OR REPLACE INTO settings (id, value, updated_at)
+                VALUES (?, ?, ?)
+                ''', (setting_id, value, int(time.time())))
+                
+                conn.commit()
             
-            # Update or insert the setting
-            cursor.execute('''
-            INSERT OR REPLACE INTO settings (id, value, updated_at)
-            VALUES (?, ?, ?)
-            ''', (setting_id, value, int(time.time())))
+            # Write through, caching the value exactly as a read would decode it
+            decoded = self._decode_setting(value)
+            with self._settings_lock:
+                self._settings_cache[setting_id] = decoded
             
-            conn.commit()
-            conn.close()
+            self._notify_setting_subscribers(setting_id, decoded)
             return True
         except Exception as e:
             logger.error(f'Error saving setting {setting_id}: {str(e)}')
             return False
     
     def _get_setting(self, setting_id, default=None):
-        """Get a setting from the database"""
+        """Get a setting, from the settings cache when possible"""
+        with self._settings_lock:
+            cached = self._settings_cache.get(setting_id, _NOT_CACHED)
+        if cached is not _NOT_CACHED:
+            # Copy so callers can't mutate the cached value
+            return default if cached is _MISSING else copy.deepcopy(cached)
+        
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT value FROM settings WHERE id = ?', (setting_id,))
-            result = cursor.fetchone()
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('SELECT value FROM settings WHERE id = ?', (setting_id,))
+                result = cursor.fetchone()
             
-            conn.close()
+            decoded = self._decode_setting(result[0]) if result else _MISSING
+            with self._settings_lock:
+                self._settings_cache.setdefault(setting_id, decoded)
             
-            if result:
-                try:
-                    return json.loads(result[0])
-                except json.JSONDecodeError:
-                    return result[0]
-            return default
+            return default if decoded is _MISSING else copy.deepcopy(decoded)
         except Exception as e:
             logger.error(f'Error getting setting {setting_id}: {str(e)}')
             return default
     
-    def save_sensor_reading(self, sensor_id, value):
+    def _decode_setting(self, value):
+        """Decode a stored setting value, falling back to the raw string"""
+        try:
+            return json.loads(value)
+        except (TypeError, json.JSONDecodeError):
+            return value
+    
+    def invalidate_settings_cache(self, setting_id=None):
+        """Drop one or all settings from the cache so they are re-read"""
+        with self._settings_lock:
+            if setting_id is None:
+                self._settings_cache.clear()
+            else:
+                self._settings_cache.pop(setting_id, None)
+    
+    def subscribe(self, setting_id, callback):
+        """Call callback(setting_id, value) whenever a setting is saved
+        
+        Pass None as setting_id to be notified about every setting.
+        """
+        with self._settings_lock:
+            self._setting_subscribers[setting_id].append(callback)
+        return callback
+    
+    def unsubscribe(self, setting_id, callback):
+        """Remove a callback registered with subscribe"""
+        with self._settings_lock:
+            if callback in self._setting_subscribers.get(setting_id, []):
+                self._setting_subscribers[setting_id].remove(callback)
+    
+    def _notify_setting_subscribers(self, setting_id, value):
+        """Tell subscribers that a setting changed"""
+        with self._settings_lock:
+            callbacks = self._setting_subscribers.get(setting_id, []) + self._setting_subscribers.get(None, [])
+        
+        for callback in callbacks:
+            try:
+                callback(setting_id, copy.deepcopy(value))
+            except Exception as e:
+                logger.error(f'Error in settings subscriber for {setting_id}: {str(e)}')
+    
+    def add_write_listener(self, callback):
+        """Call callback(kind, rows) for every batch of data written
+        
+        kind is 'readings' with (timestamp, sensor_id, value) rows, or
+        'events' with (timestamp, event_type, details, severity, source,
+        zone) rows where details is JSON text.
+        """
+        self._write_listeners.append(callback)
+        return callback
+    
+    def _notify_write_listeners(self, kind, rows):
+        """Hand written rows to the write listeners"""
+        for callback in self._write_listeners:
+            try:
+                callback(kind, rows)
+            except Exception as e:
+                logger.error(f'Error in write listener for {kind}: {str(e)}')
+    
+    def save_sensor_reading(self, sensor_id, value, timestamp=None):
         """Save a sensor reading to the database"""
+        return self.save_sensor_readings([(sensor_id, value)], timestamp)
+    
+    def save_sensor_readings(self, readings, timestamp=None):
+        """Queue a batch of sensor readings for writing
+        
+        readings is either a {sensor_id: value} dict or an iterable of
+        (sensor_id, value) or (sensor_id, value, timestamp) tuples.
+        Non-numeric values are skipped.
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            if timestamp is None:
+                timestamp = int(time.time())
+            if isinstance(readings, dict):
+                readings = readings.items()
+            
+            rows = []
+            for reading in readings:
+                sensor_id, value = reading[0], reading[1]
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                row_time = reading[2] if len(reading) > 2 else timestamp
+                rows.append((int(row_time), sensor_id, value))
             
-            cursor.execute('''
-            INSERT INTO sensor_readings (timestamp, sensor_id, value)
-            VALUES (?, ?, ?)
-            ''', (int(time.time()), sensor_id, value))
+            # Large imports are queued in limit-sized chunks so they are
+            # flushed as they go instead of overflowing the buffer
+            for i in range(0, len(rows), WRITE_BUFFER_LIMIT):
+                self._enqueue_readings(rows[i:i + WRITE_BUFFER_LIMIT])
             
-            conn.commit()
-            conn.close()
+            if rows and self._write_listeners:
+                self._notify_write_listeners('readings', rows)
             return True
         except Exception as e:
-            logger.error(f'Error saving sensor reading for {sensor_id}: {str(e)}')
+            logger.error(f'Error saving sensor readings: {str(e)}')
             return False
     
-    def get_recent_sensor_readings(self, sensor_id, hours=24):
-        """Get recent sensor readings from the database"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+    def _enqueue_readings(self, rows):
+        """Add rows to the write buffer, applying back-pressure when it is full"""
+        # Back-pressure: flush synchronously before growing past the limit
+        if len(self._write_buffer) + len(rows) > WRITE_BUFFER_LIMIT:
+            self.flush()
+        
+        with self._buffer_lock:
+            overflow = len(self._write_buffer) + len(rows) - WRITE_BUFFER_LIMIT
+            if overflow > 0:
+                # Flushing failed as well, so drop the oldest readings
+                for _ in range(overflow):
+                    self._write_buffer.popleft()
+                self._buffer_stats['dropped'] += overflow
+                logger.warning(f'Sensor write buffer full, dropped {overflow} readings')
             
-            # Get readings from the last X hours
-            start_time = int(time.time()) - (hours * 3600)
-            
-            cursor.execute('''
-            SELECT timestamp, value FROM sensor_readings
-            WHERE sensor_id = ? AND timestamp > ?
-            ORDER BY timestamp ASC
-            ''', (sensor_id, start_time))
-            
-            results = cursor.fetchall()
-            conn.close()
+            if not self._write_buffer:
+                self._buffer_oldest = time.time()
+            self._write_buffer.extend(rows)
+            depth = len(self._write_buffer)
+            age = time.time() - self._buffer_oldest
+        
+        self._start_flush_thread()
+        if depth >= WRITE_BUFFER_SIZE or age >= WRITE_BUFFER_MAX_AGE:
+            self.flush()
+    
+    def flush(self):
+        """Write all buffered sensor readings in a single transaction"""
+        with self._flush_lock:
+            with self._buffer_lock:
+                if not self._write_buffer:
+                    return True
+                rows = list(self._write_buffer)
+                self._write_buffer.clear()
+                self._flushing = rows
+                oldest = self._buffer_oldest
+                self._buffer_oldest = None
             
-            return [(r[0], r[1]) for r in results]
+            start = time.time()
+            try:
+                with self._connection() as conn:
+                    conn.executemany('''
+                    INSERT INTO sensor_readings (timestamp, sensor_id, value)
+                    VALUES (?, ?, ?)
+                    ''', rows)
+                    self._update_rollups(conn, rows)
+                    conn.commit()
+                
+                self._buffer_stats['flushed'] += len(rows)
+                self._buffer_stats['last_flush_rows'] = len(rows)
+                self._buffer_stats['last_flush_duration'] = time.time() - start
+                
+                if self.storage_format == 'chunks':
+                    self._maybe_compact()
+                return True
+            except Exception as e:
+                logger.error(f'Error flushing {len(rows)} sensor readings: {str(e)}')
+                self._buffer_stats['flush_errors'] += 1
+                # The rollup tails moved on with the rolled back batch
+                self._held.clear()
+                
+                # Put the rows back in front of anything queued meanwhile
+                with self._buffer_lock:
+                    self._write_buffer.extendleft(reversed(rows))
+                    self._buffer_oldest = oldest
+                    while len(self._write_buffer) > WRITE_BUFFER_LIMIT:
+                        self._write_buffer.popleft()
+                        self._buffer_stats['dropped'] += 1
+                return False
+            finally:
+                self._flushing = ()
+    
+    def _flush_overlapping(self, sensor_ids=None, start=None, end=None, exclude_sensor_ids=()):
+        """Flush before a read only if buffered readings fall inside its window
+        
+        Reads of windows the buffer doesn't touch leave it to the flush
+        thread, so history and export queries stay plain reads. Readings a
+        flush has taken off the buffer but not committed count too. Bounds
+        are inclusive; flushing for a reading just outside the window is
+        harmless.
+        """
+        with self._buffer_lock:
+            overlaps = any(
+                (start is None or timestamp >= start)
+                and (end is None or timestamp <= end)
+                and (sensor_ids is None or sensor_id in sensor_ids)
+                and sensor_id not in exclude_sensor_ids
+                for rows in (self._write_buffer, self._flushing)
+                for timestamp, sensor_id, _ in rows
+            )
+        if overlaps:
+            self.flush()
+    
+    def _update_rollups(self, conn, rows):
+        """Fold a batch of (timestamp, sensor_id, value) rows into the rollup tiers
+        
+        Besides the min/max/sum/count of the points, every bucket a value
+        holds over is credited with value * seconds held (see MAX_HOLD). A
+        point's hold ends at the sensor's next point, so it is credited when
+        that point is folded; self._held keeps each sensor's newest point
+        between batches. Call with the flush lock held.
+        """
+        buckets = {}
+        by_sensor = collections.defaultdict(list)
+        for timestamp, sensor_id, value in rows:
+            by_sensor[sensor_id].append((timestamp, value))
+            for resolution in ROLLUP_RESOLUTIONS:
+                key = (resolution, sensor_id, timestamp - timestamp % resolution)
+                agg = buckets.get(key)
+                if agg is None:
+                    buckets[key] = [value, value, value, 1, 0.0, 0]
+                else:
+                    agg[0] = min(agg[0], value)
+                    agg[1] = max(agg[1], value)
+                    agg[2] += value
+                    agg[3] += 1
+        
+        for sensor_id, points in by_sensor.items():
+            points.sort(key=lambda p: p[0])
+            held = self._held.get(sensor_id)
+            if held is None:
+                held = self._previous_reading(conn.cursor(), sensor_id, points[0][0] - 1)
+            for timestamp, value in points:
+                if held is not None and timestamp < held[0]:
+                    # A late reading; its interval was credited to the
+                    # value held then, until rollups are rebuilt
+                    continue
+                if held is not None:
+                    self._credit_hold(buckets, sensor_id, held[0], timestamp, held[1])
+                held = (timestamp, value)
+            self._held[sensor_id] = held
+        
+        conn.executemany('''
+        INSERT INTO sensor_rollups
+            (resolution, sensor_id, bucket, min_value, max_value, sum_value, count, held_sum, held_seconds)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (resolution, sensor_id, bucket) DO UPDATE SET
+            min_value = min(min_value, excluded.min_value),
+            max_value = max(max_value, excluded.max_value),
+            sum_value = sum_value + excluded.sum_value,
+            count = count + excluded.count,
+            held_sum = held_sum + excluded.held_sum,
+            held_seconds = held_seconds + excluded.held_seconds
+        ''', [key + tuple(agg) for key, agg in buckets.items()])
+    
+    def _credit_hold(self, buckets, sensor_id, start, end, value):
+        """Credit value as held over [start, end) to every bucket it overlaps"""
+        end = min(end, start + MAX_HOLD)
+        for resolution in ROLLUP_RESOLUTIONS:
+            at = start
+            while at < end:
+                bucket = at - at % resolution
+                until = min(end, bucket + resolution)
+                agg = buckets.get((resolution, sensor_id, bucket))
+                if agg is None:
+                    # A bucket the value holds through without a point in it
+                    agg = buckets[(resolution, sensor_id, bucket)] = [value, value, 0.0, 0, 0.0, 0]
+                else:
+                    agg[0] = min(agg[0], value)
+                    agg[1] = max(agg[1], value)
+                agg[4] += value * (until - at)
+                agg[5] += until - at
+                at = until
+    
+    def rebuild_rollups(self, sensor_id=None):
+        """Rebuild the rollup tiers from raw sensor readings, a sensor and a day at a time"""
+        self.flush()
+        
+        try:
+            with self._flush_lock, self._connection() as conn:
+                cursor = conn.cursor()
+                
+                if sensor_id:
+                    sensor_ids = [sensor_id]
+                    cursor.execute('DELETE FROM sensor_rollups WHERE sensor_id = ?', (sensor_id,))
+                else:
+                    cursor.execute('SELECT DISTINCT sensor_id FROM sensor_readings')
+                    sensor_ids = {row[0] for row in cursor.fetchall()}
+                    if self.storage_format == 'chunks':
+                        cursor.execute('SELECT DISTINCT sensor_id FROM sensor_chunks')
+                        sensor_ids.update(row[0] for row in cursor.fetchall())
+                    cursor.execute('DELETE FROM sensor_rollups')
+                
+                for rebuilt_id in sensor_ids:
+                    self._held.pop(rebuilt_id, None)
+                    span = self._sensor_span(cursor, rebuilt_id)
+                    if span is None:
+                        continue
+                    # Windows are (start, end], so start just before the first reading
+                    for window in range(span[0] - 1, span[1], COMPACT_WINDOW):
+                        points = self._read_series(cursor, rebuilt_id, window, window + COMPACT_WINDOW)
+                        if points:
+                            self._update_rollups(conn, [(t, rebuilt_id, v) for t, v in points])
+                
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f'Error rebuilding sensor rollups: {str(e)}')
+            return False
+    
+    def _sensor_span(self, cursor, sensor_id):
+        """Get a sensor's first and last reading timestamps, or None if it has none"""
+        cursor.execute('SELECT min(timestamp), max(timestamp) FROM sensor_readings WHERE sensor_id = ?',
+                       (sensor_id,))
+        first, last = cursor.fetchone()
+        if self.storage_format == 'chunks':
+            cursor.execute('SELECT min(first_timestamp), max(last_timestamp) FROM sensor_chunks WHERE sensor_id = ?',
+                           (sensor_id,))
+            packed_first, packed_last = cursor.fetchone()
+            if packed_first is not None:
+                first = packed_first if first is None else min(first, packed_first)
+                last = packed_last if last is None else max(last, packed_last)
+        return None if first is None else (first, last)
+    
+    def get_write_buffer_stats(self):
+        """Get queue depth and flush statistics for the write buffer"""
+        with self._buffer_lock:
+            stats = dict(self._buffer_stats)
+            stats['depth'] = len(self._write_buffer)
+            stats['limit'] = WRITE_BUFFER_LIMIT
+            stats['oldest_age'] = time.time() - self._buffer_oldest if self._buffer_oldest else 0
+        return stats
+    
+    def _start_flush_thread(self):
+        """Start the thread that flushes readings once they reach the max age"""
+        if self._flush_thread or self._flush_stop.is_set():
+            return
+        with self._buffer_lock:
+            if self._flush_thread:
+                return
+            self._flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flush_thread.start()
+    
+    def _flush_loop(self):
+        """Periodically flush readings that have waited too long"""
+        while not self._flush_stop.wait(WRITE_BUFFER_MAX_AGE / 2):
+            oldest = self._buffer_oldest
+            if oldest and time.time() - oldest >= WRITE_BUFFER_MAX_AGE:
+                self.flush()
+    
+    def get_recent_sensor_readings(self, sensor_id, hours=24):
+        """Get recent sensor readings from the database
+        
+        Readings are stored only when they change meaningfully (see
+        utils/deadband.py), so a value holds until the next reading.
+        
+        Windows that recent_cache (a utils.ring_buffer.RingBufferStore) still
+        holds are answered from memory without touching SQLite.
+        """
+        # Get readings from the last X hours
+        start_time = int(time.time()) - (hours * 3600)
+        
+        if self.recent_cache is not None:
+            cached = self.recent_cache.get_recent_readings(sensor_id, start_time)
+            if cached is not None:
+                return cached
+        
+        # Make buffered readings visible to the query
+        self._flush_overlapping((sensor_id,), start_time)
+        
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                results = self._read_series(cursor, sensor_id, start_time)
+                
+                return [(r[0], r[1]) for r in results]
         except Exception as e:
             logger.error(f'Error getting recent sensor readings for {sensor_id}: {str(e)}')
             return []
     
-    def log_event(self, event_type, details):
-        """Log an event to the database"""
+    def get_sensor_history(self, sensor_id, start=None, end=None, max_points=DEFAULT_POINT_BUDGET,
+                           resolution=None):
+        """Get sensor history downsampled to at most max_points points
+        
+        Returns the chosen resolution (0 for raw readings) and a list of
+        [timestamp, avg, min, max, count] points. Passing resolution skips
+        the point budget; see history_resolution.
+        
+        Stored readings hold until the next one, so raw history starts with
+        the value in force at start as a point at start with a count of 0.
+        """
+        end = int(end if end is not None else time.time())
+        start = int(start if start is not None else end - 24 * 3600)
+        span = max(end - start, 1)
+        resolution, tier = history_resolution(span, max_points, resolution)
+        # The value carried into a raw window can be any age
+        self._flush_overlapping((sensor_id,), start - tier if resolution else None, end)
+        
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Convert details to JSON if it's not a string
-            if not isinstance(details, str):
-                details = json.dumps(details)
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                if resolution == 0:
+                    points = self._carried_reading(cursor, sensor_id, start)
+                    if self.storage_format == 'chunks':
+                        points += [[t, v, v, v, 1] for t, v in self._read_series(cursor, sensor_id, start, end)]
+                    else:
+                        cursor.execute(HISTORY_RAW_SQL, (sensor_id, start, end))
+                        points += [list(r) for r in cursor.fetchall()]
+                else:
+                    cursor.execute(HISTORY_ROLLUP_SQL,
+                                   (resolution, tier, sensor_id, start - tier, end, resolution))
+                    points = [list(r) for r in cursor.fetchall()]
             
-            cursor.execute('''
-            INSERT INTO events (timestamp, event_type, details)
-            VALUES (?, ?, ?)
-            ''', (int(time.time()), event_type, details))
+            return {
+                'sensor_id': sensor_id,
+                'start': start,
+                'end': end,
+                'resolution': resolution,
+                'points': points
+            }
+        except Exception as e:
+            logger.error(f'Error getting sensor history for {sensor_id}: {str(e)}')
+            return {'sensor_id': sensor_id, 'start': start, 'end': end, 'resolution': None, 'points': []}
+    
+    def _carried_reading(self, cursor, sensor_id, start):
+        """Get the value in force at start as a [start, avg, min, max, 0] history point, if any"""
+        previous = self._previous_reading(cursor, sensor_id, start)
+        if previous is None:
+            return []
+        return [[start, previous[1], previous[1], previous[1], 0]]
+    
+    def iter_sensor_history(self, sensor_ids, start, end, resolution=0, batch_size=EXPORT_BATCH_SIZE):
+        """Stream history rows for several sensors in bounded memory
+        
+        Yields (sensor_id, timestamp, avg, min, max, count) tuples, one
+        sensor after another, fetching batch_size rows at a time. Raw rows
+        start with the value in force at start, as in get_sensor_history.
+        The rows come from a dedicated connection rather than the pool, so a
+        slow consumer never holds up other queries. Raises ValueError for an
+        unsupported resolution before anything is read. An error while
+        streaming is logged and raised from the iterator, so output built
+        from it is cut off rather than ending like a complete export.
+        """
+        resolution, tier = history_resolution(max(end - start, 1), resolution=resolution)
+        return self._iter_history_rows(list(sensor_ids), int(start), int(end), resolution, tier, batch_size)
+    
+    def _iter_history_rows(self, sensor_ids, start, end, resolution, tier, batch_size):
+        """Generator behind iter_sensor_history"""
+        self._flush_overlapping(set(sensor_ids), start - tier if resolution else None, end)
+        
+        conn = None
+        try:
+            conn = self._create_connection()
+            cursor = conn.cursor()
+            for sensor_id in sensor_ids:
+                if resolution == 0:
+                    for point in self._carried_reading(cursor, sensor_id, start):
+                        yield (sensor_id,) + tuple(point)
+                
+                if resolution == 0 and self.storage_format == 'chunks':
+                    # Merged from rows and chunks a day at a time
+                    for window in range(start, end, COMPACT_WINDOW):
+                        for t, v in self._read_series(cursor, sensor_id, window, min(window + COMPACT_WINDOW, end)):
+                            yield (sensor_id, t, v, v, v, 1)
+                    continue
+                
+                if resolution == 0:
+                    cursor.execute(HISTORY_RAW_SQL, (sensor_id, start, end))
+                else:
+                    cursor.execute(HISTORY_ROLLUP_SQL,
+                                   (resolution, tier, sensor_id, start - tier, end, resolution))
+                
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for r in rows:
+                        yield (sensor_id,) + tuple(r)
+        except Exception as e:
+            logger.error(f'Error streaming sensor history: {str(e)}')
+            raise
+        finally:
+            if conn is not None:
+                conn.close()
+    
+    def log_event(self, event_type, details, severity='info', source=None, zone=None, timestamp=None):
+        """Log an event to the database
+        
+        details is stored as JSON; a string that isn't JSON already is
+        stored as a JSON string, so it reads back unchanged.
+        """
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                row = self._event_row(event_type, details, severity, source, zone, timestamp)
+                cursor.execute(INSERT_EVENT_SQL, row)
+                
+                conn.commit()
             
-            conn.commit()
-            conn.close()
+            if self._write_listeners:
+                self._notify_write_listeners('events', [row])
             return True
         except Exception as e:
             logger.error(f'Error logging event {event_type}: {str(e)}')
             return False
     
+    def _event_row(self, event_type, details, severity='info', source=None, zone=None, timestamp=None):
+        """Build an events row, with details as JSON text"""
+        # Convert details to JSON if it's not a string
+        if not isinstance(details, str):
+            details = json.dumps(details)
+        else:
+            try:
+                json.loads(details)
+            except ValueError:
+                details = json.dumps(details)
+        
+        return (int(timestamp if timestamp is not None else time.time()),
+                event_type, details, severity, source, zone)
+    
     def get_recent_events(self, event_type=None, limit=100):
         """Get recent events from the database"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                if event_type:
+                    cursor.execute(RECENT_EVENTS_BY_TYPE_SQL, (event_type, limit))
+                else:
+                    cursor.execute(RECENT_EVENTS_SQL, (limit,))
+                
+                results = cursor.fetchall()
+                
+                events = []
+                for r in results:
+                    try:
+                        details = json.loads(r[2])
+                    except json.JSONDecodeError:
+                        details = r[2]
+                    
+                    events.append({
+                        'timestamp': r[0],
+                        'event_type': r[1],
+                        'details': details
+                    })
+                
+                return events
+        except Exception as e:
+            logger.error(f'Error getting recent events: {str(e)}')
+            return []
+    
+    def get_events_page(self, limit=50, cursor=None, event_type=None, severity=None,
+                        source=None, zone=None, search=None, start=None, end=None):
+        """Get one page of events, newest first, as JSON text
+        
+        Returns (events, next_cursor). Each event is a JSON object string
+        built by SQLite, so details are never decoded in Python. cursor is
+        the (timestamp, id) of the last event on the previous page; pages
+        continue strictly after it however deep they go, and next_cursor
+        is None on the last page. search matches words in details using
+        full-text search when available, or a substring match otherwise.
+        """
+        limit = max(1, min(int(limit), MAX_EVENTS_PAGE))
+        before = tuple(cursor) if cursor else (end + 1 if end is not None else 2 ** 62, 0)
+        # A blank search matches everything, and would be an empty MATCH
+        search = search.strip() if search else None
+        
+        try:
+            with self._connection() as conn:
+                db_cursor = conn.cursor()
+                
+                if event_type and not any((severity, source, zone, search, start)):
+                    db_cursor.execute(EVENTS_PAGE_BY_TYPE_SQL, (event_type,) + before + (limit + 1,))
+                elif not any((severity, source, zone, search, start)):
+                    db_cursor.execute(EVENTS_PAGE_SQL, before + (limit + 1,))
+                else:
+                    conditions = ['(timestamp, id) < (?, ?)']
+                    params = list(before)
+                    for column, value in (('event_type', event_type), ('severity', severity),
+                                          ('source', source), ('zone', zone)):
+                        if value:
+                            conditions.append(f'{column} = ?')
+                            params.append(value)
+                    if start is not None:
+                        conditions.append('timestamp >= ?')
+                        params.append(int(start))
+                    if search and self.has_event_search:
+                        # Quote each word so user input can't break the query syntax
+                        words = ['"' + word.replace('"', '""') + '"' for word in search.split()]
+                        conditions.append('id IN (SELECT rowid FROM events_fts WHERE events_fts MATCH ?)')
+                        params.append(' '.join(words))
+                    elif search:
+                        # % and _ in the search are literal characters
+                        escaped = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                        conditions.append("details LIKE ? ESCAPE '\\'")
+                        params.append(f'%{escaped}%')
+                    
+                    db_cursor.execute(EVENT_JSON_SQL + f'''
+                    WHERE {' AND '.join(conditions)}
+                    ORDER BY timestamp DESC, id DESC LIMIT ?
+                    ''', params + [limit + 1])
+                
+                # One extra row tells whether another page follows
+                rows = db_cursor.fetchall()
             
-            if event_type:
+            next_cursor = (rows[limit - 1][1], rows[limit - 1][2]) if len(rows) > limit else None
+            return [r[0] for r in rows[:limit]], next_cursor
+        except Exception as e:
+            logger.error(f'Error getting events page: {str(e)}')
+            return [], None
+    
+    # Actuator command journal
+    
+    def save_command(self, command):
+        """Journal a new command record, committing before returning"""
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
                 cursor.execute('''
-                SELECT timestamp, event_type, details FROM events
-                WHERE event_type = ?
-                ORDER BY timestamp DESC LIMIT ?
-                ''', (event_type, limit))
-            else:
+                INSERT INTO command_journal
+                    (id, idempotency_key, target, command, status, result, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (command['id'], command['idempotency_key'], command['target'],
+                      json.dumps(command['command']), command['status'],
+                      json.dumps(command['result']), command['created_at'], command['updated_at']))
+                
+                conn.commit()
+                return True
+        except sqlite3.IntegrityError:
+            # Another request journaled the same idempotency key first
+            return False
+        except Exception as e:
+            logger.error(f'Error journaling command {command["id"]}: {str(e)}')
+            return False
+    
+    def update_command(self, command_id, status, result=None):
+        """Record a command's new status and result"""
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
                 cursor.execute('''
-                SELECT timestamp, event_type, details FROM events
-                ORDER BY timestamp DESC LIMIT ?
-                ''', (limit,))
-            
-            results = cursor.fetchall()
-            conn.close()
-            
-            events = []
-            for r in results:
-                try:
-                    details = json.loads(r[2])
-                except json.JSONDecodeError:
-                    details = r[2]
-                
-                events.append({
-                    'timestamp': r[0],
-                    'event_type': r[1],
-                    'details': details
-                })
-            
-            return events
+                UPDATE command_journal SET status = ?, result = ?, updated_at = ?
+                WHERE id = ?
+                ''', (status, json.dumps(result), time.time(), command_id))
+                
+                conn.commit()
+                return True
         except Exception as e:
-            logger.error(f'Error getting recent events: {str(e)}')
+            logger.error(f'Error updating command {command_id}: {str(e)}')
+            return False
+    
+    def _command_from_row(self, row):
+        return {
+            'id': row[0],
+            'idempotency_key': row[1],
+            'target': row[2],
+            'command': json.loads(row[3]),
+            'status': row[4],
+            'result': json.loads(row[5]) if row[5] else None,
+            'created_at': row[6],
+            'updated_at': row[7]
+        }
+    
+    def get_command(self, command_id=None, idempotency_key=None):
+        """Get a journaled command by id or idempotency key"""
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                column, value = ('id', command_id) if command_id else ('idempotency_key', idempotency_key)
+                cursor.execute(f'''
+                SELECT id, idempotency_key, target, command, status, result, created_at, updated_at
+                FROM command_journal WHERE {column} = ?
+                ''', (value,))
+                
+                row = cursor.fetchone()
+                return self._command_from_row(row) if row else None
+        except Exception as e:
+            logger.error(f'Error getting command {command_id or idempotency_key}: {str(e)}')
+            return None
+    
+    def get_unfinished_commands(self):
+        """Get commands left queued or running, oldest first"""
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                SELECT id, idempotency_key, target, command, status, result, created_at, updated_at
+                FROM command_journal WHERE status IN ('queued', 'running')
+                ORDER BY created_at ASC
+                ''')
+                
+                return [self._command_from_row(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f'Error getting unfinished commands: {str(e)}')
             return []
     
+    def delete_finished_commands_before(self, cutoff):
+        """Delete finished commands last updated before cutoff"""
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                DELETE FROM command_journal
+                WHERE status NOT IN ('queued', 'running') AND updated_at < ?
+                ''', (cutoff,))
+                
+                conn.commit()
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f'Error pruning command journal: {str(e)}')
+            return 0
+    
     # Specialized methods for different settings
     
     def save_light_schedules(self, schedules):
@@ -253,100 +1406,637 @@ class Database:
         """Get watering settings from the database"""
         return self._get_setting('watering_settings', {})
     
-    def save_growing_profile(self, profile):
-        """Save a growing profile to the database"""
+    def save_active_profile(self, active):
+        """Save the running growing profile as {'profile_id', 'started_at'}, or {} for none"""
+        return self._save_setting('active_profile', active)
+    
+    def get_active_profile(self):
+        """Get the running growing profile, or {} if none is running"""
+        return self._get_setting('active_profile', {})
+    
+    def save_sampling_settings(self, settings):
+        """Save sensor and controller sampling periods to the database"""
+        return self._save_setting('sampling_settings', settings)
+    
+    def get_sampling_settings(self):
+        """Get sensor and controller sampling periods from the database"""
+        return self._get_setting('sampling_settings', {})
+    
+    def save_deadband_settings(self, settings):
+        """Save change-based recording settings to the database"""
+        return self._save_setting('deadband_settings', settings)
+    
+    def get_deadband_settings(self):
+        """Get change-based recording settings from the database"""
+        return self._get_setting('deadband_settings', {})
+    
+    def save_retention_settings(self, settings):
+        """Save data retention settings to the database"""
+        return self._save_setting('retention_settings', settings)
+    
+    def get_retention_settings(self):
+        """Get data retention settings from the database"""
+        return self._get_setting('retention_settings', {})
+    
+    def save_alert_rules(self, rules):
+        """Save alert rules to the database"""
+        return self._save_setting('alert_rules', rules)
+    
+    def get_alert_rules(self):
+        """Get alert rules from the database"""
+        return self._get_setting('alert_rules', [])
+    
+    def save_replication_nodes(self, nodes):
+        """Save per-node replication status to the database"""
+        return self._save_setting('replication_nodes', nodes)
+    
+    def get_replication_nodes(self):
+        """Get per-node replication status from the database"""
+        return self._get_setting('replication_nodes', {})
+    
+    def apply_replication_batch(self, readings, events, nodes):
+        """Store a replicated batch and the replication status in one transaction
+        
+        readings are (sensor_id, value, timestamp) tuples and events are
+        (timestamp, event_type, details, severity, source, zone) tuples.
+        Unlike save_sensor_readings, the readings skip the write buffer, so
+        everything is on disk when this returns True and nothing of the
+        batch is if it returns False.
+        """
+        rows = [(int(timestamp), sensor_id, value) for sensor_id, value, timestamp in readings
+                if not isinstance(value, bool) and isinstance(value, (int, float))]
+        event_rows = [self._event_row(event_type, details, severity, source, zone, timestamp)
+                      for timestamp, event_type, details, severity, source, zone in events]
+        value = json.dumps(nodes)
+        
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            now = int(time.time())
-            
-            if 'id' in profile and profile['id']:
-                # Update existing profile
-                cursor.execute('''
-                UPDATE growing_profiles SET
-                name = ?, profile_data = ?, updated_at = ?
-                WHERE id = ?
-                ''', (
-                    profile['name'],
-                    json.dumps(profile),
-                    now,
-                    profile['id']
-                ))
-            else:
-                # Create new profile
-                cursor.execute('''
-                INSERT INTO growing_profiles (name, profile_data, created_at, updated_at)
-                VALUES (?, ?, ?, ?)
-                ''', (
-                    profile['name'],
-                    json.dumps(profile),
-                    now,
-                    now
-                ))
+            with self._flush_lock, self._connection() as conn:
+                cursor = conn.cursor()
+                
+                try:
+                    if rows:
+                        cursor.executemany('''
+                        INSERT INTO sensor_readings (timestamp, sensor_id, value)
+                        VALUES (?, ?, ?)
+                        ''', rows)
+                        self._update_rollups(conn, rows)
+                    if event_rows:
+                        cursor.executemany(INSERT_EVENT_SQL, event_rows)
+                    cursor.execute('''
+                    INSERT OR REPLACE INTO settings (id, value, updated_at)
+                    VALUES ('replication_nodes', ?, ?)
+                    ''', (value, int(time.time())))
+                    
+                    conn.commit()
+                except Exception:
+                    # The rollup tails moved on with the rolled back readings
+                    self._held.clear()
+                    raise
             
-            conn.commit()
-            conn.close()
+            decoded = json.loads(value)
+            with self._settings_lock:
+                self._settings_cache['replication_nodes'] = decoded
+            self._notify_setting_subscribers('replication_nodes', decoded)
+            if self._write_listeners:
+                if rows:
+                    self._notify_write_listeners('readings', rows)
+                if event_rows:
+                    self._notify_write_listeners('events', event_rows)
             return True
+        except Exception as e:
+            logger.error(f'Error applying replication batch: {str(e)}')
+            return False
+    
+    def save_growing_profile(self, profile):
+        """Save a growing profile to the database, returning its id or False"""
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                now = int(time.time())
+                metadata = _profile_metadata(profile)
+                
+                if 'id' in profile and profile['id']:
+                    # Update existing profile
+                    cursor.execute('''
+                    UPDATE growing_profiles SET
+                    name = ?, profile_data = ?, crop = ?, stage_count = ?, total_days = ?, updated_at = ?
+                    WHERE id = ?
+                    ''', (
+                        profile['name'],
+                        json.dumps(profile),
+                        metadata['crop'],
+                        metadata['stage_count'],
+                        metadata['total_days'],
+                        now,
+                        profile['id']
+                    ))
+                    profile_id = profile['id'] if cursor.rowcount else False
+                else:
+                    # Create new profile
+                    cursor.execute('''
+                    INSERT INTO growing_profiles
+                    (name, profile_data, crop, stage_count, total_days, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ''', (
+                        profile['name'],
+                        json.dumps(profile),
+                        metadata['crop'],
+                        metadata['stage_count'],
+                        metadata['total_days'],
+                        now,
+                        now
+                    ))
+                    profile_id = cursor.lastrowid
+                
+                conn.commit()
+                return profile_id
         except Exception as e:
             logger.error(f'Error saving growing profile: {str(e)}')
             return False
     
-    def get_growing_profiles(self):
-        """Get all growing profiles from the database"""
+    def get_growing_profiles(self, include_data=False):
+        """Get all growing profiles from the database
+        
+        Listings are read from the metadata columns' covering index; only
+        include_data reads and decodes each profile's JSON.
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-            SELECT id, name, profile_data, created_at, updated_at
-            FROM growing_profiles
-            ORDER BY name
-            ''')
-            
-            results = cursor.fetchall()
-            conn.close()
-            
-            profiles = []
-            for r in results:
-                try:
-                    profile_data = json.loads(r[2])
-                except json.JSONDecodeError:
-                    profile_data = {}
-                
-                profiles.append({
-                    'id': r[0],
-                    'name': r[1],
-                    'data': profile_data,
-                    'created_at': r[3],
-                    'updated_at': r[4]
-                })
-            
-            return profiles
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                if include_data:
+                    cursor.execute('''
+                    SELECT id, name, crop, stage_count, total_days, created_at, updated_at, profile_data
+                    FROM growing_profiles
+                    ORDER BY name
+                    ''')
+                else:
+                    cursor.execute(GROWING_PROFILES_SQL)
+                
+                results = cursor.fetchall()
+                
+                profiles = []
+                for r in results:
+                    profile = {
+                        'id': r[0],
+                        'name': r[1],
+                        'crop': r[2],
+                        'stage_count': r[3],
+                        'total_days': r[4],
+                        'created_at': r[5],
+                        'updated_at': r[6]
+                    }
+                    if include_data:
+                        try:
+                            profile['data'] = json.loads(r[7])
+                        except json.JSONDecodeError:
+                            profile['data'] = {}
+                    profiles.append(profile)
+                
+                return profiles
         except Exception as e:
             logger.error(f'Error getting growing profiles: {str(e)}')
             return []
     
+    def delete_growing_profile(self, profile_id):
+        """Delete a growing profile, returning whether it existed"""
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('DELETE FROM growing_profiles WHERE id = ?', (profile_id,))
+                
+                conn.commit()
+                return cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f'Error deleting growing profile {profile_id}: {str(e)}')
+            return False
+    
     def get_growing_profile(self, profile_id):
         """Get a specific growing profile from the database"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-            SELECT profile_data FROM growing_profiles
-            WHERE id = ?
-            ''', (profile_id,))
-            
-            result = cursor.fetchone()
-            conn.close()
-            
-            if result:
-                try:
-                    return json.loads(result[0])
-                except json.JSONDecodeError:
-                    return {}
-            return None
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                SELECT profile_data FROM growing_profiles
+                WHERE id = ?
+                ''', (profile_id,))
+                
+                result = cursor.fetchone()
+                
+                if result:
+                    try:
+                        return json.loads(result[0])
+                    except json.JSONDecodeError:
+                        return {}
+                return None
         except Exception as e:
             logger.error(f'Error getting growing profile {profile_id}: {str(e)}')
             return None
+    
+    # Chunked storage
+    
+    def set_storage_format(self, storage_format):
+        """Convert stored sensor readings to 'rows' or 'chunks' and keep using that format
+        
+        Returns whether the conversion finished. Converting a large database
+        takes a while; utils/convert_storage.py does it with the app stopped.
+        """
+        if storage_format not in STORAGE_FORMATS:
+            raise ValueError(f'Storage format must be one of {", ".join(STORAGE_FORMATS)}')
+        
+        self.flush()
+        try:
+            with self._flush_lock:
+                if storage_format == 'chunks':
+                    # Reads merge rows and chunks from here on, so they see
+                    # every reading however far packing has got
+                    self.storage_format = storage_format
+                    self._save_setting('storage_format', storage_format)
+                    moved = self._compact_rows(self._compaction_cutoff())
+                    self._compacted_before = self._compaction_cutoff()
+                else:
+                    moved = self._unpack_chunks()
+                    self.storage_format = storage_format
+                    self._save_setting('storage_format', storage_format)
+            
+            logger.info(f'Sensor readings stored as {storage_format}, {moved} readings converted')
+            return True
+        except Exception as e:
+            logger.error(f'Error converting sensor readings to {storage_format}: {str(e)}')
+            return False
+    
+    def compact_sensor_readings(self, before=None):
+        """Pack rows older than before into chunks, returning the readings packed
+        
+        before defaults to the start of the last hour that ended CHUNK_GRACE
+        seconds ago; flushes do this on their own once an hour.
+        """
+        if self.storage_format != 'chunks':
+            return 0
+        
+        self.flush()
+        try:
+            with self._flush_lock:
+                return self._compact_rows(self._compaction_cutoff() if before is None else int(before))
+        except Exception as e:
+            logger.error(f'Error packing sensor readings: {str(e)}')
+            return 0
+    
+    def _compaction_cutoff(self, now=None):
+        """Get the start of the last hour that ended at least CHUNK_GRACE seconds ago"""
+        now = int(time.time() if now is None else now) - CHUNK_GRACE
+        return now - now % CHUNK_SECONDS
+    
+    def _maybe_compact(self):
+        """Pack finished hours once per hour; called from flush with the flush lock held"""
+        cutoff = self._compaction_cutoff()
+        if self._compacted_before is not None and cutoff <= self._compacted_before:
+            return
+        
+        # Not retried until the next hour if it fails
+        self._compacted_before = cutoff
+        try:
+            self._compact_rows(cutoff)
+        except Exception as e:
+            logger.error(f'Error packing sensor readings: {str(e)}')
+    
+    def _compact_rows(self, before):
+        """Pack every row older than before into chunks, a window per transaction"""
+        packed = 0
+        while True:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('SELECT min(timestamp) FROM sensor_readings')
+                oldest = cursor.fetchone()[0]
+                if oldest is None or oldest >= before:
+                    return packed
+                
+                start = oldest - oldest % CHUNK_SECONDS
+                packed += self._pack_window(cursor, start, min(start + COMPACT_WINDOW, before))
+                conn.commit()
+    
+    def _pack_window(self, cursor, start, end):
+        """Merge the rows in [start, end) into their hourly chunks and delete them"""
+        cursor.execute('''
+        SELECT timestamp, sensor_id, value FROM sensor_readings
+        WHERE timestamp >= ? AND timestamp < ?
+        ORDER BY timestamp ASC
+        ''', (start, end))
+        rows = cursor.fetchall()
+        
+        chunks = collections.defaultdict(list)
+        for timestamp, sensor_id, value in rows:
+            if value is not None:
+                chunks[(sensor_id, timestamp - timestamp % CHUNK_SECONDS)].append((timestamp, value))
+        
+        for (sensor_id, hour), points in chunks.items():
+            cursor.execute('SELECT data FROM sensor_chunks WHERE sensor_id = ? AND hour = ?', (sensor_id, hour))
+            existing = cursor.fetchone()
+            if existing:
+                # Readings that arrived after the hour was packed
+                points = sorted(series_codec.decode(existing[0]) + points, key=lambda p: p[0])
+            self._write_chunk(cursor, sensor_id, hour, points)
+        
+        cursor.execute('DELETE FROM sensor_readings WHERE timestamp >= ? AND timestamp < ?', (start, end))
+        return len(rows)
+    
+    def _write_chunk(self, cursor, sensor_id, hour, points):
+        """Store a sensor's sorted (timestamp, value) points for an hour as one chunk"""
+        cursor.execute('''
+        INSERT OR REPLACE INTO sensor_chunks (sensor_id, hour, first_timestamp, last_timestamp, count, data)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (sensor_id, hour, points[0][0], points[-1][0], len(points), series_codec.encode(points)))
+    
+    def _unpack_chunks(self):
+        """Move every chunk back into rows, CHUNK_BATCH_SIZE chunks per transaction"""
+        unpacked = 0
+        while True:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('SELECT sensor_id, hour, data FROM sensor_chunks LIMIT ?', (CHUNK_BATCH_SIZE,))
+                chunks = cursor.fetchall()
+                if not chunks:
+                    return unpacked
+                
+                for sensor_id, hour, data in chunks:
+                    points = series_codec.decode(data)
+                    cursor.executemany('''
+                    INSERT INTO sensor_readings (timestamp, sensor_id, value)
+                    VALUES (?, ?, ?)
+                    ''', [(t, sensor_id, v) for t, v in points])
+                    cursor.execute('DELETE FROM sensor_chunks WHERE sensor_id = ? AND hour = ?', (sensor_id, hour))
+                    unpacked += len(points)
+                conn.commit()
+    
+    def _read_series(self, cursor, sensor_id, start, end=None):
+        """Get a sensor's (timestamp, value) readings after start, up to end if given"""
+        if end is None:
+            cursor.execute(RECENT_READINGS_SQL, (sensor_id, start))
+        else:
+            cursor.execute(RANGE_READINGS_SQL, (sensor_id, start, end))
+        rows = cursor.fetchall()
+        if self.storage_format != 'chunks':
+            return rows
+        
+        # A chunk holds the hour starting at its key, so one starting up to
+        # an hour before start can hold readings after it
+        cursor.execute(CHUNKS_SQL, (sensor_id, start - CHUNK_SECONDS, end if end is not None else 2 ** 62))
+        points = []
+        for (data,) in cursor.fetchall():
+            points.extend(p for p in series_codec.decode(data) if p[0] > start and (end is None or p[0] <= end))
+        if not points:
+            return rows
+        # Packed hours are all older than the rows unless late readings came in
+        return sorted(points + rows, key=lambda p: p[0])
+    
+    def _previous_reading(self, cursor, sensor_id, before):
+        """Get a sensor's last (timestamp, value) reading at or before before, or None"""
+        cursor.execute(PREVIOUS_READING_SQL, (sensor_id, before))
+        previous = cursor.fetchone()
+        if self.storage_format != 'chunks':
+            return previous
+        
+        cursor.execute(PREVIOUS_CHUNK_SQL, (sensor_id, before, before))
+        chunk = cursor.fetchone()
+        if chunk:
+            packed = [p for p in series_codec.decode(chunk[0]) if p[0] <= before][-1]
+            if previous is None or packed[0] > previous[0]:
+                previous = packed
+        return previous
+    
+    def _prune_chunks(self, cursor, cutoff, conditions, params):
+        """Delete or trim a batch of chunks holding readings older than cutoff, returning the readings removed"""
+        where = ' AND '.join(['first_timestamp < ?', 'hour < ?'] + conditions)
+        cursor.execute(f'''
+        SELECT sensor_id, hour, last_timestamp, count, data FROM sensor_chunks
+        WHERE {where} LIMIT ?
+        ''', [cutoff, cutoff] + params + [CHUNK_BATCH_SIZE])
+        
+        removed = 0
+        for sensor_id, hour, last_timestamp, count, data in cursor.fetchall():
+            if last_timestamp < cutoff:
+                cursor.execute('DELETE FROM sensor_chunks WHERE sensor_id = ? AND hour = ?', (sensor_id, hour))
+                removed += count
+            else:
+                # The cutoff falls inside this chunk's hour
+                kept = [p for p in series_codec.decode(data) if p[0] >= cutoff]
+                self._write_chunk(cursor, sensor_id, hour, kept)
+                removed += count - len(kept)
+        return removed
+    
+    def get_storage_stats(self):
+        """Get the storage format and how many readings and bytes rows and chunks hold"""
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('SELECT count(*) FROM sensor_readings')
+                rows = cursor.fetchone()[0]
+                cursor.execute('SELECT count(*), coalesce(sum(count), 0), coalesce(sum(length(data)), 0) FROM sensor_chunks')
+                chunks, chunk_readings, chunk_bytes = cursor.fetchone()
+                
+                return {
+                    'storage_format': self.storage_format,
+                    'rows': rows,
+                    'chunks': chunks,
+                    'chunk_readings': chunk_readings,
+                    'chunk_bytes': chunk_bytes,
+                    'chunk_bytes_per_reading': round(chunk_bytes / chunk_readings, 2) if chunk_readings else None,
+                    'database_size': self._database_size(conn)
+                }
+        except Exception as e:
+            logger.error(f'Error getting storage stats: {str(e)}')
+            return {'storage_format': self.storage_format}
+    
+    # Retention and maintenance helpers
+    
+    def delete_sensor_readings_before(self, cutoff, sensor_id=None, exclude_sensor_ids=(), limit=PRUNE_CHUNK_SIZE):
+        """Delete one chunk of sensor readings older than cutoff, returning the row count"""
+        self.flush()
+        
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                conditions = ['timestamp < ?']
+                params = [cutoff]
+                if sensor_id is not None:
+                    conditions.append('sensor_id = ?')
+                    params.append(sensor_id)
+                if exclude_sensor_ids:
+                    conditions.append(f'sensor_id NOT IN ({",".join("?" * len(exclude_sensor_ids))})')
+                    params.extend(exclude_sensor_ids)
+                
+                cursor.execute(f'''
+                DELETE FROM sensor_readings WHERE id IN (
+                    SELECT id FROM sensor_readings WHERE {' AND '.join(conditions)} LIMIT ?
+                )
+                ''', params + [limit])
+                deleted = cursor.rowcount
+                
+                if self.storage_format == 'chunks':
+                    deleted += self._prune_chunks(cursor, cutoff, conditions[1:], params[1:])
+                
+                conn.commit()
+                return deleted
+        except Exception as e:
+            logger.error(f'Error pruning sensor readings: {str(e)}')
+            return 0
+    
+    def delete_rollups_before(self, resolution, cutoff, limit=PRUNE_CHUNK_SIZE):
+        """Delete one chunk of rollup buckets older than cutoff, returning the row count"""
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                DELETE FROM sensor_rollups WHERE (resolution, sensor_id, bucket) IN (
+                    SELECT resolution, sensor_id, bucket FROM sensor_rollups
+                    WHERE resolution = ? AND bucket < ? LIMIT ?
+                )
+                ''', (resolution, cutoff, limit))
+                
+                conn.commit()
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f'Error pruning {resolution}s rollups: {str(e)}')
+            return 0
+    
+    def delete_events_before(self, cutoff, limit=PRUNE_CHUNK_SIZE):
+        """Delete one chunk of events older than cutoff, returning the row count"""
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                DELETE FROM events WHERE id IN (
+                    SELECT id FROM events WHERE timestamp < ? LIMIT ?
+                )
+                ''', (cutoff, limit))
+                
+                conn.commit()
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f'Error pruning events: {str(e)}')
+            return 0
+    
+    def get_oldest_timestamp(self, table):
+        """Get the oldest timestamp in sensor_readings or events"""
+        if table not in ('sensor_readings', 'events'):
+            raise ValueError(f'Unknown table {table}')
+        
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f'SELECT min(timestamp) FROM {table}')
+                oldest = cursor.fetchone()[0]
+                
+                if table == 'sensor_readings' and self.storage_format == 'chunks':
+                    cursor.execute('''
+                    SELECT min(first_timestamp) FROM sensor_chunks
+                    WHERE hour = (SELECT min(hour) FROM sensor_chunks)
+                    ''')
+                    packed = cursor.fetchone()[0]
+                    if packed is not None and (oldest is None or packed < oldest):
+                        oldest = packed
+                return oldest
+        except Exception as e:
+            logger.error(f'Error getting oldest timestamp in {table}: {str(e)}')
+            return None
+    
+    def get_sensor_readings_between(self, start, end, sensor_id=None, exclude_sensor_ids=()):
+        """Get all (timestamp, sensor_id, value) readings in [start, end)"""
+        self._flush_overlapping(None if sensor_id is None else (sensor_id,), start, end,
+                                exclude_sensor_ids)
+        
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                conditions = ['timestamp >= ?', 'timestamp < ?']
+                params = [start, end]
+                if sensor_id is not None:
+                    conditions.append('sensor_id = ?')
+                    params.append(sensor_id)
+                if exclude_sensor_ids:
+                    conditions.append(f'sensor_id NOT IN ({",".join("?" * len(exclude_sensor_ids))})')
+                    params.extend(exclude_sensor_ids)
+                
+                cursor.execute(f'''
+                SELECT timestamp, sensor_id, value FROM sensor_readings
+                WHERE {' AND '.join(conditions)}
+                ORDER BY timestamp ASC
+                ''', params)
+                rows = cursor.fetchall()
+                
+                if self.storage_format == 'chunks':
+                    cursor.execute(f'''
+                    SELECT sensor_id, data FROM sensor_chunks
+                    WHERE {' AND '.join(['hour > ?', 'hour < ?'] + conditions[2:])}
+                    ''', [start - CHUNK_SECONDS, end] + params[2:])
+                    for chunk_sensor_id, data in cursor.fetchall():
+                        rows.extend((t, chunk_sensor_id, v) for t, v in series_codec.decode(data) if start <= t < end)
+                    rows.sort(key=lambda r: r[0])
+                
+                return rows
+        except Exception as e:
+            logger.error(f'Error getting sensor readings between {start} and {end}: {str(e)}')
+            return []
+    
+    def get_events_between(self, start, end):
+        """Get all (timestamp, event_type, details) events in [start, end)"""
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                SELECT timestamp, event_type, details FROM events
+                WHERE timestamp >= ? AND timestamp < ?
+                ORDER BY timestamp ASC
+                ''', (start, end))
+                
+                return cursor.fetchall()
+        except Exception as e:
+            logger.error(f'Error getting events between {start} and {end}: {str(e)}')
+            return []
+    
+    def get_database_size(self):
+        """Get the size of the database file in bytes"""
+        try:
+            with self._connection() as conn:
+                return self._database_size(conn)
+        except Exception as e:
+            logger.error(f'Error getting database size: {str(e)}')
+            return 0
+    
+    def _database_size(self, conn):
+        """Get the database size in bytes using an existing connection"""
+        page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        return page_count * page_size
+    
+    def incremental_vacuum(self, max_pages=None):
+        """Return free pages to the filesystem, returning the bytes reclaimed"""
+        try:
+            with self._connection() as conn:
+                if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                    # Databases created before incremental auto-vacuum need a
+                    # one-off full VACUUM before pages can be released
+                    logger.info('Incremental vacuum unavailable, run VACUUM once to enable it')
+                    return 0
+                
+                before = self._database_size(conn)
+                # executescript steps the pragma to completion; execute()
+                # only frees a single page
+                pages = f'({int(max_pages)})' if max_pages else ''
+                conn.executescript(f'PRAGMA incremental_vacuum{pages};')
+                
+                return max(before - self._database_size(conn), 0)
+        except Exception as e:
+            logger.error(f'Error running incremental vacuum: {str(e)}')
+            return 0
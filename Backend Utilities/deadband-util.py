@@ -0,0 +1,161 @@
+# File: utils/deadband.py - Change-based recording of sensor readings
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Per-sensor recording rules, overridden by the 'deadband_settings' setting.
+# absolute/relative set the deadband, max_silence forces a heartbeat point
+# after that many seconds without one, and mode is 'deadband' (readers hold
+# each value until the next point) or 'swinging_door' (readers interpolate
+# linearly between points; absolute is the target deviation)
+DEFAULT_DEADBAND_SETTINGS = {
+    'default': {
+        'mode': 'deadband',
+        'absolute': 0.0,
+        'relative': 0.0,
+        'max_silence': 300
+    },
+    'sensors': {
+        'temperature': {'absolute': 0.1},
+        'humidity': {'absolute': 0.5},
+        'ph': {'absolute': 0.02},
+        'ec': {'absolute': 0.02},
+        'co2': {'absolute': 10}
+    }
+}
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class _SwingingDoor:
+    """Swinging-door trending state for one sensor"""
+
+    def __init__(self, timestamp, value):
+        self.origin = (timestamp, value)
+        self.last = (timestamp, value)
+        self.upper = float('inf')
+        self.lower = float('-inf')
+
+    def add(self, timestamp, value, deviation):
+        """Add a point, returning the point to archive if the door closes"""
+        origin_time, origin_value = self.origin
+        if timestamp <= origin_time:
+            return None
+
+        dt = timestamp - origin_time
+        upper = min(self.upper, (value + deviation - origin_value) / dt)
+        lower = max(self.lower, (value - deviation - origin_value) / dt)
+
+        if lower > upper:
+            # No line from the origin stays within deviation of every point
+            # since it: archive the previous point and start from there
+            archived = self.last
+            self.origin = archived
+            dt = timestamp - archived[0]
+            self.upper = (value + deviation - archived[1]) / dt
+            self.lower = (value - deviation - archived[1]) / dt
+            self.last = (timestamp, value)
+            return archived
+
+        self.upper, self.lower = upper, lower
+        self.last = (timestamp, value)
+        return None
+
+class DeadbandFilter:
+    """Decides which readings are worth recording or broadcasting"""
+
+    def __init__(self, settings=None, force_mode=None):
+        self.force_mode = force_mode
+        self.update_settings(settings or {})
+        self._recorded = {}
+        self._doors = {}
+        self.stats = {'received': 0, 'recorded': 0}
+
+    def update_settings(self, settings):
+        """Apply new settings merged over the defaults"""
+        default = dict(DEFAULT_DEADBAND_SETTINGS['default'])
+        default.update(settings.get('default', {}))
+        sensors = {k: dict(v) for k, v in DEFAULT_DEADBAND_SETTINGS['sensors'].items()}
+        for sensor_id, rules in settings.get('sensors', {}).items():
+            sensors.setdefault(sensor_id, {}).update(rules)
+        self.default = default
+        self.sensors = sensors
+
+    def rules_for(self, sensor_id):
+        """Get the recording rules for a sensor"""
+        rules = dict(self.default)
+        rules.update(self.sensors.get(sensor_id, {}))
+        if self.force_mode:
+            rules['mode'] = self.force_mode
+        return rules
+
+    def filter(self, readings, timestamp):
+        """Filter a {sensor_id: value} dict taken at timestamp
+
+        Returns a list of (sensor_id, value, timestamp) points to keep. In
+        swinging-door mode a kept point can be an earlier reading.
+        """
+        points = []
+        for sensor_id, value in readings.items():
+            self.stats['received'] += 1
+            point = self._filter_one(sensor_id, value, timestamp)
+            if point:
+                points.append(point)
+                self._recorded[sensor_id] = (point[2], point[1])
+        self.stats['recorded'] += len(points)
+        return points
+
+    def _filter_one(self, sensor_id, value, timestamp):
+        """Decide whether to keep one reading"""
+        rules = self.rules_for(sensor_id)
+        last = self._recorded.get(sensor_id)
+
+        if last is None:
+            if _is_number(value) and rules['mode'] == 'swinging_door':
+                self._doors[sensor_id] = _SwingingDoor(timestamp, value)
+            return (sensor_id, value, timestamp)
+
+        last_time, last_value = last
+        silent_too_long = rules.get('max_silence') and timestamp - last_time >= rules['max_silence']
+
+        if not _is_number(value) or not _is_number(last_value):
+            if value != last_value or silent_too_long:
+                return (sensor_id, value, timestamp)
+            return None
+
+        if rules['mode'] == 'swinging_door':
+            door = self._doors.get(sensor_id)
+            if door is None:
+                self._doors[sensor_id] = _SwingingDoor(timestamp, value)
+                return (sensor_id, value, timestamp)
+            if silent_too_long and door.last[0] > door.origin[0]:
+                # Heartbeat: archive the held point, which the open door
+                # still covers, and restart the door from it
+                archived = door.last
+                self._doors[sensor_id] = _SwingingDoor(*archived)
+                self._doors[sensor_id].add(timestamp, value, rules['absolute'])
+                return (sensor_id, archived[1], archived[0])
+            archived = door.add(timestamp, value, rules['absolute'])
+            return (sensor_id, archived[1], archived[0]) if archived else None
+
+        band = max(rules['absolute'], rules['relative'] * abs(last_value))
+        if abs(value - last_value) > band or silent_too_long:
+            return (sensor_id, value, timestamp)
+        return None
+
+    def pending(self):
+        """Get the held points that swinging-door mode has not archived yet"""
+        points = []
+        for sensor_id, door in self._doors.items():
+            last_time, last_value = door.last
+            recorded = self._recorded.get(sensor_id)
+            if recorded is None or recorded[0] < last_time:
+                points.append((sensor_id, last_value, last_time))
+        return points
+
+    def get_stats(self):
+        """Get received/recorded counts and the resulting compression ratio"""
+        stats = dict(self.stats)
+        stats['ratio'] = stats['received'] / stats['recorded'] if stats['recorded'] else None
+        return stats
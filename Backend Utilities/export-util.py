@@ -0,0 +1,71 @@
+# File: utils/export.py - Streaming CSV/NDJSON encoding of sensor history
+
+import csv
+import io
+import json
+import zlib
+
+HISTORY_COLUMNS = ('sensor_id', 'timestamp', 'value', 'min', 'max', 'count')
+
+# Rows encoded per yielded chunk, to keep chunks a few tens of KB
+ROWS_PER_CHUNK = 500
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+def _chunked(rows, size=ROWS_PER_CHUNK):
+    """Group an iterable of rows into lists of at most size rows"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_ndjson(rows):
+    """Encode history rows as newline-delimited JSON objects"""
+    for chunk in _chunked(rows):
+        yield ''.join(
+            json.dumps(dict(zip(HISTORY_COLUMNS, row)), separators=(',', ':')) + '\n'
+            for row in chunk
+        )
+
+def iter_csv(rows):
+    """Encode history rows as CSV with a header line"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(HISTORY_COLUMNS)
+    for chunk in _chunked(rows):
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def encode_rows(rows, fmt):
+    """Encode history rows in the given format ('ndjson' or 'csv')"""
+    if fmt == 'csv':
+        return iter_csv(rows)
+    return iter_ndjson(rows)
+
+def iter_gzip(chunks, level=6):
+    """Gzip-compress a stream of text chunks without buffering it all"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def accepts_gzip(accept_encoding):
+    """Check whether an Accept-Encoding header value allows gzip"""
+    for part in (accept_encoding or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        if coding.strip().lower() in ('gzip', '*'):
+            return params.replace(' ', '') != 'q=0'
+    return False
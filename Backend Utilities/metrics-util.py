@@ -0,0 +1,323 @@
+# File: utils/metrics.py - Prometheus text-format metrics and a sampling profiler
+
+import bisect
+import collections
+import functools
+import os
+import sys
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; covers sub-millisecond SQLite calls up to slow sensor reads
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+class Registry:
+    """A set of metrics rendered together"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+
+    def get(self, name):
+        """Get a registered metric by name, or None"""
+        return self._metrics.get(name)
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+class _Value:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def _add(self, amount):
+        with self._lock:
+            self.value += amount
+
+    def set_function(self, function):
+        """Read the value from function() each time metrics are rendered
+
+        For values another component already counts, such as loop or
+        queue statistics. A function returning None leaves the sample out.
+        """
+        self.function = function
+
+    def samples(self, name, labels):
+        value = self.value
+        if self.function:
+            try:
+                value = self.function()
+            except Exception as e:
+                logger.error(f'Error reading metric {name}: {str(e)}')
+                return []
+            if value is None:
+                return []
+        return [(name, labels, value)]
+
+class _CounterValue(_Value):
+    def inc(self, amount=1):
+        if amount < 0:
+            raise ValueError('Counters can only increase')
+        self._add(amount)
+
+class _GaugeValue(_Value):
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self._add(amount)
+
+    def dec(self, amount=1):
+        self._add(-amount)
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the duration of its block"""
+        return _Timer(self)
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append((f'{name}_bucket', labels + (('le', _format_value(bound)),), cumulative))
+        samples.append((f'{name}_sum', labels, total))
+        samples.append((f'{name}_count', labels, cumulative))
+        return samples
+
+class _Metric:
+    kind = None
+    # Appended to the name for HELP, TYPE and the samples
+    suffix = ''
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        if registry is not None:
+            registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values, **named):
+        """Get the child metric for a set of label values"""
+        if named:
+            values = tuple(named[label] for label in self.labelnames)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}')
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _unlabelled(self):
+        if self.labelnames:
+            raise ValueError(f'{self.name} needs labels {self.labelnames}')
+        return self._children[()]
+
+    def render(self):
+        documentation = self.documentation.replace('\\', '\\\\').replace('\n', '\\n')
+        family = self.name + self.suffix
+        lines = [f'# HELP {family} {documentation}', f'# TYPE {family} {self.kind}']
+        with self._lock:
+            children = sorted(self._children.items())
+        for key, child in children:
+            labels = tuple(zip(self.labelnames, key))
+            for name, sample_labels, value in child.samples(family, labels):
+                label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in sample_labels)
+                lines.append(f'{name}{{{label_text}}} {_format_value(value)}' if label_text
+                             else f'{name} {_format_value(value)}')
+        return lines
+
+class Counter(_Metric):
+    """A count that only goes up, exposed as <name>_total"""
+
+    kind = 'counter'
+    suffix = '_total'
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self._unlabelled().inc(amount)
+
+    def set_function(self, function):
+        self._unlabelled().set_function(function)
+
+class Gauge(_Metric):
+    """A value that goes up and down, set directly or read from a function"""
+
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        self._unlabelled().set(value)
+
+    def inc(self, amount=1):
+        self._unlabelled().inc(amount)
+
+    def dec(self, amount=1):
+        self._unlabelled().dec(amount)
+
+    def set_function(self, function):
+        self._unlabelled().set_function(function)
+
+class Histogram(_Metric):
+    """A distribution of observed values, usually durations in seconds"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(float(b) for b in buckets if b != float('inf')))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._unlabelled().observe(value)
+
+    def time(self):
+        return self._unlabelled().time()
+
+def timed(function, histogram):
+    """Wrap function so each call's duration is observed in histogram"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return wrapper
+
+def instrument(obj, histogram, methods=None):
+    """Time calls to obj's public methods into histogram, labelled by method name
+
+    Replaces the methods on the instance only, so calls between methods
+    are timed too.
+    """
+    if methods is None:
+        methods = [
+            name for name in dir(type(obj))
+            if not name.startswith('_') and callable(getattr(type(obj), name, None))
+        ]
+    for name in methods:
+        setattr(obj, name, timed(getattr(obj, name), histogram.labels(name)))
+    return methods
+
+# Leaf frames of threads that are blocked waiting rather than working
+IDLE_FRAMES = {
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('selectors.py', 'select'),
+    ('queue.py', 'get'),
+    ('thread.py', '_worker'),
+    ('socket.py', 'accept'),
+    ('socket.py', 'readinto'),
+    ('socketserver.py', 'serve_forever')
+}
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+def sample_stacks(seconds, interval=0.01, include_idle=False):
+    """Sample every other thread's Python stack for seconds
+
+    Returns (Counter of collapsed stacks, number of sampling rounds). Each
+    stack is 'thread;outer;...;inner' with frames labelled
+    'function (file:line)'. Threads blocked in a wait are left out unless
+    include_idle. Only OS threads are seen, not green threads.
+    """
+    stacks = collections.Counter()
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    rounds = 0
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            code = frame.f_code
+            if not include_idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.append(names.get(ident, f'thread-{ident}'))
+            stacks[';'.join(reversed(labels))] += 1
+        rounds += 1
+        time.sleep(interval)
+    return stacks, rounds
+
+def collapsed(stacks):
+    """Format sampled stacks in the collapsed format read by flamegraph.pl and speedscope"""
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
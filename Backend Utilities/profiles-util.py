@@ -0,0 +1,247 @@
+# File: utils/profiles.py - Growing profiles compiled into setpoint timelines
+
+import bisect
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DAY = 86400
+
+# Settings a stage can set, one section per controller. Each is merged over
+# the controller's current settings; 'light' is merged into every zone's
+# schedule
+SECTIONS = ('light', 'nutrient', 'environment', 'watering')
+
+STAGE_KEYS = {'name', 'days', 'ramp'} | set(SECTIONS)
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def validate_profile(profile):
+    """Check a profile's structure, raising ValueError naming the first problem
+
+    A profile is {'name', 'crop', 'stages': [...]}, each stage
+    {'name', 'days', 'ramp', 'light', 'nutrient', 'environment', 'watering'}
+    with only name and days required. A stage with 'ramp' moves its numeric
+    setpoints towards the next stage's a day at a time.
+    """
+    if not isinstance(profile, dict):
+        raise ValueError('A profile must be an object')
+    if not profile.get('name'):
+        raise ValueError('A profile needs a name')
+    stages = profile.get('stages')
+    if not isinstance(stages, list) or not stages:
+        raise ValueError('A profile needs at least one stage')
+
+    for number, stage in enumerate(stages, 1):
+        if not isinstance(stage, dict):
+            raise ValueError(f'Stage {number} must be an object')
+        if not _is_number(stage.get('days')) or stage['days'] <= 0:
+            raise ValueError(f'Stage {number} needs a positive number of days')
+        unknown = set(stage) - STAGE_KEYS
+        if unknown:
+            raise ValueError(f'Stage {number} has unknown keys: {", ".join(sorted(unknown))}')
+        for section in SECTIONS:
+            if section in stage and not isinstance(stage[section], dict):
+                raise ValueError(f'Stage {number}: {section} must be an object')
+
+def _interpolate(current, target, fraction):
+    """Move current's numeric values a fraction of the way to target's"""
+    values = dict(current)
+    for key, value in current.items():
+        goal = target.get(key)
+        if _is_number(value) and _is_number(goal):
+            values[key] = round(value + (goal - value) * fraction, 3)
+    return values
+
+class SetpointTimeline:
+    """A profile's setpoints as change points sorted by time
+
+    Every point holds the full setpoints of every section from its time
+    until the next point, carried forward from earlier stages, so a lookup
+    is one bisect and no merging. The last point holds after the profile's
+    last stage ends.
+    """
+
+    def __init__(self, points, start, end, profile_id=None):
+        self.points = points
+        self.times = [point['time'] for point in points]
+        self.start = start
+        self.end = end
+        self.profile_id = profile_id
+
+    def __len__(self):
+        return len(self.points)
+
+    def index_at(self, timestamp):
+        """Get the index of the point in force at timestamp, or -1 before the start"""
+        return bisect.bisect_right(self.times, timestamp) - 1
+
+    def at(self, timestamp):
+        """Get the point in force at timestamp, or None before the start"""
+        i = self.index_at(timestamp)
+        return self.points[i] if i >= 0 else None
+
+    def setpoint(self, section, timestamp):
+        """Get one section's setpoints at timestamp, or None"""
+        point = self.at(timestamp)
+        return point['settings'].get(section) if point else None
+
+    def next_change(self, timestamp):
+        """Get the first point after timestamp, or None after the last one"""
+        i = bisect.bisect_right(self.times, timestamp)
+        return self.points[i] if i < len(self.points) else None
+
+def compile_profile(profile, start, profile_id=None):
+    """Compile a profile started at start (epoch seconds) into a SetpointTimeline"""
+    validate_profile(profile)
+    stages = profile['stages']
+
+    points = []
+    settings = {}
+    at = start
+    for index, stage in enumerate(stages):
+        for section in SECTIONS:
+            if section in stage:
+                settings[section] = dict(settings.get(section, {}), **stage[section])
+        base = {section: dict(values) for section, values in settings.items()}
+
+        # Ramping stages get a point per day, stepping towards the next stage
+        following = stages[index + 1] if index + 1 < len(stages) else None
+        steps = int(stage['days']) if stage.get('ramp') and following else 1
+        for day in range(max(1, steps)):
+            stepped = {
+                section: _interpolate(values, following.get(section, {}), day / steps) if day else values
+                for section, values in base.items()
+            }
+            points.append({
+                'time': at + day * DAY,
+                'stage': stage.get('name') or f'Stage {index + 1}',
+                'stage_index': index,
+                'day': day,
+                'settings': stepped
+            })
+        at += stage['days'] * DAY
+
+    return SetpointTimeline(points, start, at, profile_id)
+
+class ProfileEngine:
+    """Applies the running growing profile's setpoints as they come due
+
+    Runs as a control loop task. The running profile is the
+    'active_profile' setting, {'profile_id', 'started_at'}; its timeline is
+    compiled whenever that setting or the profile changes, so each update
+    is a single lookup. Setpoints are applied through apply(section,
+    values) only when a new point comes due, so manual changes made in
+    between stand until the next one. After a restart the point in force
+    is applied again.
+    """
+
+    def __init__(self, db, apply):
+        self.db = db
+        self.apply = apply
+        self.profile = None
+        self.timeline = None
+        self.stats = {'compiles': 0, 'points_applied': 0}
+        self._applied = None
+        self._lock = threading.Lock()
+
+        db.subscribe('active_profile', lambda setting_id, value: self.reload())
+        self.reload()
+
+    def reload(self):
+        """Compile the running profile's timeline from the database"""
+        active = self.db.get_active_profile()
+        profile = timeline = None
+        if active:
+            profile = self.db.get_growing_profile(active['profile_id'])
+            if profile is None:
+                logger.warning(f'Running growing profile {active["profile_id"]} no longer exists')
+            else:
+                try:
+                    timeline = compile_profile(profile, active['started_at'], active['profile_id'])
+                    self.stats['compiles'] += 1
+                except ValueError as e:
+                    logger.error(f'Error compiling growing profile {active["profile_id"]}: {str(e)}')
+                    profile = None
+
+        with self._lock:
+            self.profile = profile
+            self.timeline = timeline
+            self._applied = None
+
+    def activate(self, profile_id, started_at=None):
+        """Run a profile from started_at (default now), returning whether it was saved"""
+        return self.db.save_active_profile({
+            'profile_id': profile_id,
+            'started_at': int(started_at if started_at is not None else time.time())
+        })
+
+    def deactivate(self):
+        """Stop running a profile; controllers keep their current settings"""
+        return self.db.save_active_profile({})
+
+    def profile_saved(self, profile_id):
+        """Recompile if the saved profile is the one running"""
+        timeline = self.timeline
+        if timeline is not None and timeline.profile_id == profile_id:
+            self.reload()
+
+    def setpoint(self, section, timestamp=None):
+        """Get a section's setpoints at timestamp (default now), or None if no profile applies"""
+        timeline = self.timeline
+        if timeline is None:
+            return None
+        return timeline.setpoint(section, time.time() if timestamp is None else timestamp)
+
+    def update(self, sensor_data=None):
+        """Apply the point in force if it hasn't been applied yet"""
+        with self._lock:
+            timeline = self.timeline
+            if timeline is None:
+                return
+            i = timeline.index_at(time.time())
+            if i < 0 or (timeline, i) == self._applied:
+                return
+            self._applied = (timeline, i)
+        point = timeline.points[i]
+
+        for section, values in point['settings'].items():
+            try:
+                self.apply(section, values)
+            except Exception as e:
+                logger.error(f'Error applying {section} setpoints from growing profile: {str(e)}')
+        self.stats['points_applied'] += 1
+
+        self.db.log_event('profile_setpoints', {
+            'profile_id': timeline.profile_id,
+            'stage': point['stage'],
+            'day': point['day']
+        }, source='profiles')
+
+    def get_status(self, now=None):
+        """Get the running profile, its current stage and setpoints and the next change"""
+        now = time.time() if now is None else now
+        timeline, profile = self.timeline, self.profile
+        if timeline is None:
+            return {'active': False, 'stats': dict(self.stats)}
+
+        point = timeline.at(now)
+        following = timeline.next_change(now)
+        return {
+            'active': True,
+            'profile_id': timeline.profile_id,
+            'name': profile.get('name'),
+            'started_at': timeline.start,
+            'ends_at': timeline.end,
+            'day': int((now - timeline.start) // DAY),
+            'finished': now >= timeline.end,
+            'stage': point['stage'] if point else None,
+            'setpoints': point['settings'] if point else None,
+            'next_change': following['time'] if following else None,
+            'next_stage': following['stage'] if following else None,
+            'points': len(timeline),
+            'stats': dict(self.stats)
+        }
@@ -0,0 +1,410 @@
+# File: utils/replication.py - Replication of readings and events from farm nodes to an aggregator
+
+import gzip
+import hmac
+import json
+import os
+import socket
+import threading
+import time
+import logging
+import urllib.error
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+# Roles: a standalone farm controller, a node that owns some zones and
+# replicates them, or the aggregator that collects every node's data
+STANDALONE = 'standalone'
+NODE = 'node'
+AGGREGATOR = 'aggregator'
+
+INGEST_PATH = '/api/replication/ingest'
+TOKEN_HEADER = 'X-Replication-Token'
+
+# Separates the node id from a node's own sensor ids on the aggregator
+NODE_SEPARATOR = ':'
+
+BATCH_SIZE = 2000
+SEND_INTERVAL = 5
+REQUEST_TIMEOUT = 10
+MAX_SPOOL_FILES = 10000
+MAX_PENDING_ROWS = 50000
+
+# Batch numbers are this far apart, so a batch the aggregator finds too
+# large can be split into parts numbered in between, down to single rows
+SEQ_STEP = 1024
+# Batches the aggregator can't parse are kept here for inspection
+REJECTED_DIR = 'rejected'
+# The node's last batch number, kept in the spool directory
+SEQ_FILE = 'seq'
+
+def get_replication_config(environ=None):
+    """Read replication settings from FARM_* environment variables"""
+    environ = os.environ if environ is None else environ
+    return {
+        'role': environ.get('FARM_ROLE', STANDALONE),
+        'node_id': environ.get('FARM_NODE_ID', socket.gethostname()),
+        'aggregator_url': environ.get('FARM_AGGREGATOR_URL', 'http://127.0.0.1:5000'),
+        'spool_path': environ.get('FARM_SPOOL_PATH', 'spool'),
+        'token': environ.get('FARM_REPLICATION_TOKEN', '')
+    }
+
+def encode_batch(batch):
+    """Encode a batch as gzip-compressed compact JSON"""
+    return gzip.compress(json.dumps(batch, separators=(',', ':')).encode('utf-8'))
+
+def decode_batch(body, content_encoding=None):
+    """Decode a batch body, gzip-compressed or not"""
+    if content_encoding == 'gzip' or body[:2] == b'\x1f\x8b':
+        body = gzip.decompress(body)
+    return json.loads(body)
+
+class ReplicationClient:
+    """Ships a node's readings and events to the aggregator in batches
+
+    Register capture() with Database.add_write_listener. Rows collect in
+    memory and are sent every SEND_INTERVAL seconds as numbered, gzipped
+    JSON batches over HTTP. While the aggregator is unreachable, batches
+    are spooled to disk and sent, oldest first, once it is back. Batch
+    numbers let the aggregator ignore a batch it has already applied.
+
+    The last number used is saved in the spool directory, so numbering
+    carries on across restarts whatever the clock says. An ack newer than
+    the batch sent means the aggregator has seen higher numbers from this
+    node, e.g. after the spool was wiped, and ignored the batch; it is
+    renumbered after the ack and sent again.
+
+    A batch the aggregator refuses as too large (413) is split in half and
+    each half sent under its own number; one it can't parse (400) is moved
+    to the spool's rejected directory so it doesn't hold up the rest.
+    """
+
+    def __init__(self, node_id, aggregator_url, spool_path='spool', token='',
+                 batch_size=BATCH_SIZE, interval=SEND_INTERVAL):
+        self.node_id = node_id
+        self.url = aggregator_url.rstrip('/') + INGEST_PATH
+        self.spool_path = spool_path
+        self.token = token
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self._readings = []
+        self._events = []
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {
+            'batches_sent': 0,
+            'bytes_sent': 0,
+            'send_errors': 0,
+            'rejected_batches': 0,
+            'spooled_batches': 0,
+            'dropped_rows': 0,
+            'last_success': None,
+            'last_error': None
+        }
+
+        os.makedirs(self.spool_path, exist_ok=True)
+        self._seq = self._load_seq()
+
+    def capture(self, kind, rows):
+        """Write listener: queue written rows for replication"""
+        with self._lock:
+            target = self._readings if kind == 'readings' else self._events
+            target.extend(rows)
+            overflow = len(self._readings) + len(self._events) - MAX_PENDING_ROWS
+            # The sender has fallen far behind; drop the oldest readings,
+            # then the oldest events if readings alone don't make room
+            for pending in (self._readings, self._events):
+                if overflow <= 0:
+                    break
+                dropped = min(overflow, len(pending))
+                del pending[:dropped]
+                overflow -= dropped
+                self.stats['dropped_rows'] += dropped
+
+    def start(self):
+        """Start the background sender; calling it again does nothing"""
+        if self._thread and self._thread.is_alive():
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='replication', daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        """Stop the sender and spool anything not yet sent"""
+        self._stop.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(REQUEST_TIMEOUT)
+        for batch in self._take_batches():
+            self._spool(batch)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.send_pending()
+
+    def send_pending(self):
+        """Send spooled batches, then new rows, keeping batches in order
+
+        Returns False if the aggregator could not be reached, in which case
+        everything unsent is in the spool.
+        """
+        with self._send_lock:
+            for path in self._spool_files():
+                with open(path, 'rb') as f:
+                    body = f.read()
+                batch = decode_batch(body)
+                unsent = self._deliver(batch, body)
+                if not unsent or unsent[0] is not batch:
+                    # Parts left over from a split replace the file; the
+                    # first part keeps the batch's number and file name
+                    if not unsent or unsent[0]['seq'] != batch['seq']:
+                        os.remove(path)
+                    for part in unsent:
+                        self._spool(part)
+                if unsent:
+                    for new_batch in self._take_batches():
+                        self._spool(new_batch)
+                    return False
+
+            batches = self._take_batches()
+            for i, batch in enumerate(batches):
+                unsent = self._deliver(batch)
+                if unsent:
+                    for part in unsent + batches[i + 1:]:
+                        self._spool(part)
+                    return False
+            return True
+
+    def _deliver(self, batch, body=None):
+        """Send a batch, splitting it if it is too large
+
+        Returns the batches, or parts of it, still to be sent because the
+        aggregator could not be reached; the list is [batch] itself when
+        nothing was sent.
+        """
+        status, ack = self._post(body or encode_batch(batch))
+        if status is None:
+            return [batch]
+        if 200 <= status < 300 and ack > batch['seq']:
+            # The aggregator already has later batches from this node, so
+            # it ignored this one
+            logger.warning(f'Aggregator is at batch {ack}, renumbering batch {batch["seq"]}')
+            self._seq = max(self._seq, ack)
+            renumbered = dict(batch, seq=self._next_seq())
+            return self._deliver(renumbered)
+        if status == 413:
+            parts = self._split(batch)
+            if parts:
+                for i, part in enumerate(parts):
+                    unsent = self._deliver(part)
+                    if unsent:
+                        return unsent + parts[i + 1:]
+                return []
+        if status in (400, 413):
+            self._reject(batch, body, status)
+        return []
+
+    def _split(self, batch):
+        """Split a batch into two halves numbered within its span, or None if it can't be"""
+        # Batches spooled before batch numbers were spaced out have no span
+        span = batch.get('span', 1)
+        events, readings = batch.get('events', []), batch.get('readings', [])
+        half = (len(events) + len(readings)) // 2
+        if span < 2 or half == 0:
+            return None
+        span //= 2
+        first = dict(batch, span=span, events=events[:half], readings=readings[:max(0, half - len(events))])
+        second = dict(batch, seq=batch['seq'] + span, span=span, events=events[half:],
+                      readings=readings[max(0, half - len(events)):])
+        return [first, second]
+
+    def _reject(self, batch, body, status):
+        """Move a batch the aggregator refused out of the way of the rest"""
+        self.stats['rejected_batches'] += 1
+        directory = os.path.join(self.spool_path, REJECTED_DIR)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{batch["seq"]:016d}.json.gz')
+        with open(path, 'wb') as f:
+            f.write(body or encode_batch(batch))
+        logger.error(f'Aggregator rejected replication batch {batch["seq"]} ({status}), moved to {path}')
+
+    def _take_batches(self):
+        """Move queued rows into numbered batches of at most batch_size rows"""
+        with self._lock:
+            readings, self._readings = self._readings, []
+            events, self._events = self._events, []
+
+        batches = []
+        while readings or events:
+            chunk_events, events = events[:self.batch_size], events[self.batch_size:]
+            room = self.batch_size - len(chunk_events)
+            chunk_readings, readings = readings[:room], readings[room:]
+            batches.append({
+                'node_id': self.node_id,
+                'seq': self._next_seq(),
+                'span': SEQ_STEP,
+                'sent_at': time.time(),
+                'readings': chunk_readings,
+                'events': chunk_events
+            })
+        return batches
+
+    def _next_seq(self):
+        """Take the next batch number and save it before it is used"""
+        self._seq += SEQ_STEP
+        path = os.path.join(self.spool_path, SEQ_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(self._seq))
+        os.replace(path + '.tmp', path)
+        return self._seq
+
+    def _post(self, body):
+        """POST one encoded batch
+
+        Returns the HTTP status and the aggregator's ack, or None for the
+        status if the batch should be retried.
+        """
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        if self.token:
+            headers[TOKEN_HEADER] = self.token
+        request = urllib.request.Request(self.url, data=body, headers=headers, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+                reply = json.loads(response.read() or b'{}')
+                status = response.status
+            self.stats['batches_sent'] += 1
+            self.stats['bytes_sent'] += len(body)
+            self.stats['last_success'] = time.time()
+            return status, int(reply.get('ack', 0))
+        except urllib.error.HTTPError as e:
+            if e.code in (400, 413):
+                # Retrying these as they are would block every batch behind them
+                return e.code, 0
+            self.stats['send_errors'] += 1
+            self.stats['last_error'] = str(e)
+            logger.warning(f'Replication to {self.url} failed: {str(e)}')
+            return None, 0
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            self.stats['send_errors'] += 1
+            self.stats['last_error'] = str(e)
+            logger.warning(f'Replication to {self.url} failed: {str(e)}')
+            return None, 0
+
+    def _spool_files(self):
+        """Get spooled batch files, oldest first"""
+        return sorted(
+            os.path.join(self.spool_path, name)
+            for name in os.listdir(self.spool_path) if name.endswith('.json.gz')
+        )
+
+    def _load_seq(self):
+        """Get the number the next batch should follow
+
+        The saved number, or the newest spooled batch's if that is higher.
+        A node with neither starts from the clock in milliseconds, times
+        SEQ_STEP; the aggregator's ack corrects that if it is too low.
+        """
+        seqs = [int(os.path.basename(path).split('.')[0]) for path in self._spool_files()[-1:]]
+        try:
+            with open(os.path.join(self.spool_path, SEQ_FILE)) as f:
+                seqs.append(int(f.read()))
+        except (OSError, ValueError):
+            pass
+        if not seqs:
+            return int(time.time() * 1000) * SEQ_STEP
+        return max(seqs)
+
+    def _spool(self, batch, body=None):
+        """Write a batch to the spool directory"""
+        files = self._spool_files()
+        if len(files) >= MAX_SPOOL_FILES:
+            logger.warning(f'Replication spool full, dropping {files[0]}')
+            os.remove(files[0])
+
+        path = os.path.join(self.spool_path, f'{batch["seq"]:016d}.json.gz')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(body or encode_batch(batch))
+        os.replace(path + '.tmp', path)
+        self.stats['spooled_batches'] = len(files) + 1
+
+    def get_stats(self):
+        """Get send counters, queue depth and spool size"""
+        stats = dict(self.stats)
+        with self._lock:
+            stats['pending_rows'] = len(self._readings) + len(self._events)
+        stats['spooled_batches'] = len(self._spool_files())
+        stats['node_id'] = self.node_id
+        stats['aggregator'] = self.url
+        return stats
+
+class ReplicationServer:
+    """Applies node batches to the aggregator's database
+
+    Node sensor ids are stored as '<node_id>:<sensor_id>' so history and
+    the dashboard cover every node, and event sources are prefixed the
+    same way. The last batch number applied per node is kept in the
+    'replication_nodes' setting, so retried batches are not applied twice.
+    """
+
+    def __init__(self, db, token='', on_readings=None):
+        self.db = db
+        self.token = token
+        self.on_readings = on_readings
+        self._lock = threading.Lock()
+        self.nodes = db.get_replication_nodes()
+
+    def authorized(self, token):
+        """Check a request's replication token"""
+        return not self.token or hmac.compare_digest(token or '', self.token)
+
+    def ingest(self, batch):
+        """Apply one batch, returning the node's last applied batch number
+
+        The batch's readings and events and the node's new batch number
+        are committed together before the number is returned, so an
+        acknowledged batch is on disk and one that failed can be resent
+        without storing anything twice. Raises RuntimeError if the batch
+        could not be stored.
+        """
+        node_id = str(batch['node_id'])
+        seq = int(batch['seq'])
+
+        with self._lock:
+            node = self.nodes.get(node_id, {'last_seq': 0, 'readings': 0, 'events': 0})
+            if seq <= node['last_seq']:
+                return node['last_seq']
+
+            readings = [
+                (f'{node_id}{NODE_SEPARATOR}{sensor_id}', value, timestamp)
+                for timestamp, sensor_id, value in batch.get('readings', [])
+            ]
+            events = [
+                (timestamp, event_type, details, severity,
+                 f'{node_id}{NODE_SEPARATOR}{source}' if source else node_id, zone)
+                for timestamp, event_type, details, severity, source, zone in batch.get('events', [])
+            ]
+
+            nodes = dict(self.nodes)
+            nodes[node_id] = dict(node, **{
+                'last_seq': seq,
+                'last_seen': time.time(),
+                'lag': time.time() - batch.get('sent_at', time.time()),
+                'readings': node['readings'] + len(readings),
+                'events': node['events'] + len(events)
+            })
+            if not self.db.apply_replication_batch(readings, events, nodes):
+                raise RuntimeError(f'Could not store batch {seq} from {node_id}')
+            self.nodes = nodes
+
+        if readings and self.on_readings:
+            self.on_readings(readings)
+        return seq
+
+    def get_nodes(self):
+        """Get the replication status of every node seen"""
+        with self._lock:
+            return {node_id: dict(node) for node_id, node in self.nodes.items()}
@@ -0,0 +1,220 @@
+# File: utils/retention.py - Data retention, compaction and archival
+
+import os
+import re
+import threading
+import time
+import logging
+from datetime import datetime, timezone
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DAY = 86400
+
+# Default retention policy, overridden by the 'retention_settings' setting.
+# A value of None keeps data forever
+DEFAULT_RETENTION_SETTINGS = {
+    'sensor_readings_days': 30,
+    'sensor_days': {},
+    'rollup_days': {'60': 90, '900': 365, '3600': None},
+    'events_days': 180,
+    'archive_enabled': False,
+    'archive_path': 'archive',
+    'interval_hours': 6,
+    'vacuum_pages': 2000
+}
+
+# Pause between deletion chunks so the control loop can get the write lock
+CHUNK_PAUSE = 0.05
+
+class RetentionManager:
+    def __init__(self, db):
+        self.db = db
+        self.last_status = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._run_lock = threading.Lock()
+
+    def get_settings(self):
+        """Get retention settings merged over the defaults"""
+        settings = dict(DEFAULT_RETENTION_SETTINGS)
+        settings.update(self.db.get_retention_settings() or {})
+        return settings
+
+    def update_settings(self, settings):
+        """Update retention settings"""
+        current = self.db.get_retention_settings() or {}
+        current.update(settings)
+        return self.db.save_retention_settings(current)
+
+    def start(self):
+        """Start the background retention thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background retention thread"""
+        self._stop.set()
+
+    def _run_loop(self):
+        """Run retention periodically until stopped"""
+        # Give the rest of the system time to start before the first pass
+        if self._stop.wait(60):
+            return
+        while not self._stop.is_set():
+            self.run_once()
+            interval = self.get_settings().get('interval_hours') or 6
+            self._stop.wait(interval * 3600)
+
+    def run_once(self, now=None):
+        """Apply the retention policy once and log the result as an event"""
+        with self._run_lock:
+            start = time.time()
+            now = int(now if now is not None else start)
+            settings = self.get_settings()
+            status = {'rows_pruned': {}, 'archived_files': [], 'bytes_reclaimed': 0}
+
+            try:
+                status['rows_pruned']['sensor_readings'] = self._prune_sensor_readings(settings, now, status)
+                status['rows_pruned']['sensor_rollups'] = self._prune_rollups(settings, now)
+                status['rows_pruned']['events'] = self._prune_events(settings, now, status)
+
+                if sum(status['rows_pruned'].values()):
+                    status['bytes_reclaimed'] = self.db.incremental_vacuum(settings.get('vacuum_pages'))
+            except Exception as e:
+                logger.error(f'Error applying retention policy: {str(e)}')
+                status['error'] = str(e)
+
+            status['duration'] = round(time.time() - start, 3)
+            status['database_size'] = self.db.get_database_size()
+            self.last_status = status
+
+            self.db.log_event('retention', status, source='retention')
+            logger.info(f'Retention pass finished: {status}')
+            return status
+
+    def _prune_sensor_readings(self, settings, now, status):
+        """Prune raw sensor readings using the default and per-sensor TTLs"""
+        sensor_days = settings.get('sensor_days') or {}
+        pruned = 0
+
+        # Per-sensor overrides first, then everything else on the default TTL
+        for sensor_id, days in sensor_days.items():
+            if days is None:
+                continue
+            cutoff = now - int(days * DAY)
+            self._archive_partitions('sensor_readings', cutoff, settings, status, sensor_id=sensor_id)
+            pruned += self._delete_chunked(
+                self.db.delete_sensor_readings_before, cutoff, sensor_id=sensor_id)
+
+        days = settings.get('sensor_readings_days')
+        if days is not None:
+            cutoff = now - int(days * DAY)
+            excluded = tuple(sensor_days.keys())
+            self._archive_partitions('sensor_readings', cutoff, settings, status,
+                                     exclude_sensor_ids=excluded)
+            pruned += self._delete_chunked(
+                self.db.delete_sensor_readings_before, cutoff, exclude_sensor_ids=excluded)
+        return pruned
+
+    def _prune_rollups(self, settings, now):
+        """Prune each rollup tier using its own TTL"""
+        pruned = 0
+        for resolution, days in (settings.get('rollup_days') or {}).items():
+            if days is None:
+                continue
+            cutoff = now - int(days * DAY)
+            pruned += self._delete_chunked(self.db.delete_rollups_before, int(resolution), cutoff)
+        return pruned
+
+    def _prune_events(self, settings, now, status):
+        """Prune events older than the events TTL"""
+        days = settings.get('events_days')
+        if days is None:
+            return 0
+        cutoff = now - int(days * DAY)
+        self._archive_partitions('events', cutoff, settings, status)
+        return self._delete_chunked(self.db.delete_events_before, cutoff)
+
+    def _delete_chunked(self, delete, *args, **kwargs):
+        """Call a chunked delete until it stops removing rows"""
+        total = 0
+        while not self._stop.is_set():
+            deleted = delete(*args, **kwargs)
+            total += deleted
+            if deleted <= 0:
+                break
+            time.sleep(CHUNK_PAUSE)
+        return total
+
+    def _archive_partitions(self, table, cutoff, settings, status, **selection):
+        """Export expired days of a table to compressed columnar files
+
+        selection narrows sensor_readings to a sensor_id or excludes the
+        sensors that have their own TTL, matching the rows about to be deleted.
+        """
+        if not settings.get('archive_enabled'):
+            return
+
+        oldest = self.db.get_oldest_timestamp(table)
+        if oldest is None:
+            return
+
+        # Archive day-sized partitions; a partially expired day is exported
+        # as far as the cutoff and the remainder on the next pass
+        day = oldest - oldest % DAY
+        while day < cutoff and not self._stop.is_set():
+            end = min(day + DAY, cutoff)
+            path = self._export_partition(table, day, end, settings.get('archive_path'), selection)
+            if path:
+                status['archived_files'].append(path)
+            day += DAY
+
+    def _export_partition(self, table, start, end, archive_path, selection):
+        """Write one partition to an .npz file, returning its path"""
+        directory = os.path.join(archive_path, table)
+        os.makedirs(directory, exist_ok=True)
+        day = datetime.fromtimestamp(start, tz=timezone.utc).strftime('%Y%m%d')
+        suffix = f'-{selection["sensor_id"]}' if selection.get('sensor_id') else ''
+
+        # A pass interrupted between archiving and deleting leaves rows that
+        # are already archived; start after them instead of writing them twice
+        start = max(start, self._archived_until(directory, table, day, suffix))
+        if start >= end:
+            return None
+
+        if table == 'sensor_readings':
+            rows = self.db.get_sensor_readings_between(start, end, **selection)
+        else:
+            rows = self.db.get_events_between(start, end)
+        if not rows:
+            return None
+
+        timestamps, keys, values = zip(*rows)
+        path = os.path.join(directory, f'{table}-{day}-{start}-{end}{suffix}.npz')
+
+        # Sensor ids and event types are stored dictionary-encoded
+        names, codes = np.unique(np.array(keys, dtype=str), return_inverse=True)
+        columns = {
+            'timestamp': np.array(timestamps, dtype=np.int64),
+            'key_names': names,
+            'key_codes': codes.astype(np.uint32)
+        }
+        if table == 'sensor_readings':
+            columns['value'] = np.array(values, dtype=np.float64)
+        else:
+            columns['details'] = np.array(values, dtype=str)
+
+        np.savez_compressed(path, **columns)
+        return path
+
+    def _archived_until(self, directory, table, day, suffix):
+        """Get the end of the latest archive of a day's partition, or 0 if there is none"""
+        pattern = re.compile(rf'{table}-{day}-(\d+)-(\d+){re.escape(suffix)}\.npz$')
+        ends = [int(match.group(2)) for match in map(pattern.match, os.listdir(directory)) if match]
+        return max(ends, default=0)
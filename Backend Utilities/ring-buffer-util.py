@@ -0,0 +1,228 @@
+# File: utils/ring_buffer.py - In-memory columnar ring buffers of recent sensor readings
+
+import threading
+import logging
+
+import numpy as np
+
+from utils.database import history_resolution
+
+logger = logging.getLogger(__name__)
+
+# Readings kept per sensor: about 11 hours at a 5 second sampling period,
+# at 256 KB per sensor
+DEFAULT_CAPACITY = 8192
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class SensorRing:
+    """Fixed-size ring of timestamp/value readings for one sensor
+
+    The arrays are twice the capacity and every reading is written at both
+    i and i + capacity, so the live readings are always one contiguous
+    slice and windows are views rather than copies. Timestamps only move
+    forward; an older reading than the newest one is ignored.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._timestamps = np.zeros(2 * capacity, dtype=np.float64)
+        self._values = np.zeros(2 * capacity, dtype=np.float64)
+        self._start = 0
+        self._count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, value):
+        """Add a reading, overwriting the oldest when full"""
+        with self.lock:
+            if self._count and timestamp < self._timestamps[self._start + self._count - 1]:
+                return False
+            if self._count < self.capacity:
+                i = (self._start + self._count) % self.capacity
+                self._count += 1
+            else:
+                i = self._start
+                self._start = (self._start + 1) % self.capacity
+            self._timestamps[i] = self._timestamps[i + self.capacity] = timestamp
+            self._values[i] = self._values[i + self.capacity] = value
+            return True
+
+    def oldest(self):
+        """Get the timestamp of the oldest reading held, or None"""
+        return self._timestamps[self._start] if self._count else None
+
+    def newest(self):
+        """Get the timestamp of the newest reading held, or None"""
+        return self._timestamps[self._start + self._count - 1] if self._count else None
+
+    def window(self, start=None, end=None):
+        """Get (timestamps, values) views of readings with start < t <= end
+
+        The views are read-only and share memory with the ring: take them
+        under `lock`, or copy them, if appends may overwrite their oldest
+        entries while they are in use.
+        """
+        timestamps = self._timestamps[self._start:self._start + self._count]
+        values = self._values[self._start:self._start + self._count]
+        lo = 0 if start is None else np.searchsorted(timestamps, start, side='right')
+        hi = len(timestamps) if end is None else np.searchsorted(timestamps, end, side='right')
+        timestamps, values = timestamps[lo:hi], values[lo:hi]
+        timestamps.flags.writeable = False
+        values.flags.writeable = False
+        return timestamps, values
+
+    def value_at(self, timestamp):
+        """Get the last value at or before timestamp, or None"""
+        timestamps, values = self.window(end=timestamp)
+        return float(values[-1]) if len(values) else None
+
+class RingBufferStore:
+    """Per-sensor ring buffers fed by the control loop
+
+    Holds every numeric reading, before deadband filtering, for the recent
+    past. Callers fall back to the database for anything older than the
+    oldest reading a ring holds.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, capacities=None):
+        self.capacity = capacity
+        self.capacities = dict(capacities or {})
+        self._rings = {}
+        self._lock = threading.Lock()
+
+    def _ring(self, sensor_id, create=False):
+        ring = self._rings.get(sensor_id)
+        if ring is None and create:
+            with self._lock:
+                ring = self._rings.setdefault(
+                    sensor_id, SensorRing(self.capacities.get(sensor_id, self.capacity)))
+        return ring
+
+    def sensor_ids(self):
+        """Get the ids of sensors with buffered readings"""
+        return list(self._rings)
+
+    def append(self, readings, timestamp):
+        """Add a {sensor_id: value} dict of readings taken at timestamp"""
+        for sensor_id, value in readings.items():
+            if _is_number(value):
+                self._ring(sensor_id, create=True).append(timestamp, value)
+
+    def covers(self, sensor_id, start):
+        """Check whether the buffer holds every reading after start"""
+        ring = self._ring(sensor_id)
+        oldest = ring.oldest() if ring else None
+        return oldest is not None and oldest <= start
+
+    def window(self, sensor_id, start=None, end=None):
+        """Get (timestamps, values) views for a sensor; see SensorRing.window"""
+        ring = self._ring(sensor_id)
+        if ring is None:
+            empty = np.empty(0, dtype=np.float64)
+            return empty, empty
+        return ring.window(start, end)
+
+    def get_recent_readings(self, sensor_id, start):
+        """Get readings after start as (timestamp, value) tuples
+
+        Returns None when the buffer doesn't reach back to start.
+        """
+        if not self.covers(sensor_id, start):
+            return None
+        ring = self._ring(sensor_id)
+        with ring.lock:
+            timestamps, values = ring.window(start)
+            readings = list(zip(timestamps.astype(np.int64).tolist(), values.tolist()))
+        return readings
+
+    def stats(self, sensor_id, seconds, now=None):
+        """Get min, max, mean and slope of a sensor over the last seconds
+
+        slope is the least-squares trend in units per minute. Returns None
+        when there are no readings in the window.
+        """
+        ring = self._ring(sensor_id)
+        if ring is None:
+            return None
+        with ring.lock:
+            end = now if now is not None else ring.newest()
+            if end is None:
+                return None
+            timestamps, values = ring.window(end - seconds, end)
+            if not len(values):
+                return None
+
+            t = timestamps - timestamps.mean()
+            denominator = np.dot(t, t)
+            slope = np.dot(t, values - values.mean()) / denominator * 60 if denominator else 0.0
+            return {
+                'count': int(len(values)),
+                'start': float(timestamps[0]),
+                'end': float(timestamps[-1]),
+                'min': float(values.min()),
+                'max': float(values.max()),
+                'mean': float(values.mean()),
+                'last': float(values[-1]),
+                'slope': float(slope)
+            }
+
+    def history(self, sensor_id, start, end, max_points=500, resolution=None):
+        """Downsample buffered readings like Database.get_sensor_history
+
+        Returns None when the buffer doesn't reach back to start. The
+        resolution is picked and validated by utils.database.history_resolution,
+        so a request gets the same buckets from either source; raw history is
+        only kept when the readings also fit max_points. Raw history starts
+        with the value at start as a point with a count of 0.
+
+        The rings hold every reading, before deadband filtering, where the
+        database holds only changes and heartbeats. Raw history here has
+        every sample and bucket counts are samples, not stored points. A
+        bucket's average over evenly spaced samples matches the database's
+        time-weighted one to within the deadband tolerance.
+        """
+        span = max(int(end - start), 1)
+        budget = resolution is None
+        resolution = history_resolution(span, max_points, resolution)[0]
+        if not self.covers(sensor_id, start):
+            return None
+        ring = self._ring(sensor_id)
+        with ring.lock:
+            timestamps, values = ring.window(start, end)
+            if budget and resolution == 0 and len(values) > max(int(max_points), 1):
+                # Sampled faster than the database's raw budget assumes
+                resolution = 60 * max(1, -(-span // (60 * max(int(max_points), 1))))
+
+            if resolution == 0:
+                points = [[int(t), v, v, v, 1] for t, v in zip(timestamps.tolist(), values.tolist())]
+                previous = ring.value_at(start)
+                if previous is not None:
+                    points.insert(0, [int(start), previous, previous, previous, 0])
+            elif not len(values):
+                points = []
+            else:
+                buckets = timestamps.astype(np.int64) // resolution * resolution
+                # Readings are sorted, so each bucket is one contiguous run
+                edges = np.flatnonzero(np.diff(buckets)) + 1
+                starts = np.concatenate(([0], edges))
+                counts = np.diff(np.concatenate((starts, [len(values)])))
+                points = np.column_stack((
+                    buckets[starts],
+                    np.add.reduceat(values, starts) / counts,
+                    np.minimum.reduceat(values, starts),
+                    np.maximum.reduceat(values, starts),
+                    counts
+                )).tolist()
+                points = [[int(p[0]), p[1], p[2], p[3], int(p[4])] for p in points]
+
+        return {
+            'sensor_id': sensor_id,
+            'start': start,
+            'end': end,
+            'resolution': resolution,
+            'points': points
+        }
@@ -0,0 +1,194 @@
+# File: utils/series_codec.py - Gorilla-style compression of sensor reading series
+
+import struct
+
+# Value encodings. Readings that are exact at a few decimal places (most
+# sensors report 1-2) are stored as integer deltas at that precision;
+# anything else is stored losslessly as XORed float64 bits
+XOR = 0
+QUANTIZED = 1
+MAX_PRECISION = 6
+
+# Encoding, precision, point count, first timestamp
+HEADER = struct.Struct('>BBIq')
+
+# Variable-width classes as (prefix, prefix bits, value bits); the last
+# class takes anything. Timestamps are delta-of-delta encoded, so a steady
+# sampling period costs one bit per point; quantized values are delta encoded
+TIMESTAMP_CLASSES = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12), (0b1111, 4, 64))
+VALUE_CLASSES = ((0b10, 2, 7), (0b110, 3, 12), (0b1110, 4, 20), (0b1111, 4, 64))
+
+class BitWriter:
+    """Appends values of any bit width to a byte string"""
+
+    def __init__(self):
+        self._bytes = bytearray()
+        self._acc = 0
+        self._bits = 0
+
+    def write(self, value, width):
+        self._acc = (self._acc << width) | (value & ((1 << width) - 1))
+        self._bits += width
+        while self._bits >= 8:
+            self._bits -= 8
+            self._bytes.append((self._acc >> self._bits) & 0xFF)
+        self._acc &= (1 << self._bits) - 1
+
+    def getvalue(self):
+        if self._bits:
+            return bytes(self._bytes) + bytes([(self._acc << (8 - self._bits)) & 0xFF])
+        return bytes(self._bytes)
+
+class BitReader:
+    """Reads values of any bit width back from a byte string"""
+
+    def __init__(self, data, offset=0):
+        self._data = data
+        self._pos = offset
+        self._acc = 0
+        self._bits = 0
+
+    def read(self, width):
+        while self._bits < width:
+            if self._pos >= len(self._data):
+                raise ValueError('Truncated series data')
+            self._acc = (self._acc << 8) | self._data[self._pos]
+            self._pos += 1
+            self._bits += 8
+        self._bits -= width
+        value = self._acc >> self._bits
+        self._acc &= (1 << self._bits) - 1
+        return value
+
+def _signed(value, width):
+    """Interpret the low width bits of value as two's complement"""
+    return value - (1 << width) if value >> (width - 1) else value
+
+def _write_varying(writer, value, classes):
+    if value == 0:
+        writer.write(0, 1)
+        return
+    for prefix, prefix_bits, bits in classes:
+        if -(1 << (bits - 1)) <= value < (1 << (bits - 1)):
+            writer.write(prefix, prefix_bits)
+            writer.write(value, bits)
+            return
+    raise ValueError(f'{value} does not fit in 64 bits')
+
+def _read_varying(reader, classes):
+    if not reader.read(1):
+        return 0
+    for _, prefix_bits, bits in classes[:-1]:
+        if not reader.read(1):
+            return _signed(reader.read(bits), bits)
+    return _signed(reader.read(classes[-1][2]), classes[-1][2])
+
+def _float_bits(value):
+    return struct.unpack('>Q', struct.pack('>d', value))[0]
+
+def _bits_float(bits):
+    return struct.unpack('>d', struct.pack('>Q', bits))[0]
+
+def _precision(values):
+    """Get the fewest decimal places that represent every value exactly, or None"""
+    for precision in range(MAX_PRECISION + 1):
+        scale = 10 ** precision
+        try:
+            if all(round(v * scale) / scale == v and abs(v * scale) < 2 ** 62 for v in values):
+                return precision
+        except (OverflowError, ValueError):
+            # inf or nan
+            return None
+    return None
+
+def encode(points):
+    """Encode (timestamp, value) points into bytes
+
+    Timestamps are whole seconds; points keep their order, which should
+    be by timestamp for good compression.
+    """
+    if not points:
+        raise ValueError('Nothing to encode')
+    timestamps = [int(t) for t, _ in points]
+    values = [float(v) for _, v in points]
+
+    precision = _precision(values)
+    encoding = XOR if precision is None else QUANTIZED
+    writer = BitWriter()
+
+    previous, previous_delta = timestamps[0], 0
+    for timestamp in timestamps[1:]:
+        delta = timestamp - previous
+        _write_varying(writer, delta - previous_delta, TIMESTAMP_CLASSES)
+        previous, previous_delta = timestamp, delta
+
+    if encoding == QUANTIZED:
+        scale = 10 ** precision
+        previous = round(values[0] * scale)
+        writer.write(previous, 64)
+        for value in values[1:]:
+            quantized = round(value * scale)
+            _write_varying(writer, quantized - previous, VALUE_CLASSES)
+            previous = quantized
+    else:
+        previous = _float_bits(values[0])
+        writer.write(previous, 64)
+        leading = trailing = None
+        for value in values[1:]:
+            bits = _float_bits(value)
+            xor = bits ^ previous
+            previous = bits
+            if xor == 0:
+                writer.write(0, 1)
+                continue
+            new_leading = min(64 - xor.bit_length(), 31)
+            new_trailing = (xor & -xor).bit_length() - 1
+            if leading is not None and new_leading >= leading and new_trailing >= trailing:
+                # Fits the previous window of meaningful bits
+                writer.write(0b10, 2)
+                writer.write(xor >> trailing, 64 - leading - trailing)
+            else:
+                leading, trailing = new_leading, new_trailing
+                meaningful = 64 - leading - trailing
+                writer.write(0b11, 2)
+                writer.write(leading, 5)
+                writer.write(meaningful - 1, 6)
+                writer.write(xor >> trailing, meaningful)
+
+    return HEADER.pack(encoding, precision or 0, len(points), timestamps[0]) + writer.getvalue()
+
+def decode(data):
+    """Decode bytes from encode back into a list of (timestamp, value) points"""
+    encoding, precision, count, first = HEADER.unpack_from(data)
+    reader = BitReader(data, HEADER.size)
+
+    timestamps = [first]
+    previous, delta = first, 0
+    for _ in range(count - 1):
+        delta += _read_varying(reader, TIMESTAMP_CLASSES)
+        previous += delta
+        timestamps.append(previous)
+
+    values = []
+    if encoding == QUANTIZED:
+        scale = 10 ** precision
+        quantized = _signed(reader.read(64), 64)
+        values.append(quantized / scale)
+        for _ in range(count - 1):
+            quantized += _read_varying(reader, VALUE_CLASSES)
+            values.append(quantized / scale)
+    elif encoding == XOR:
+        bits = reader.read(64)
+        values.append(_bits_float(bits))
+        leading = trailing = 0
+        for _ in range(count - 1):
+            if reader.read(1):
+                if reader.read(1):
+                    leading = reader.read(5)
+                    trailing = 64 - leading - (reader.read(6) + 1)
+                bits ^= reader.read(64 - leading - trailing) << trailing
+            values.append(_bits_float(bits))
+    else:
+        raise ValueError(f'Unknown series encoding {encoding}')
+
+    return list(zip(timestamps, values))
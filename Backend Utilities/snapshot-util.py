@@ -0,0 +1,67 @@
+# File: utils/snapshot.py - Immutable, versioned snapshots of the latest sensor data
+
+import os
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+# A snapshot older than this many seconds is reported as stale
+DEFAULT_MAX_AGE = 60
+
+class Snapshot(namedtuple('Snapshot', ['version', 'timestamp', 'data', 'etag'])):
+    """One published state of the sensor data
+
+    data is a read-only mapping. version only changes when the data does,
+    so etag stays valid across republishes of identical readings.
+    """
+
+    __slots__ = ()
+
+    def age(self, now=None):
+        """Get the seconds since the snapshot was published"""
+        if self.timestamp is None:
+            return None
+        return (now if now is not None else time.time()) - self.timestamp
+
+    def is_stale(self, max_age=DEFAULT_MAX_AGE, now=None):
+        """Check whether the snapshot is missing or older than max_age"""
+        age = self.age(now)
+        return age is None or age > max_age
+
+class SnapshotStore:
+    """Holds the current snapshot for lock-free readers
+
+    The control loop publishes a new snapshot each tick; readers take
+    `current`, a single reference read, and get a consistent view that no
+    later publish can change.
+    """
+
+    def __init__(self, max_age=DEFAULT_MAX_AGE):
+        self.max_age = max_age
+        # Tags from before a restart never match the new process's versions
+        self._instance = os.urandom(4).hex()
+        self._publish_lock = threading.Lock()
+        self._current = self._make(0, None, {})
+
+    @property
+    def current(self):
+        """Get the latest snapshot"""
+        return self._current
+
+    def _make(self, version, timestamp, data):
+        return Snapshot(version, timestamp, MappingProxyType(dict(data)),
+                        f'{self._instance}-{version}')
+
+    def publish(self, data, timestamp=None):
+        """Publish new sensor data, bumping the version if it changed"""
+        timestamp = timestamp if timestamp is not None else time.time()
+        with self._publish_lock:
+            current = self._current
+            version = current.version if dict(current.data) == data else current.version + 1
+            self._current = self._make(version, timestamp, data)
+            return self._current
+
+    def is_stale(self, now=None):
+        """Check whether the current snapshot is stale"""
+        return self._current.is_stale(self.max_age, now)
@@ -0,0 +1,109 @@
+# File: utils/startup.py - Deferred construction and startup progress for readiness checks
+
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+class Lazy:
+    """Stands in for an object that is only built on first use
+
+    Attribute access builds the object with factory() and forwards to it,
+    so module-level controllers can be referenced before the hardware has
+    been probed. A failed build is retried on the next access.
+    """
+
+    def __init__(self, name, factory):
+        self._lazy_name = name
+        self._lazy_factory = factory
+        self._lazy_target = None
+        self._lazy_seconds = None
+        self._lazy_lock = threading.Lock()
+
+    def _lazy_get(self):
+        target = self._lazy_target
+        if target is not None:
+            return target
+        with self._lazy_lock:
+            if self._lazy_target is None:
+                start = time.monotonic()
+                self._lazy_target = self._lazy_factory()
+                self._lazy_seconds = time.monotonic() - start
+                logger.info(f'Built {self._lazy_name} in {self._lazy_seconds:.3f}s')
+            return self._lazy_target
+
+    def __getattr__(self, name):
+        # Only called for attributes the proxy doesn't have itself
+        if name.startswith('_lazy_'):
+            raise AttributeError(name)
+        return getattr(self._lazy_get(), name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_lazy_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._lazy_get(), name, value)
+
+    def __repr__(self):
+        state = 'built' if self._lazy_target is not None else 'not built'
+        return f'<Lazy {self._lazy_name} ({state})>'
+
+def resolve(obj):
+    """Get the object behind a Lazy, building it if needed; anything else is returned as is"""
+    return obj._lazy_get() if isinstance(obj, Lazy) else obj
+
+def is_built(obj):
+    """Check whether a Lazy has been built; anything else counts as built"""
+    return not isinstance(obj, Lazy) or obj._lazy_target is not None
+
+class StartupTracker:
+    """Records the steps of a startup that runs after the server is listening
+
+    Steps are listed up front so a readiness check can report what is
+    still to come, not only what has started.
+    """
+
+    def __init__(self, steps=()):
+        self.started_at = time.time()
+        self._steps = {name: {'status': PENDING, 'seconds': None, 'error': None} for name in steps}
+        self._lock = threading.Lock()
+
+    def _update(self, name, **values):
+        with self._lock:
+            self._steps.setdefault(name, {'status': PENDING, 'seconds': None, 'error': None}).update(values)
+
+    @contextmanager
+    def step(self, name):
+        """Context manager recording a step's duration and outcome; errors are re-raised"""
+        self._update(name, status=RUNNING, error=None)
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self._update(name, status=FAILED, seconds=time.monotonic() - start, error=str(e))
+            logger.error(f'Startup step {name} failed: {str(e)}')
+            raise
+        self._update(name, status=DONE, seconds=time.monotonic() - start)
+
+    def is_done(self, name=None):
+        """Check whether one step, or every step when name is None, has finished"""
+        with self._lock:
+            if name is not None:
+                return self._steps.get(name, {}).get('status') == DONE
+            return all(step['status'] == DONE for step in self._steps.values())
+
+    def get_status(self):
+        """Get every step's status, duration and error, in order"""
+        with self._lock:
+            return {
+                'started_at': self.started_at,
+                'uptime': time.time() - self.started_at,
+                'steps': {name: dict(step) for name, step in self._steps.items()}
+            }
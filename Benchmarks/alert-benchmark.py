@@ -0,0 +1,120 @@
+# File: benchmarks/alert_benchmark.py - Alert evaluation cost against rule count
+#
+# Compares AlertEngine's indexed evaluation with checking every rule on every
+# tick, for growing numbers of threshold rules spread over zones and sensors.
+# Both evaluators are checked to produce the same alerts.
+#
+# Usage: python3 benchmarks/alert_benchmark.py [--ticks 500] [--zones 20]
+#        [--rules 10,100,1000,5000]
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.alerts import AlertEngine
+
+PARAMETERS = {
+    'temperature': (21.0, 2.0),
+    'humidity': (65.0, 8.0),
+    'ph': (6.0, 0.3),
+    'ec': (1.8, 0.3),
+    'co2': (900.0, 150.0)
+}
+
+class LinearAlertEngine:
+    """Reference evaluator: checks every rule against every tick"""
+
+    def __init__(self, rules):
+        self.rules = [dict(rule, state='idle', since=None) for rule in rules]
+
+    def evaluate(self, readings, timestamp):
+        alerts = []
+        for rule in self.rules:
+            value = readings.get(rule['sensor_id'])
+            if value is None:
+                continue
+            above = rule['condition'] == 'above'
+            beyond = value > rule['threshold'] if above else value < rule['threshold']
+            if rule['state'] == 'active':
+                h = rule.get('hysteresis', 0)
+                if (value < rule['threshold'] - h) if above else (value > rule['threshold'] + h):
+                    rule['state'] = 'idle'
+                    alerts.append(self._alert(rule, 'cleared', value, timestamp))
+            elif not beyond:
+                rule['state'], rule['since'] = 'idle', None
+            else:
+                if rule['state'] == 'idle':
+                    rule['state'], rule['since'] = 'pending', timestamp
+                if timestamp - rule['since'] >= rule.get('min_duration', 0):
+                    rule['state'] = 'active'
+                    alerts.append(self._alert(rule, 'firing', value, timestamp))
+        return alerts
+
+    def _alert(self, rule, state, value, timestamp):
+        return {'rule_id': rule['id'], 'sensor_id': rule['sensor_id'], 'state': state,
+                'threshold': rule['threshold'], 'value': value, 'timestamp': timestamp}
+
+def make_rules(count, zones):
+    """Create count above/below rules spread across zones and parameters"""
+    rules = []
+    for i in range(count):
+        name = random.choice(list(PARAMETERS))
+        mean, spread = PARAMETERS[name]
+        above = i % 2 == 0
+        rules.append({
+            'id': f'rule-{i}',
+            'sensor_id': f'zone{i % zones}.{name}',
+            'condition': 'above' if above else 'below',
+            'threshold': mean + (1 if above else -1) * random.uniform(0.5, 2.5) * spread,
+            'hysteresis': spread * 0.1,
+            'min_duration': random.choice((0, 30, 120))
+        })
+    return rules
+
+def make_ticks(ticks, zones, period=5):
+    """Create random-walk readings for every zone and parameter"""
+    state = {f'zone{z}.{name}': mean for z in range(zones) for name, (mean, _) in PARAMETERS.items()}
+    result = []
+    for t in range(ticks):
+        for sensor_id in state:
+            mean, spread = PARAMETERS[sensor_id.split('.')[1]]
+            state[sensor_id] += random.gauss(0, spread * 0.05) + (mean - state[sensor_id]) * 0.01
+        result.append((t * period, dict(state)))
+    return result
+
+def run(engine, ticks):
+    """Evaluate every tick, returning alerts and microseconds per tick"""
+    alerts = []
+    start = time.perf_counter()
+    for timestamp, readings in ticks:
+        alerts.extend(engine.evaluate(readings, timestamp))
+    return alerts, (time.perf_counter() - start) / len(ticks) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark alert rule evaluation')
+    parser.add_argument('--ticks', type=int, default=500)
+    parser.add_argument('--zones', type=int, default=20)
+    parser.add_argument('--rules', default='10,100,1000,5000', help='comma-separated rule counts')
+    args = parser.parse_args()
+
+    random.seed(1)
+    ticks = make_ticks(args.ticks, args.zones)
+
+    print(f'{args.zones * len(PARAMETERS)} sensors, {args.ticks} ticks')
+    print(f'{"rules":>8}{"linear us/tick":>16}{"indexed us/tick":>17}{"speedup":>9}{"alerts":>8}')
+    for count in [int(c) for c in args.rules.split(',')]:
+        rules = make_rules(count, args.zones)
+        linear_alerts, linear = run(LinearAlertEngine(rules), ticks)
+        indexed_alerts, indexed = run(AlertEngine(rules), ticks)
+
+        indexed_alerts = [(a['rule_id'], a['state']) for a in indexed_alerts]
+        if sorted(indexed_alerts) != sorted((a['rule_id'], a['state']) for a in linear_alerts):
+            print(f'warning: evaluators disagree at {count} rules')
+        print(f'{count:>8}{linear:>16.1f}{indexed:>17.1f}{linear / indexed:>8.1f}x{len(indexed_alerts):>8}')
+
+if __name__ == '__main__':
+    main()
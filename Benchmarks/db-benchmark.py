@@ -0,0 +1,138 @@
+# File: benchmarks/db_benchmark.py - Database throughput benchmark
+#
+# Compares the pooled WAL connection used by Database against the old
+# behaviour of opening a new connection for every call. Inserts are timed
+# until the last one is committed, including the write buffer's final flush.
+#
+# Usage: python3 benchmarks/db_benchmark.py [--readings 2000] [--reads 200]
+
+import argparse
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.database import Database
+
+SENSORS = ['temperature', 'humidity', 'ph', 'ec', 'co2']
+
+class OpenPerCallDatabase:
+    """Minimal copy of the original open-per-call access pattern"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # Reuse the real schema so both runs query identical tables
+        Database(db_path).close()
+        conn = sqlite3.connect(db_path)
+        conn.execute('PRAGMA journal_mode=DELETE')
+        conn.close()
+
+    def save_sensor_reading(self, sensor_id, value):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+        INSERT INTO sensor_readings (timestamp, sensor_id, value)
+        VALUES (?, ?, ?)
+        ''', (int(time.time()), sensor_id, value))
+        conn.commit()
+        conn.close()
+        return True
+
+    def get_recent_sensor_readings(self, sensor_id, hours=24):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        start_time = int(time.time()) - (hours * 3600)
+        cursor.execute('''
+        SELECT timestamp, value FROM sensor_readings
+        WHERE sensor_id = ? AND timestamp > ?
+        ORDER BY timestamp ASC
+        ''', (sensor_id, start_time))
+        results = cursor.fetchall()
+        conn.close()
+        return [(r[0], r[1]) for r in results]
+
+    def flush(self):
+        # Every write is committed as it is made
+        return True
+
+    def close(self):
+        pass
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a list of samples"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+def run_benchmark(db, readings, reads):
+    """Measure insert throughput and read latency, with and without a concurrent writer"""
+    results = {}
+
+    start = time.perf_counter()
+    for i in range(readings):
+        db.save_sensor_reading(SENSORS[i % len(SENSORS)], 20.0 + (i % 100) / 10.0)
+    # Includes writing out the buffered tail, so the rate is of rows committed
+    # to SQLite rather than of rows queued in memory
+    db.flush()
+    elapsed = time.perf_counter() - start
+    results['inserts_per_sec'] = readings / elapsed
+
+    latencies = []
+    for i in range(reads):
+        start = time.perf_counter()
+        db.get_recent_sensor_readings(SENSORS[i % len(SENSORS)], hours=1)
+        latencies.append((time.perf_counter() - start) * 1000)
+    results['read_p50_ms'] = statistics.median(latencies)
+    results['read_p99_ms'] = percentile(latencies, 99)
+
+    # Reads while a writer thread keeps inserting, as the control loop does
+    stop = threading.Event()
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            db.save_sensor_reading(SENSORS[i % len(SENSORS)], 21.0)
+            i += 1
+
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    writer_thread.start()
+    latencies = []
+    for i in range(reads):
+        start = time.perf_counter()
+        db.get_recent_sensor_readings(SENSORS[i % len(SENSORS)], hours=1)
+        latencies.append((time.perf_counter() - start) * 1000)
+    stop.set()
+    writer_thread.join()
+    results['contended_read_p50_ms'] = statistics.median(latencies)
+    results['contended_read_p99_ms'] = percentile(latencies, 99)
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Database connection handling')
+    parser.add_argument('--readings', type=int, default=2000, help='number of inserts')
+    parser.add_argument('--reads', type=int, default=200, help='number of read queries')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        runs = [
+            ('open-per-call', OpenPerCallDatabase(os.path.join(tmp, 'legacy.db'))),
+            ('pooled-wal', Database(os.path.join(tmp, 'pooled.db')))
+        ]
+
+        print(f'{"mode":<16}{"inserts/s":>12}{"read p50":>12}{"read p99":>12}'
+              f'{"busy p50":>12}{"busy p99":>12}')
+        for name, db in runs:
+            r = run_benchmark(db, args.readings, args.reads)
+            db.close()
+            print(f'{name:<16}{r["inserts_per_sec"]:>12.0f}'
+                  f'{r["read_p50_ms"]:>10.2f}ms{r["read_p99_ms"]:>10.2f}ms'
+                  f'{r["contended_read_p50_ms"]:>10.2f}ms{r["contended_read_p99_ms"]:>10.2f}ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,404 @@
+# File: benchmarks/load_test.py - Load test of the app with simulated sensors and clients
+#
+# Runs app.py in-process against a fresh database, with a simulated
+# SensorManager and stub controllers installed in place of the hardware
+# modules, in two phases:
+#
+#   history  writes --days of simulated readings and events through the
+#            app's storage filter, measuring ingest rate and database
+#            growth per simulated day
+#   live     runs the real control loop at --period with --clients Socket.IO
+#            dashboard clients and --pollers REST pollers for --duration
+#            seconds, measuring tick jitter, request latency and memory
+#
+# Requests go through Flask's and Flask-SocketIO's test clients, so latencies
+# are handler time without network overhead. Results are printed and written
+# as JSON to --report, so runs before and after a change can be compared.
+#
+# Usage: python3 benchmarks/load_test.py [--zones 4] [--days 14] [--clients 20]
+#        [--pollers 4] [--duration 30] [--period 0.5] [--report load_test.json]
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PARAMETERS = {
+    'temperature': (21.0, 2.0),
+    'humidity': (65.0, 8.0),
+    'ph': (6.0, 0.3),
+    'ec': (1.8, 0.3),
+    'co2': (900.0, 150.0),
+    'water_flow': (2.0, 0.5)
+}
+
+# Sampling period of the simulated history, in seconds
+HISTORY_PERIOD = 5
+
+class SimulatedZone:
+    """Random-walk readings for every parameter of one growing zone"""
+
+    def __init__(self, name, latency=0.0):
+        self.name = name
+        self.latency = latency
+        self.values = {f'{name}.{p}': mean for p, (mean, _) in PARAMETERS.items()}
+
+    def step(self):
+        for sensor_id in self.values:
+            mean, spread = PARAMETERS[sensor_id.split('.')[1]]
+            self.values[sensor_id] += random.gauss(0, spread * 0.02) + (mean - self.values[sensor_id]) * 0.01
+        return {sensor_id: round(value, 2) for sensor_id, value in self.values.items()}
+
+    def read(self):
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        return self.step()
+
+class SimulatedSensorManager:
+    """Stands in for controllers.sensor_manager.SensorManager"""
+
+    zones = 4
+    latency = 0.0
+    probe_delay = 0.0
+
+    def __init__(self):
+        # Probing real sensors takes a while
+        if self.probe_delay:
+            time.sleep(self.probe_delay)
+        self.sensors = [SimulatedZone(f'zone{i}', self.latency) for i in range(self.zones)]
+
+    def get_sensor_readers(self):
+        return {zone.name: zone.read for zone in self.sensors}
+
+    def read_all_sensors(self):
+        readings = {}
+        for zone in self.sensors:
+            readings.update(zone.read())
+        return readings
+
+class StubController:
+    """Accepts the calls app.py makes on a controller and does nothing"""
+
+    def __init__(self, *args):
+        self.settings = {}
+        self.schedules = []
+
+    def update(self, sensor_data):
+        pass
+
+    def get_settings(self):
+        return self.settings
+
+    def update_settings(self, settings):
+        self.settings = dict(settings)
+
+    def get_schedules(self):
+        return self.schedules
+
+    def update_schedule(self, schedules):
+        self.schedules = schedules
+
+    def manual_control(self, *args):
+        return True
+
+CONTROLLER_MODULES = {
+    'light_controller': 'LightController',
+    'nutrient_controller': 'NutrientController',
+    'environment_controller': 'EnvironmentController',
+    'watering_controller': 'WateringController'
+}
+
+def install_simulated_hardware(zones, latency, probe_delay=0.0):
+    """Register fake controllers.* modules so importing app needs no hardware"""
+    package = types.ModuleType('controllers')
+    package.__path__ = []
+    sys.modules['controllers'] = package
+
+    SimulatedSensorManager.zones = zones
+    SimulatedSensorManager.latency = latency
+    SimulatedSensorManager.probe_delay = probe_delay
+    modules = {'sensor_manager': {'SensorManager': SimulatedSensorManager}}
+    for module_name, class_name in CONTROLLER_MODULES.items():
+        modules[module_name] = {class_name: type(class_name, (StubController,), {})}
+
+    for module_name, attributes in modules.items():
+        module = types.ModuleType(f'controllers.{module_name}')
+        module.__dict__.update(attributes)
+        sys.modules[module.__name__] = module
+        setattr(package, module_name, module)
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a list of samples"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(samples, scale=1000.0):
+    """Summarize a list of durations in seconds as milliseconds"""
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'p50_ms': percentile(samples, 50) * scale,
+        'p99_ms': percentile(samples, 99) * scale,
+        'max_ms': max(samples) * scale,
+        'mean_ms': statistics.mean(samples) * scale
+    }
+
+def memory_usage():
+    """Get current and peak resident set size in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        current = peak
+    return {'rss_bytes': current, 'peak_rss_bytes': peak}
+
+def database_files_size(path):
+    """Get the size of the database file plus its WAL"""
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+def count_rows(db, table):
+    with db._connection() as conn:
+        return conn.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+
+def run_history(app, days, end):
+    """Write days of simulated readings and events ending at end"""
+    db = app.db
+    zones = SimulatedSensorManager().sensors
+    start = end - days * 86400
+    daily = []
+    readings = events = 0
+    ingest_time = 0.0
+
+    for day in range(days):
+        day_start = start + day * 86400
+        began = time.perf_counter()
+        for timestamp in range(day_start, day_start + 86400, HISTORY_PERIOD):
+            fresh = {}
+            for zone in zones:
+                fresh.update(zone.step())
+            readings += len(fresh)
+            points = app.storage_filter.filter(fresh, timestamp)
+            if points:
+                db.save_sensor_readings(points)
+            if timestamp % 3600 == 0:
+                for zone in zones:
+                    db.log_event('watering', {'zone': zone.name, 'duration': 60},
+                                 source='load_test', zone=zone.name, timestamp=timestamp)
+                    events += 1
+        db.flush()
+        ingest_time += time.perf_counter() - began
+        daily.append({
+            'day': day + 1,
+            'stored_readings': count_rows(db, 'sensor_readings'),
+            'db_bytes': database_files_size(db.db_path)
+        })
+        print(f'  day {day + 1:>3}: {daily[-1]["stored_readings"]:>10} rows stored, '
+              f'{daily[-1]["db_bytes"] / 1e6:8.1f} MB')
+
+    growth = [b['db_bytes'] - a['db_bytes'] for a, b in zip(daily, daily[1:])]
+    return {
+        'days': days,
+        'readings': readings,
+        'events': events,
+        'readings_per_sec': readings / ingest_time if ingest_time else None,
+        'stored_readings': daily[-1]['stored_readings'] if daily else 0,
+        'db_bytes': daily[-1]['db_bytes'] if daily else 0,
+        'db_bytes_per_day': statistics.mean(growth) if growth else None,
+        'daily': daily
+    }
+
+def poll(client, endpoints, stop, latencies, errors, interval):
+    """Request endpoints in turn until stopped, recording latencies"""
+    while not stop.is_set():
+        for name, method, url, body in endpoints:
+            began = time.perf_counter()
+            response = client.open(url, method=method, json=body)
+            latencies[name].append(time.perf_counter() - began)
+            if response.status_code >= 400:
+                errors[name] += 1
+            response.close()
+            if interval:
+                stop.wait(interval)
+
+def run_live(app, clients, pollers, duration, period, poll_interval):
+    """Run the control loop under dashboard and polling load"""
+    db = app.db
+    sensor_ids = list(SimulatedSensorManager().sensors[0].values)
+    endpoints = [
+        ('sensor-data', 'GET', '/api/sensor-data', None),
+        ('events', 'GET', '/api/events?limit=20', None),
+        ('events-search', 'GET', '/api/events?limit=20&q=watering&zone=zone0', None),
+        ('history-1h', 'GET', f'/api/history?sensors={sensor_ids[0]}&hours=1', None),
+        ('history-7d', 'GET', f'/api/history?sensors={",".join(sensor_ids)}&hours=168', None),
+        ('environment-settings', 'GET', '/api/environment-settings', None),
+        ('environment-settings-save', 'POST', '/api/environment-settings', {'humidity_min': 60, 'humidity_max': 70}),
+        ('sampling-settings', 'GET', '/api/sampling-settings', None),
+        ('loop-stats', 'GET', '/api/loop-stats', None),
+        ('metrics', 'GET', '/metrics', None)
+    ]
+
+    # Every sensor and controller at the same period, so jitter is comparable
+    app.initialize_hardware()
+    db.save_sampling_settings({
+        'sensor_periods': {name: period for name in app.control_loop.sensor_readers},
+        'controller_periods': {name: period for name, _ in app.control_loop.controllers}
+    })
+
+    jitter = []
+    tick_times = []
+
+    def record_tick(sensor_data, fresh):
+        jitter.append(app.control_loop.stats['last_jitter'])
+        tick_times.append(sum(v for k, v in app.control_loop.last_timings.items() if k != 'total'))
+
+    app.control_loop.stages.append(('load_test', record_tick))
+
+    rows_before = count_rows(db, 'sensor_readings')
+    bytes_before = database_files_size(db.db_path)
+    ticks_before = app.control_loop.stats['ticks']
+
+    sockets = [app.socketio.test_client(app.app) for _ in range(clients)]
+    app.start_background_tasks()
+
+    stop = threading.Event()
+    latencies = {name: [] for name, *_ in endpoints}
+    errors = {name: 0 for name, *_ in endpoints}
+    threads = [
+        threading.Thread(target=poll, args=(app.app.test_client(), endpoints, stop, latencies, errors, poll_interval),
+                         daemon=True)
+        for _ in range(pollers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    received = [0] * clients
+    received_bytes = [0] * clients
+    peak = memory_usage()
+    began = time.monotonic()
+    while time.monotonic() - began < duration:
+        time.sleep(1)
+        for i, sock in enumerate(sockets):
+            for message in sock.get_received():
+                received[i] += 1
+                received_bytes[i] += len(json.dumps(message['args'], separators=(',', ':')))
+        usage = memory_usage()
+        peak = usage if usage['rss_bytes'] > peak['rss_bytes'] else peak
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - began
+    app.control_loop.stop()
+    db.flush()
+    for sock in sockets:
+        sock.disconnect()
+
+    minutes = elapsed / 60
+    stats = app.control_loop.get_stats()
+    return {
+        'duration': elapsed,
+        'period': period,
+        'ticks': stats['ticks'] - ticks_before,
+        'overruns': stats['overruns'],
+        'skipped_ticks': stats['skipped_ticks'],
+        'jitter': summarize(jitter),
+        'tick_work': summarize(tick_times),
+        'stored_readings_per_sec': (count_rows(db, 'sensor_readings') - rows_before) / elapsed,
+        'db_bytes_growth': database_files_size(db.db_path) - bytes_before,
+        'write_buffer': db.get_write_buffer_stats(),
+        'requests': {
+            name: dict(summarize(samples), errors=errors[name], per_sec=len(samples) / elapsed)
+            for name, samples in latencies.items()
+        },
+        'socket_clients': {
+            'clients': clients,
+            'messages_per_client_minute': statistics.mean(received) / minutes if clients else 0,
+            'bytes_per_client_minute': statistics.mean(received_bytes) / minutes if clients else 0
+        },
+        'broadcast': app.broadcaster.get_stats(),
+        'peak_memory': peak
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the app with simulated sensors and clients')
+    parser.add_argument('--zones', type=int, default=4, help=f'zones of {len(PARAMETERS)} sensors each')
+    parser.add_argument('--latency', type=float, default=0.005, help='simulated sensor read latency (s)')
+    parser.add_argument('--days', type=int, default=14, help='days of history to simulate first')
+    parser.add_argument('--clients', type=int, default=20, help='Socket.IO dashboard clients')
+    parser.add_argument('--pollers', type=int, default=4, help='REST polling threads')
+    parser.add_argument('--poll-interval', type=float, default=0.0, help='pause between requests (s)')
+    parser.add_argument('--duration', type=float, default=30, help='length of the live phase (s)')
+    parser.add_argument('--period', type=float, default=0.5, help='control loop period (s)')
+    parser.add_argument('--workdir', help='directory for the database and log (default: a temp dir)')
+    parser.add_argument('--report', default='load_test_report.json')
+    args = parser.parse_args()
+
+    report_path = os.path.abspath(args.report)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='farm-load-test-')
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    random.seed(1)
+
+    install_simulated_hardware(args.zones, args.latency)
+    memory_before = memory_usage()
+    import app
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = {
+        'config': vars(args),
+        'started_at': time.time(),
+        'workdir': workdir,
+        'sensors': args.zones * len(PARAMETERS),
+        'memory_at_start': memory_before,
+        'memory_after_import': memory_usage()
+    }
+
+    print(f'{report["sensors"]} sensors, database in {workdir}')
+    print(f'history: {args.days} days at {HISTORY_PERIOD}s')
+    report['history'] = run_history(app, args.days, int(time.time()) - 60)
+    report['memory_after_history'] = memory_usage()
+
+    print(f'live: {args.duration:.0f}s, {args.clients} socket clients, {args.pollers} pollers, '
+          f'{args.period}s period')
+    report['live'] = run_live(app, args.clients, args.pollers, args.duration, args.period, args.poll_interval)
+    report['memory_at_end'] = memory_usage()
+
+    history, live = report['history'], report['live']
+    print()
+    print(f'ingest            {history["readings_per_sec"]:>12,.0f} readings/s '
+          f'({history["stored_readings"]:,} stored of {history["readings"]:,})')
+    # Daily growth needs at least two simulated days
+    per_day = history['db_bytes_per_day']
+    print(f'database          {history["db_bytes"] / 1e6:>12.1f} MB '
+          f'({"n/a" if per_day is None else f"{per_day / 1e6:.2f}"} MB/day)')
+    print(f'ticks             {live["ticks"]:>12} ({live["overruns"]} overruns)')
+    print(f'jitter p50/p99    {live["jitter"].get("p50_ms", 0):>9.2f} ms / {live["jitter"].get("p99_ms", 0):.2f} ms')
+    print(f'peak rss          {report["memory_at_end"]["peak_rss_bytes"] / 1e6:>12.1f} MB')
+    print(f'socket clients    {live["socket_clients"]["bytes_per_client_minute"] / 1e3:>12.1f} KB/client/min')
+    print()
+    print(f'{"endpoint":<28}{"req/s":>9}{"p50 ms":>9}{"p99 ms":>9}{"errors":>8}')
+    for name, stats in live['requests'].items():
+        print(f'{name:<28}{stats["per_sec"]:>9.1f}{stats.get("p50_ms", 0):>9.2f}'
+              f'{stats.get("p99_ms", 0):>9.2f}{stats["errors"]:>8}')
+
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nreport written to {report_path}')
+
+if __name__ == '__main__':
+    main()
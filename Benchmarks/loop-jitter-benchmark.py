@@ -0,0 +1,112 @@
+# File: benchmarks/loop_jitter_benchmark.py - Control loop tick jitter benchmark
+#
+# Drives ControlLoop with simulated sensors of configurable latency and
+# compares tick timing against the original serial read-then-sleep loop.
+#
+# Usage: python3 benchmarks/loop_jitter_benchmark.py [--ticks 40] [--period 0.5]
+#        [--latency 0.05] [--slow-latency 0.8] [--sensors 6]
+
+import argparse
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.control_loop import ControlLoop
+
+class SimulatedSensor:
+    """Sensor that takes latency +/- jitter seconds to return a value"""
+
+    def __init__(self, name, latency, jitter=0.0, value=1.0):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.value = value
+
+    def read(self):
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        return self.value
+
+def make_sensors(count, latency, slow_latency):
+    """Create count sensors, the last of which is slow"""
+    sensors = [SimulatedSensor(f'sensor_{i}', latency, latency / 4) for i in range(count - 1)]
+    sensors.append(SimulatedSensor('slow_sensor', slow_latency, slow_latency / 4))
+    return sensors
+
+def serial_loop(sensors, period, ticks):
+    """The original loop: read every sensor in turn, then sleep a fixed period"""
+    starts = []
+    for _ in range(ticks):
+        starts.append(time.monotonic())
+        for sensor in sensors:
+            sensor.read()
+        time.sleep(period)
+    return starts
+
+def control_loop(sensors, period, ticks, timeout):
+    """ControlLoop with concurrent reads and fixed-rate ticks"""
+    starts = []
+    loop = ControlLoop(
+        {s.name: s.read for s in sensors},
+        [],
+        stages=[('record', lambda data, fresh: None)],
+        period=period,
+        default_timeout=timeout
+    )
+    original_tick = loop.tick
+
+    def tick(*args):
+        starts.append(time.monotonic())
+        return original_tick(*args)
+
+    loop.tick = tick
+    loop.start()
+    while len(starts) < ticks:
+        time.sleep(period / 10)
+    loop.stop()
+    return starts[:ticks], loop.get_stats()
+
+def summarize(starts, period):
+    """Summarize interval error and drift of tick start times in milliseconds"""
+    intervals = [b - a for a, b in zip(starts, starts[1:])]
+    errors = sorted(abs(i - period) * 1000 for i in intervals)
+    drift = (starts[-1] - starts[0] - period * (len(starts) - 1)) * 1000
+    return {
+        'p50': statistics.median(errors),
+        'p99': errors[min(len(errors) - 1, int(len(errors) * 0.99))],
+        'max': errors[-1],
+        'drift': drift
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark control loop tick jitter')
+    parser.add_argument('--ticks', type=int, default=40)
+    parser.add_argument('--period', type=float, default=0.5, help='tick period in seconds')
+    parser.add_argument('--sensors', type=int, default=6)
+    parser.add_argument('--latency', type=float, default=0.05, help='typical sensor latency')
+    parser.add_argument('--slow-latency', type=float, default=0.8, help='latency of the slow sensor')
+    parser.add_argument('--timeout', type=float, default=0.2, help='per-sensor deadline')
+    args = parser.parse_args()
+
+    # Missed deadlines are expected here; keep the report readable
+    logging.getLogger('utils.control_loop').setLevel(logging.ERROR)
+
+    sensors = make_sensors(args.sensors, args.latency, args.slow_latency)
+
+    print(f'{"mode":<14}{"err p50":>10}{"err p99":>10}{"err max":>10}{"drift":>12}')
+    serial = summarize(serial_loop(sensors, args.period, args.ticks), args.period)
+    starts, stats = control_loop(sensors, args.period, args.ticks, args.timeout)
+    concurrent = summarize(starts, args.period)
+    for name, r in (('serial', serial), ('control-loop', concurrent)):
+        print(f'{name:<14}{r["p50"]:>8.1f}ms{r["p99"]:>8.1f}ms{r["max"]:>8.1f}ms{r["drift"]:>10.1f}ms')
+
+    print(f'\nsensor timeouts: {stats["sensor_timeouts"]}, overruns: {stats["overruns"]}')
+    print('last tick stages: ' + ', '.join(
+        f'{name}={seconds * 1000:.1f}ms' for name, seconds in stats['last_timings'].items()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+# File: benchmarks/server_benchmark.py - Connections and memory per serving mode
+#
+# Starts the app in a subprocess in each serving mode: 'flask' runs
+# Flask-SocketIO as app.py does, 'asgi' the asyncio mode in asgi_app.py under
+# uvicorn. Against each it measures:
+#
+#   requests     --requests GET /api/sensor-data at --concurrency, recording
+#                latency and the server's peak RSS growth per concurrent request
+#   connections  websocket dashboard clients opened in steps up to
+#                --max-clients, recording server RSS and threads per step and
+#                checking that every client still receives sensor deltas
+#
+# Clients are plain asyncio sockets speaking just enough WebSocket and
+# Engine.IO to stay connected, so one process can hold thousands of them.
+# With --simulate the server runs the load test's simulated sensors and stub
+# controllers, for machines without the farm hardware.
+#
+# Usage: python3 benchmarks/server_benchmark.py [--modes flask,asgi] [--simulate]
+#        [--max-clients 1000] [--requests 2000] [--concurrency 20]
+#        [--report server_benchmark.json]
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+
+SERVERS = {
+    'flask': 'import app\n'
+             'app.start_background_tasks()\n'
+             'app.socketio.run(app.app, host="127.0.0.1", port={port}, use_reloader=False,\n'
+             '                allow_unsafe_werkzeug=True)\n',
+    'asgi': 'import asgi_app, uvicorn\n'
+            'uvicorn.run(asgi_app.asgi, host="127.0.0.1", port={port}, log_level="warning")\n'
+}
+
+SIMULATED_HARDWARE = (
+    f'import sys\n'
+    f'sys.path.insert(0, {BENCHMARKS!r})\n'
+    f'from load_test import install_simulated_hardware\n'
+    f'install_simulated_hardware(4, 0.005)\n'
+)
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a list of samples"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+def process_status(pid):
+    """Get a process's RSS, peak RSS and thread count from /proc"""
+    status = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                status[key] = int(value.split()[0]) * 1024
+            elif key == 'Threads':
+                status[key] = int(value)
+    return {'rss_bytes': status['VmRSS'], 'peak_rss_bytes': status['VmHWM'], 'threads': status['Threads']}
+
+def start_server(mode, port, simulate, workdir):
+    """Start the app in a serving mode and wait until it answers"""
+    code = (SIMULATED_HARDWARE if simulate else '') + SERVERS[mode].format(port=port)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    server = subprocess.Popen([sys.executable, '-c', code], cwd=workdir, env=env, stdout=log, stderr=log)
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'{mode} server exited; see {workdir}/server.log')
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/api/sensor-data', timeout=1).read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f'{mode} server did not start; see {workdir}/server.log')
+
+async def http_get(port, path):
+    """GET path over a fresh connection, returning the status code"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nConnection: close\r\n\r\n'.encode())
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b' ', 2)[1])
+
+async def run_requests(pid, port, count, concurrency):
+    """Send count requests at the given concurrency"""
+    before = process_status(pid)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            began = time.perf_counter()
+            try:
+                if await http_get(port, '/api/sensor-data') != 200:
+                    errors += 1
+            except OSError:
+                errors += 1
+            latencies.append(time.perf_counter() - began)
+
+    began = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(count)))
+    elapsed = time.perf_counter() - began
+    after = process_status(pid)
+    return {
+        'requests': count,
+        'concurrency': concurrency,
+        'errors': errors,
+        'per_sec': count / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_rss_growth_bytes': after['peak_rss_bytes'] - before['rss_bytes'],
+        'bytes_per_concurrent_request': max(0, after['peak_rss_bytes'] - before['rss_bytes']) / concurrency
+    }
+
+class Dashboard:
+    """A websocket Socket.IO client that only counts the messages it gets"""
+
+    def __init__(self, port):
+        self.port = port
+        self.messages = 0
+        self.last_message = None
+        self.closed = False
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.writer.write((
+            f'GET /socket.io/?EIO=4&transport=websocket HTTP/1.1\r\n'
+            f'Host: 127.0.0.1:{self.port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n'
+        ).encode())
+        headers = await self.reader.readuntil(b'\r\n\r\n')
+        if b' 101 ' not in headers.split(b'\r\n', 1)[0]:
+            raise ConnectionError(headers.split(b'\r\n', 1)[0].decode())
+        if not (await self.receive()).startswith('0'):
+            raise ConnectionError('No Engine.IO open packet')
+        self.send('40')
+        while not (await self.receive()).startswith('40'):
+            pass
+
+    def send(self, text, opcode=1):
+        """Send a masked frame, text unless another opcode is given"""
+        payload = text.encode() if isinstance(text, str) else text
+        mask = os.urandom(4)
+        if len(payload) < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | len(payload))
+        else:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, len(payload))
+        self.writer.write(header + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload)))
+
+    async def receive(self):
+        """Read one text frame, answering WebSocket and Engine.IO pings along the way"""
+        while True:
+            first, second = await self.reader.readexactly(2)
+            length = second & 0x7f
+            if length == 126:
+                length, = struct.unpack('!H', await self.reader.readexactly(2))
+            elif length == 127:
+                length, = struct.unpack('!Q', await self.reader.readexactly(8))
+            payload = await self.reader.readexactly(length)
+            opcode = first & 0x0f
+            if opcode == 8:
+                raise ConnectionError('Closed by server')
+            if opcode == 9:
+                self.send(payload, opcode=10)
+                continue
+            if opcode != 1:
+                continue
+            text = payload.decode()
+            if text == '2':
+                self.send('3')
+                continue
+            return text
+
+    async def listen(self):
+        try:
+            while True:
+                text = await self.receive()
+                if text.startswith('42["sensor_delta"'):
+                    self.messages += 1
+                    self.last_message = time.monotonic()
+        except (ConnectionError, asyncio.IncompleteReadError, OSError):
+            self.closed = True
+
+    def close(self):
+        self.writer.close()
+
+async def run_connections(pid, port, max_clients, window):
+    """Open clients in doubling steps, checking each step still gets deltas"""
+    clients = []
+    tasks = []
+    steps = []
+    target = 50
+    while True:
+        target = min(target, max_clients)
+        began = time.perf_counter()
+        failed = 0
+        connect_times = []
+        while len(clients) + failed < target:
+            client = Dashboard(port)
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(client.connect(), 10)
+            except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, OSError):
+                failed += 1
+                continue
+            connect_times.append(time.perf_counter() - started)
+            clients.append(client)
+            tasks.append(asyncio.create_task(client.listen()))
+
+        # Every client should get a sensor delta within the window
+        settle = time.monotonic()
+        await asyncio.sleep(window)
+        live = [c for c in clients if not c.closed]
+        receiving = sum(1 for c in live if c.last_message and c.last_message >= settle)
+        status = process_status(pid)
+        steps.append({
+            'clients': len(live),
+            'failed_connects': failed,
+            'receiving': receiving,
+            'connect_p50_ms': (percentile(connect_times, 50) or 0) * 1000,
+            'connect_p99_ms': (percentile(connect_times, 99) or 0) * 1000,
+            'ramp_seconds': time.perf_counter() - began,
+            **status
+        })
+        print(f'  {len(live):>6} clients  {receiving:>6} receiving  {status["rss_bytes"] / 1e6:7.1f} MB  '
+              f'{status["threads"]:>5} threads  connect p99 {steps[-1]["connect_p99_ms"]:.1f} ms')
+        if failed or receiving < len(live) or target >= max_clients:
+            break
+        target *= 2
+
+    for client in clients:
+        client.close()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    healthy = [s for s in steps if not s['failed_connects'] and s['receiving'] == s['clients']]
+    first, last = steps[0], steps[-1]
+    return {
+        'steps': steps,
+        'max_healthy_clients': healthy[-1]['clients'] if healthy else 0,
+        'bytes_per_client': ((last['rss_bytes'] - first['rss_bytes']) / (last['clients'] - first['clients'])
+                             if last['clients'] > first['clients'] else None)
+    }
+
+def benchmark_mode(mode, args, port):
+    workdir = tempfile.mkdtemp(prefix=f'farm-{mode}-')
+    print(f'{mode}: starting in {workdir}')
+    server = start_server(mode, port, args.simulate, workdir)
+    try:
+        # Let the first ticks and writes settle before measuring
+        time.sleep(2)
+        result = {'idle': process_status(server.pid)}
+        result['requests'] = asyncio.run(run_requests(server.pid, port, args.requests, args.concurrency))
+        print(f'  {result["requests"]["per_sec"]:.0f} req/s, p99 {result["requests"]["p99_ms"]:.1f} ms, '
+              f'{result["requests"]["bytes_per_concurrent_request"] / 1e3:.0f} KB per concurrent request')
+        result['connections'] = asyncio.run(run_connections(server.pid, port, args.max_clients, args.window))
+        return result
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare serving modes by connections and memory')
+    parser.add_argument('--modes', default='flask,asgi')
+    parser.add_argument('--simulate', action='store_true', help='run with simulated sensors and controllers')
+    parser.add_argument('--max-clients', type=int, default=1000)
+    parser.add_argument('--window', type=float, default=12, help='seconds each client has to receive a delta')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--port', type=int, default=5077)
+    parser.add_argument('--report', default='server_benchmark.json')
+    args = parser.parse_args()
+
+    # Every client is a socket on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    report = {'config': vars(args), 'modes': {}}
+    for i, mode in enumerate(args.modes.split(',')):
+        report['modes'][mode] = benchmark_mode(mode, args, args.port + i)
+
+    print()
+    print(f'{"mode":<8}{"idle MB":>9}{"req/s":>8}{"p99 ms":>8}{"KB/req":>8}{"clients":>9}{"KB/client":>11}')
+    for mode, result in report['modes'].items():
+        requests, connections = result['requests'], result['connections']
+        per_client = connections['bytes_per_client']
+        print(f'{mode:<8}{result["idle"]["rss_bytes"] / 1e6:>9.1f}{requests["per_sec"]:>8.0f}'
+              f'{requests["p99_ms"]:>8.1f}{requests["bytes_per_concurrent_request"] / 1e3:>8.0f}'
+              f'{connections["max_healthy_clients"]:>9}'
+              f'{(per_client / 1e3 if per_client is not None else float("nan")):>11.1f}')
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nreport written to {args.report}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+# File: benchmarks/startup_benchmark.py - Time from launch to listening and to ready
+#
+# Starts the app in a subprocess --runs times per mode and database state
+# and polls /api/ready, recording:
+#
+#   listening  seconds until the server answers at all (503 while starting)
+#   ready      seconds until /api/ready answers 200: controllers built, the
+#              control loop running and its first readings published
+#
+# Modes: 'flask' starts as app.py does, building the hardware in the
+# background; 'flask-eager' builds it before serving, as app.py used to;
+# 'asgi' is the asyncio mode under uvicorn. Each runs against a 'fresh'
+# database, created and migrated on boot, and an 'existing' one already at
+# the latest schema version. With --simulate the server runs the load
+# test's simulated sensors, with --probe-delay seconds of hardware probing.
+#
+# Usage: python3 benchmarks/startup_benchmark.py [--modes flask,flask-eager,asgi]
+#        [--simulate] [--probe-delay 2] [--runs 5] [--report startup_benchmark.json]
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+
+SERVERS = {
+    'flask': 'import app\n'
+             'app.start_background_tasks_async()\n'
+             'app.socketio.run(app.app, host="127.0.0.1", port={port}, use_reloader=False,\n'
+             '                allow_unsafe_werkzeug=True)\n',
+    'flask-eager': 'import app\n'
+                   'app.start_background_tasks()\n'
+                   'app.socketio.run(app.app, host="127.0.0.1", port={port}, use_reloader=False,\n'
+                   '                allow_unsafe_werkzeug=True)\n',
+    'asgi': 'import asgi_app, uvicorn\n'
+            'uvicorn.run(asgi_app.asgi, host="127.0.0.1", port={port}, log_level="warning")\n'
+}
+
+def simulated_hardware(probe_delay):
+    return (
+        f'import sys\n'
+        f'sys.path.insert(0, {BENCHMARKS!r})\n'
+        f'from load_test import install_simulated_hardware\n'
+        f'install_simulated_hardware(4, 0.005, probe_delay={probe_delay!r})\n'
+    )
+
+def ready_status(port):
+    """Get the status code of /api/ready, or None if nothing is listening yet"""
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/api/ready', timeout=1) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+def time_startup(mode, port, workdir, args):
+    """Launch the server once and time it to listening and to ready"""
+    code = (simulated_hardware(args.probe_delay) if args.simulate else '') + SERVERS[mode].format(port=port)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    log = open(os.path.join(workdir, 'server.log'), 'a')
+
+    began = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-c', code], cwd=workdir, env=env, stdout=log, stderr=log)
+    listening = ready = None
+    try:
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline and ready is None:
+            if server.poll() is not None:
+                raise RuntimeError(f'{mode} server exited; see {workdir}/server.log')
+            status = ready_status(port)
+            elapsed = time.perf_counter() - began
+            if status is not None and listening is None:
+                listening = elapsed
+            if status == 200:
+                ready = elapsed
+            else:
+                time.sleep(args.poll_interval)
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+        log.close()
+    return listening, ready
+
+def summarize(samples):
+    """Median, min and max of the runs that got there"""
+    samples = [s for s in samples if s is not None]
+    if not samples:
+        return None
+    return {'median': statistics.median(samples), 'min': min(samples), 'max': max(samples), 'runs': len(samples)}
+
+def benchmark_mode(mode, args, port):
+    """Time --runs startups against a fresh database and against an existing one"""
+    results = {}
+    existing = tempfile.mkdtemp(prefix=f'startup-{mode}-')
+    try:
+        # Creates the database the 'existing' runs start from
+        time_startup(mode, port, existing, args)
+
+        for state in ('fresh', 'existing'):
+            listening, ready = [], []
+            for _ in range(args.runs):
+                workdir = tempfile.mkdtemp(prefix=f'startup-{mode}-') if state == 'fresh' else existing
+                try:
+                    times = time_startup(mode, port, workdir, args)
+                finally:
+                    if state == 'fresh':
+                        shutil.rmtree(workdir, ignore_errors=True)
+                listening.append(times[0])
+                ready.append(times[1])
+                print(f'{mode} {state}: listening {times[0] or float("nan"):.3f}s, '
+                      f'ready {times[1] or float("nan"):.3f}s')
+            results[state] = {'listening': summarize(listening), 'ready': summarize(ready)}
+    finally:
+        shutil.rmtree(existing, ignore_errors=True)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the app from launch to listening and to ready')
+    parser.add_argument('--modes', default='flask,flask-eager,asgi')
+    parser.add_argument('--simulate', action='store_true', help='run with simulated sensors and controllers')
+    parser.add_argument('--probe-delay', type=float, default=2.0, help='simulated hardware probing time (s)')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--poll-interval', type=float, default=0.02)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--port', type=int, default=5078)
+    parser.add_argument('--report', default='startup_benchmark.json')
+    args = parser.parse_args()
+
+    report = {'config': vars(args), 'modes': {}}
+    for i, mode in enumerate(args.modes.split(',')):
+        report['modes'][mode] = benchmark_mode(mode, args, args.port + i)
+
+    print()
+    print(f'{"mode":<13}{"database":<10}{"listening s":>13}{"ready s":>10}')
+    for mode, states in report['modes'].items():
+        for state, result in states.items():
+            listening, ready = result['listening'], result['ready']
+            print(f'{mode:<13}{state:<10}'
+                  f'{(listening["median"] if listening else float("nan")):>13.3f}'
+                  f'{(ready["median"] if ready else float("nan")):>10.3f}')
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nreport written to {args.report}')
+
+if __name__ == '__main__':
+    main()
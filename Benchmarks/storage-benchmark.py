@@ -0,0 +1,153 @@
+# File: benchmarks/storage_benchmark.py - Bytes per reading and query speed, rows vs chunks
+#
+# Writes --days of simulated readings from --zones zones (every reading,
+# every --period seconds, ending now) into a fresh database per storage
+# format, packs the finished hours and VACUUMs, then measures:
+#
+#   bytes/reading  on-disk size of the readings' tables and indexes (from
+#                  the dbstat table when SQLite has it) and of the whole file
+#   queries        get_recent_sensor_readings over 1 and 24 hours, raw
+#                  get_sensor_history over a day and get_sensor_readings_between
+#                  for one sensor over a day, without the in-memory cache
+#
+# Readings are rounded to --precision decimal places as the sensors report
+# them; --precision -1 keeps full floats, which chunks store XOR-encoded.
+#
+# Usage: python3 benchmarks/storage_benchmark.py [--days 3] [--zones 4] [--period 5]
+#        [--precision 2] [--queries 50] [--report storage_benchmark.json]
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import SimulatedZone
+from utils.database import Database
+
+# Tables and indexes holding readings in either format; rollups are the same in both
+READING_TABLES = ('sensor_readings', 'idx_sensor_readings_sensor_time', 'idx_sensor_readings_timestamp',
+                  'sensor_chunks', 'idx_sensor_chunks_hour')
+
+def write_history(db, args, end):
+    """Write every simulated reading for --days up to end, returning the count"""
+    random.seed(1)
+    zones = [SimulatedZone(f'zone{i + 1}') for i in range(args.zones)]
+    readings = 0
+    for timestamp in range(end - args.days * 86400, end, args.period):
+        for zone in zones:
+            zone.step()
+            values = zone.values.items() if args.precision < 0 else \
+                ((sensor_id, round(value, args.precision)) for sensor_id, value in zone.values.items())
+            rows = [(sensor_id, value, timestamp) for sensor_id, value in values]
+            db.save_sensor_readings(rows)
+            readings += len(rows)
+    db.flush()
+    return readings, [sensor_id for zone in zones for sensor_id in zone.values]
+
+def table_bytes(path):
+    """Get the bytes used by the readings' tables and indexes, or None without dbstat"""
+    conn = sqlite3.connect(path)
+    try:
+        sizes = dict(conn.execute(
+            f'SELECT name, sum(pgsize) FROM dbstat WHERE name IN ({",".join("?" * len(READING_TABLES))}) '
+            f'GROUP BY name', READING_TABLES).fetchall())
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+    return sum(sizes.values())
+
+def time_query(query, runs):
+    """Median and max seconds over runs calls, and the size of the result"""
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = query()
+        samples.append(time.perf_counter() - start)
+    return {'median_ms': statistics.median(samples) * 1000, 'max_ms': max(samples) * 1000, 'points': len(result)}
+
+def benchmark_format(storage_format, args, workdir, end):
+    path = os.path.join(workdir, f'{storage_format}.db')
+    db = Database(path, storage_format=storage_format)
+
+    start = time.perf_counter()
+    readings, sensors = write_history(db, args, end)
+    db.compact_sensor_readings()
+    ingest = time.perf_counter() - start
+    db.close()
+
+    conn = sqlite3.connect(path)
+    conn.execute('VACUUM')
+    conn.close()
+
+    db = Database(path)
+    stats = db.get_storage_stats()
+    sensor_id = sensors[0]
+    day_start = end - 86400
+    results = {
+        'readings': readings,
+        'ingest_readings_per_sec': readings / ingest,
+        'table_bytes': table_bytes(path),
+        'file_bytes': os.path.getsize(path),
+        'storage': stats,
+        'queries': {
+            'recent_1h': time_query(lambda: db.get_recent_sensor_readings(sensor_id, hours=1), args.queries),
+            'recent_24h': time_query(lambda: db.get_recent_sensor_readings(sensor_id, hours=24), args.queries),
+            'history_raw_24h': time_query(
+                lambda: db.get_sensor_history(sensor_id, day_start, end, resolution=0)['points'], args.queries),
+            'between_24h': time_query(
+                lambda: db.get_sensor_readings_between(day_start, end, sensor_id=sensor_id), args.queries)
+        }
+    }
+    db.close()
+
+    if results['table_bytes'] is not None:
+        results['table_bytes_per_reading'] = results['table_bytes'] / readings
+    results['file_bytes_per_reading'] = results['file_bytes'] / readings
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare row and chunk storage of sensor readings')
+    parser.add_argument('--days', type=int, default=3)
+    parser.add_argument('--zones', type=int, default=4)
+    parser.add_argument('--period', type=int, default=5, help='seconds between readings')
+    parser.add_argument('--precision', type=int, default=2, help='decimal places, -1 for full floats')
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--formats', default='rows,chunks')
+    parser.add_argument('--report', default='storage_benchmark.json')
+    args = parser.parse_args()
+
+    end = int(time.time())
+    end -= end % args.period
+    report = {'config': vars(args), 'formats': {}}
+    with tempfile.TemporaryDirectory() as workdir:
+        for storage_format in args.formats.split(','):
+            print(f'{storage_format}: writing {args.days} days from {args.zones} zones...')
+            report['formats'][storage_format] = benchmark_format(storage_format, args, workdir, end)
+
+    print()
+    print(f'{"format":<8}{"ingest/s":>10}{"table B/rd":>12}{"file B/rd":>11}'
+          f'{"recent 1h":>11}{"recent 24h":>12}{"raw 24h":>10}{"between":>10}   (median ms)')
+    for storage_format, result in report['formats'].items():
+        queries = result['queries']
+        per_reading = result.get('table_bytes_per_reading')
+        print(f'{storage_format:<8}{result["ingest_readings_per_sec"]:>10.0f}'
+              f'{(per_reading if per_reading is not None else float("nan")):>12.2f}'
+              f'{result["file_bytes_per_reading"]:>11.2f}'
+              f'{queries["recent_1h"]["median_ms"]:>11.2f}{queries["recent_24h"]["median_ms"]:>12.2f}'
+              f'{queries["history_raw_24h"]["median_ms"]:>10.2f}{queries["between_24h"]["median_ms"]:>10.2f}')
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nreport written to {args.report}')
+
+if __name__ == '__main__':
+    main()
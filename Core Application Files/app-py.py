@@ -2,13 +2,13 @@
 #
 # app.py - Flask web server for Vertical Farm Control System
 #
+import atexit
 import os
 import time
 import threading
 import logging
-import flask_login
 import json
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask import Flask, Response, g, render_template, request, jsonify, redirect, url_for, flash
 from flask_socketio import SocketIO
 
 # Import controllers
@@ -17,7 +17,21 @@ from controllers.nutrient_controller import NutrientController
 from controllers.environment_controller import EnvironmentController
 from controllers.watering_controller import WateringController
 from controllers.sensor_manager import SensorManager
+from utils.alerts import AlertEngine
+from utils.broadcast import DeltaBroadcaster
+from utils.command_queue import CommandQueue
+from utils.control_loop import ControlLoop
 from utils.database import Database
+from utils.deadband import DeadbandFilter
+from utils.export import FORMATS, accepts_gzip, encode_rows, iter_gzip
+from utils.metrics import CONTENT_TYPE, REGISTRY, Counter, Gauge, Histogram, collapsed, instrument, sample_stacks, timed
+from utils.profiles import ProfileEngine, compile_profile, validate_profile
+from utils.replication import (AGGREGATOR, NODE, TOKEN_HEADER, ReplicationClient, ReplicationServer,
+                               decode_batch, get_replication_config)
+from utils.retention import RetentionManager
+from utils.ring_buffer import RingBufferStore
+from utils.snapshot import SnapshotStore
+from utils.startup import Lazy, StartupTracker, is_built, resolve
 
 # Set up logging
 logging.basicConfig(
@@ -34,41 +48,403 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'vertical-farm-secret-key'
 app.config['DEBUG'] = True
+# /debug/profile exposes every thread's stacks and ties up a worker for up
+# to two minutes, so it is off unless FARM_PROFILING=1
+app.config['PROFILING_ENABLED'] = os.environ.get('FARM_PROFILING') == '1'
 
 # Initialize Socket.IO
 socketio = SocketIO(app)
 
 # Initialize database
 db = Database()
+atexit.register(db.close)  # Flush buffered sensor readings on shutdown
 
-# Initialize sensor manager and controllers
-sensor_manager = SensorManager()
-light_controller = LightController(db, socketio)
-nutrient_controller = NutrientController(db, socketio, sensor_manager)
-environment_controller = EnvironmentController(db, socketio, sensor_manager)
-watering_controller = WateringController(db, socketio)
+# Prunes, archives and compacts old readings and events in the background
+retention_manager = RetentionManager(db)
 
-# Background task for sensor readings and control logic
-def background_task():
-    while True:
-        try:
-            # Read all sensors
-            sensor_data = sensor_manager.read_all_sensors()
-            
-            # Update controllers with sensor data
-            light_controller.update(sensor_data)
-            nutrient_controller.update(sensor_data)
-            environment_controller.update(sensor_data)
-            watering_controller.update(sensor_data)
-            
-            # Emit updated data to connected clients
-            socketio.emit('sensor_update', sensor_data)
-            
-            # Sleep for 5 seconds
-            time.sleep(5)
-        except Exception as e:
-            logger.error(f"Error in background task: {str(e)}")
-            time.sleep(5)  # Continue after error
+# Sensor manager and controllers. Probing the hardware is slow, so they are
+# built by initialize_hardware() once the server is listening, or by
+# whichever request needs one first
+sensor_manager = Lazy('sensor manager', SensorManager)
+light_controller = Lazy('light controller', lambda: LightController(db, socketio))
+nutrient_controller = Lazy('nutrient controller',
+                           lambda: NutrientController(db, socketio, resolve(sensor_manager)))
+environment_controller = Lazy('environment controller',
+                              lambda: EnvironmentController(db, socketio, resolve(sensor_manager)))
+watering_controller = Lazy('watering controller', lambda: WateringController(db, socketio))
+
+HARDWARE = {
+    'sensor_manager': sensor_manager,
+    'light_controller': light_controller,
+    'nutrient_controller': nutrient_controller,
+    'environment_controller': environment_controller,
+    'watering_controller': watering_controller
+}
+
+# Steps run by start_background_tasks, reported by /api/ready
+startup = StartupTracker(['controllers', 'sensors', 'background_tasks'])
+
+# Timings served at /metrics: every Database method, sensor read, loop
+# stage, Socket.IO emit and HTTP request
+DB_CALL_SECONDS = Histogram('farm_db_call_seconds', 'Duration of Database method calls', ['method'])
+SENSOR_READ_SECONDS = Histogram('farm_sensor_read_seconds', 'Duration of sensor reads', ['sensor'])
+LOOP_STAGE_SECONDS = Histogram('farm_loop_stage_seconds', 'Duration of each control loop stage per tick', ['stage'])
+LOOP_JITTER_SECONDS = Histogram('farm_loop_jitter_seconds', 'Delay between a tick falling due and starting')
+SOCKETIO_EMIT_SECONDS = Histogram('farm_socketio_emit_seconds', 'Duration of Socket.IO emits', ['event'])
+HTTP_REQUEST_SECONDS = Histogram('farm_http_request_seconds', 'Duration of HTTP requests',
+                                 ['endpoint', 'method', 'status'])
+
+instrument(db, DB_CALL_SECONDS)
+
+_socketio_emit = socketio.emit
+
+def timed_emit(event, *args, **kwargs):
+    with SOCKETIO_EMIT_SECONDS.labels(event).time():
+        return _socketio_emit(event, *args, **kwargs)
+
+# Controllers emit through the same object, so their emits are timed too
+socketio.emit = timed_emit
+
+def set_emit_transport(emit):
+    """Send every emit through emit(event, data, to=...) instead of Flask-SocketIO
+
+    Used by the ASGI serving mode, where another Socket.IO server owns the
+    connections.
+    """
+    global _socketio_emit
+    _socketio_emit = emit
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    if 'request_start' in g:
+        HTTP_REQUEST_SECONDS.labels(request.endpoint or 'unknown', request.method, response.status_code).observe(
+            time.perf_counter() - g.request_start)
+    return response
+
+# Push settings changes to connected clients instead of having them poll
+DASHBOARD_SETTINGS = ('light_schedules', 'nutrient_settings', 'environment_settings', 'watering_settings')
+
+def broadcast_setting_change(setting_id, value):
+    socketio.emit('settings_update', {'id': setting_id, 'value': value})
+
+for setting_id in DASHBOARD_SETTINGS:
+    db.subscribe(setting_id, broadcast_setting_change)
+
+# Control loop for sensor readings and control logic
+def get_sensor_readers():
+    """Get per-sensor read callables, falling back to one combined read
+
+    SensorManager has no per-sensor reads, so on real hardware this is the
+    single combined read_all_sensors under the name 'all'.
+    """
+    if hasattr(sensor_manager, 'get_sensor_readers'):
+        readers = sensor_manager.get_sensor_readers()
+    else:
+        readers = {'all': sensor_manager.read_all_sensors}
+    return {name: timed(read, SENSOR_READ_SECONDS.labels(name)) for name, read in readers.items()}
+
+# Only readings that moved outside their deadband (or heartbeats) are
+# stored and broadcast. Broadcasts use plain deadbands since swinging-door
+# points are only known after the fact
+storage_filter = DeadbandFilter(db.get_deadband_settings())
+broadcast_filter = DeadbandFilter(db.get_deadband_settings(), force_mode='deadband')
+
+def apply_deadband_settings(setting_id, value):
+    storage_filter.update_settings(value)
+    broadcast_filter.update_settings(value)
+
+db.subscribe('deadband_settings', apply_deadband_settings)
+
+# Latest sensor data as published by the control loop; request handlers
+# read it instead of polling the hardware themselves
+sensor_snapshot = SnapshotStore()
+
+# Latest readings replicated from other nodes, when this is the aggregator
+remote_sensor_data = {}
+
+def publish_snapshot(sensor_data, fresh):
+    """Publish this tick's merged sensor data for request handlers"""
+    sensor_snapshot.publish(dict(sensor_data, **remote_sensor_data))
+
+# Every reading of the last few hours, kept in memory before deadband
+# filtering. Recent-window queries are answered from here and only fall
+# back to SQLite for older data
+ring_buffer = RingBufferStore()
+db.recent_cache = ring_buffer
+
+def buffer_readings(sensor_data, fresh):
+    """Add this tick's readings to the in-memory ring buffers"""
+    ring_buffer.append(fresh, time.time())
+
+def get_trend(sensor_id, seconds):
+    """Get a sensor's trend in units per minute over the last seconds"""
+    stats = ring_buffer.stats(sensor_id, seconds)
+    return stats['slope'] if stats and stats['count'] > 1 else None
+
+# Threshold and rate-of-change alerts, configured in the 'alert_rules' setting
+alert_engine = AlertEngine(db.get_alert_rules(), rate_source=get_trend)
+db.subscribe('alert_rules', lambda setting_id, value: alert_engine.load_rules(value))
+
+def check_alerts(sensor_data, fresh):
+    """Record and push alerts that fired or cleared on this tick's readings"""
+    for alert in alert_engine.evaluate(fresh, int(time.time())):
+        db.log_event('alert' if alert['state'] == 'firing' else 'alert_cleared', alert,
+                     severity=alert['severity'], source='alerts', zone=alert['zone'])
+        socketio.emit('alert', alert)
+
+def store_readings(sensor_data, fresh):
+    """Queue the readings worth keeping from this tick for a single batched write"""
+    points = storage_filter.filter(fresh, int(time.time()))
+    if points:
+        db.save_sensor_readings(points)
+
+# Clients get a keyframe of all readings, then only the fields that changed
+# since their last message, at most once a second
+broadcaster = DeltaBroadcaster(max_rate=1.0, keyframe_interval=60)
+
+def emit_readings(sensor_data, fresh):
+    """Hand changed readings to the broadcaster"""
+    changed = {sensor_id: value for sensor_id, value, _ in broadcast_filter.filter(fresh, int(time.time()))}
+    broadcaster.update(changed)
+
+def send_sensor_delta(sid, message):
+    socketio.emit('sensor_delta', message, to=sid)
+
+# Multi-node mode, configured by FARM_ROLE, FARM_NODE_ID,
+# FARM_AGGREGATOR_URL, FARM_SPOOL_PATH and FARM_REPLICATION_TOKEN. A node
+# replicates what it writes to the aggregator, which serves every node's
+# readings (as '<node_id>:<sensor_id>') and events from one dashboard
+replication_config = get_replication_config()
+replication_client = None
+replication_server = None
+
+def show_remote_readings(readings):
+    """Feed replicated readings to the live views on the aggregator"""
+    latest = {}
+    for sensor_id, value, timestamp in readings:
+        ring_buffer.append({sensor_id: value}, timestamp)
+        latest[sensor_id] = value
+    remote_sensor_data.update(latest)
+    broadcaster.update(latest)
+    sensor_snapshot.publish(dict(control_loop.sensor_data, **remote_sensor_data))
+
+if replication_config['role'] == NODE:
+    replication_client = ReplicationClient(
+        replication_config['node_id'],
+        replication_config['aggregator_url'],
+        replication_config['spool_path'],
+        replication_config['token']
+    )
+    db.add_write_listener(replication_client.capture)
+    # Runs after the held points below are saved, so they are spooled too
+    atexit.register(replication_client.stop)
+elif replication_config['role'] == AGGREGATOR:
+    replication_server = ReplicationServer(db, replication_config['token'], on_readings=show_remote_readings)
+
+# Registered after db.close so it runs first: keep swinging-door points
+# that were still being held
+atexit.register(lambda: db.save_sensor_readings(storage_filter.pending()))
+
+# Sampling periods in seconds; anything not listed runs every 5 seconds.
+# Overridden by the 'sampling_settings' setting. Sensor periods are keyed
+# by the names get_sensor_readers() returns. SensorManager only reads all
+# sensors at once, under the name 'all', so there are no per-sensor
+# defaults: every sensor is read at the 'all' period
+DEFAULT_SAMPLING_SETTINGS = {
+    'sensor_periods': {},
+    'controller_periods': {
+        'profile': 60,
+        'light': 30,
+        'nutrient': 5,
+        'environment': 15,
+        'watering': 1
+    }
+}
+
+def get_sampling_settings():
+    """Get sampling periods merged over the defaults"""
+    stored = db.get_sampling_settings()
+    return {
+        key: dict(defaults, **stored.get(key, {}))
+        for key, defaults in DEFAULT_SAMPLING_SETTINGS.items()
+    }
+
+# Growing profiles: the running profile's setpoints are merged into the
+# controllers' settings as each stage (or ramp step) comes due
+def apply_profile_setpoints(section, values):
+    """Merge a profile's setpoints for one section into its controller's settings"""
+    if section == 'light':
+        light_controller.update_schedule([dict(schedule, **values) for schedule in light_controller.get_schedules()])
+    elif section == 'nutrient':
+        nutrient_controller.update_settings(dict(nutrient_controller.get_settings(), **values))
+    elif section == 'environment':
+        environment_controller.update_settings(dict(environment_controller.get_settings(), **values))
+    elif section == 'watering':
+        watering_controller.update_settings(dict(watering_controller.get_settings(), **values))
+
+profile_engine = ProfileEngine(db, apply_profile_setpoints)
+
+# Sensor readers are handed over by initialize_hardware(). The profile task
+# runs first, so controllers see a new stage's setpoints on the same tick
+control_loop = ControlLoop(
+    {},
+    [
+        ('profile', profile_engine.update),
+        ('light', lambda sensor_data: light_controller.update(sensor_data)),
+        ('nutrient', lambda sensor_data: nutrient_controller.update(sensor_data)),
+        ('environment', lambda sensor_data: environment_controller.update(sensor_data)),
+        ('watering', lambda sensor_data: watering_controller.update(sensor_data))
+    ],
+    stages=[
+        ('snapshot', publish_snapshot),
+        ('ring_buffer', buffer_readings),
+        ('alerts', check_alerts),
+        ('storage', store_readings),
+        ('broadcast', emit_readings)
+    ],
+    period=5,
+    **get_sampling_settings()
+)
+
+# Reschedule the loop as soon as sampling periods are changed
+db.subscribe('sampling_settings', lambda setting_id, value: control_loop.set_periods(**get_sampling_settings()))
+
+# Manual actuator commands run one at a time on the command queue's worker,
+# never in a request thread. Each is journaled, so queued commands survive
+# a restart
+def run_manual_control(control):
+    """Drive an actuator for a manual control command"""
+    if control['type'] == 'light':
+        success = light_controller.manual_control(control['id'], control['state'])
+        
+    elif control['type'] == 'nutrient':
+        success = nutrient_controller.manual_control(control['pump_id'], control.get('duration', 5))
+        
+    elif control['type'] == 'environment':
+        success = environment_controller.manual_control(control['device_id'], control['state'])
+        
+    elif control['type'] == 'watering':
+        if control['command'] == 'start':
+            success = watering_controller.manual_control(True, control.get('duration'))
+            if not success:
+                return {"status": "error", "message": "Daily watering limit reached"}
+        else:
+            success = watering_controller.manual_control(False)
+    
+    return {"status": "success" if success else "error"}
+
+# Fields each manual control type needs; the first names the actuator
+MANUAL_CONTROL_FIELDS = {
+    'light': ('id', 'state'),
+    'nutrient': ('pump_id',),
+    'environment': ('device_id', 'state'),
+    'watering': ('command',)
+}
+
+def manual_control_target(control):
+    """Name the actuator a command drives, so queued commands for it coalesce"""
+    if control['type'] == 'watering':
+        # Start and stop drive the same valves
+        return 'watering'
+    return f"{control['type']}:{control[MANUAL_CONTROL_FIELDS[control['type']][0]]}"
+
+command_queue = CommandQueue(db, run_manual_control, target=manual_control_target)
+command_queue.add_listener(lambda record: socketio.emit('command_update', record))
+atexit.register(command_queue.stop)
+
+def observe_tick(timings):
+    for stage, seconds in timings.items():
+        LOOP_STAGE_SECONDS.labels(stage).observe(seconds)
+    LOOP_JITTER_SECONDS.observe(control_loop.stats['last_jitter'])
+
+control_loop.add_tick_listener(observe_tick)
+
+# Counts and queue depths kept by the components themselves, read when
+# /metrics is scraped
+for name, documentation, stat in (
+    ('farm_loop_ticks', 'Control loop ticks run', 'ticks'),
+    ('farm_loop_overruns', 'Ticks that ran into the next slot', 'overruns'),
+    ('farm_loop_skipped_ticks', 'Slots skipped after overruns', 'skipped_ticks'),
+    ('farm_sensor_timeouts', 'Sensor reads that missed their deadline', 'sensor_timeouts'),
+    ('farm_sensor_errors', 'Sensor reads that failed', 'sensor_errors')
+):
+    Counter(name, documentation).set_function(lambda stat=stat: control_loop.stats[stat])
+
+Counter('farm_db_rows_flushed', 'Sensor readings written from the write buffer').set_function(
+    lambda: db.get_write_buffer_stats()['flushed'])
+Counter('farm_socketio_bytes_sent', 'Sensor delta bytes sent to dashboard clients').set_function(
+    lambda: broadcaster.get_stats()['bytes_sent'])
+Gauge('farm_db_write_buffer_depth', 'Sensor readings waiting to be written').set_function(
+    lambda: db.get_write_buffer_stats()['depth'])
+Gauge('farm_db_size_bytes', 'Size of the SQLite database').set_function(db.get_database_size)
+Gauge('farm_command_queue_depth', 'Manual control commands waiting to run').set_function(
+    lambda: command_queue.get_stats()['queued'])
+Gauge('farm_socketio_clients', 'Connected dashboard clients').set_function(
+    lambda: broadcaster.get_stats()['connected_clients'])
+Gauge('farm_snapshot_age_seconds', 'Age of the latest sensor snapshot').set_function(
+    lambda: sensor_snapshot.current.age())
+Gauge('farm_alerts_active', 'Alerts currently firing').set_function(lambda: alert_engine.get_stats()['active'])
+if replication_client:
+    Gauge('farm_replication_pending_rows', 'Rows waiting to be replicated').set_function(
+        lambda: replication_client.get_stats()['pending_rows'])
+    Gauge('farm_replication_spooled_batches', 'Replication batches spooled to disk').set_function(
+        lambda: replication_client.get_stats()['spooled_batches'])
+
+hardware_lock = threading.Lock()
+
+def initialize_hardware():
+    """Build the sensor manager and controllers and give the control loop its readers; repeat calls do nothing"""
+    with hardware_lock:
+        if startup.is_done('sensors'):
+            return
+        with startup.step('controllers'):
+            for component in HARDWARE.values():
+                resolve(component)
+        with startup.step('sensors'):
+            control_loop.set_sensor_readers(get_sensor_readers())
+
+def start_background_tasks():
+    """Start the control loop, command, broadcast and replication threads; all ignore repeat starts"""
+    initialize_hardware()
+    with startup.step('background_tasks'):
+        control_loop.start()
+        command_queue.start()
+        broadcaster.start(send_sensor_delta)
+        if replication_client:
+            replication_client.start()
+
+startup_thread = None
+startup_thread_lock = threading.Lock()
+
+def start_background_tasks_async():
+    """Run start_background_tasks in its own thread, so the caller isn't held up by the hardware"""
+    global startup_thread
+    with startup_thread_lock:
+        if startup_thread and startup_thread.is_alive():
+            return
+        startup_thread = threading.Thread(target=_run_startup, name='startup', daemon=True)
+        startup_thread.start()
+
+def _run_startup():
+    try:
+        start_background_tasks()
+    except Exception as e:
+        # Reported by /api/ready; the next connecting client retries
+        logger.error(f'Error starting background tasks: {str(e)}')
+
+def get_readiness():
+    """Check whether the controllers are built, the loop is running and it has published readings"""
+    status = startup.get_status()
+    status['hardware'] = {name: is_built(component) for name, component in HARDWARE.items()}
+    status['control_loop_running'] = control_loop.is_running()
+    status['snapshot_version'] = sensor_snapshot.current.version
+    status['ready'] = (startup.is_done() and status['control_loop_running']
+                       and sensor_snapshot.current.timestamp is not None)
+    return status
 
 # Routes for web interface
 @app.route('/')
@@ -114,8 +490,98 @@ def logs():
 # API Routes for AJAX requests
 @app.route('/api/sensor-data', methods=['GET'])
 def get_sensor_data():
-    """Get current sensor data"""
-    return jsonify(sensor_manager.read_all_sensors())
+    """Get current sensor data from the latest control loop snapshot"""
+    snapshot = sensor_snapshot.current
+    response = jsonify(dict(snapshot.data))
+    response.set_etag(snapshot.etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Snapshot-Version'] = str(snapshot.version)
+    response.headers['X-Snapshot-Timestamp'] = str(snapshot.timestamp or '')
+    response.headers['X-Snapshot-Stale'] = str(snapshot.is_stale(sensor_snapshot.max_age)).lower()
+    # Answers If-None-Match with 304 when the readings haven't changed
+    return response.make_conditional(request)
+
+# Sensor history API
+MAX_HISTORY_POINTS = 5000
+
+def parse_history_args():
+    """Read sensors, time range and resolution from the query string
+    
+    sensors may be repeated or comma-separated. The range is start/end in
+    Unix seconds, defaulting to the last `hours` (24) hours.
+    """
+    sensors = [s for value in request.args.getlist('sensors') for s in value.split(',') if s]
+    end = request.args.get('end', type=int) or int(time.time())
+    start = request.args.get('start', type=int)
+    if start is None:
+        start = end - int(request.args.get('hours', 24, type=float) * 3600)
+    resolution = request.args.get('resolution', type=int)
+    return sensors, start, end, resolution
+
+@app.route('/api/history', methods=['GET'])
+def get_history():
+    """Get downsampled history for one or more sensors"""
+    sensors, start, end, resolution = parse_history_args()
+    if not sensors:
+        return jsonify({"status": "error", "message": "No sensors given"}), 400
+    max_points = min(request.args.get('max_points', 500, type=int), MAX_HISTORY_POINTS)
+    
+    try:
+        # Recent windows come from memory, older ones from the rollups; both
+        # pick the same resolution, but raw points and counts from memory are
+        # every sample rather than the stored changes (see RingBufferStore.history)
+        history = {
+            sensor_id: ring_buffer.history(sensor_id, start, end, max_points, resolution)
+            or db.get_sensor_history(sensor_id, start, end, max_points, resolution)
+            for sensor_id in sensors
+        }
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    return jsonify({
+        "start": start,
+        "end": end,
+        "sensors": {
+            sensor_id: {"resolution": h['resolution'], "points": h['points']}
+            for sensor_id, h in history.items()
+        }
+    })
+
+@app.route('/api/sensor-stats', methods=['GET'])
+def get_sensor_stats():
+    """Get min, max, mean and trend per minute over the last N minutes"""
+    minutes = request.args.get('minutes', 10, type=float)
+    sensors = [s for value in request.args.getlist('sensors') for s in value.split(',') if s]
+    return jsonify({
+        sensor_id: ring_buffer.stats(sensor_id, minutes * 60)
+        for sensor_id in sensors or ring_buffer.sensor_ids()
+    })
+
+@app.route('/api/export', methods=['GET'])
+def export_history():
+    """Stream sensor history as NDJSON or CSV, gzip-encoded when accepted"""
+    sensors, start, end, resolution = parse_history_args()
+    fmt = request.args.get('format', 'ndjson')
+    if not sensors or fmt not in FORMATS:
+        return jsonify({"status": "error", "message": "Need sensors and a format of ndjson or csv"}), 400
+    
+    try:
+        rows = db.iter_sensor_history(sensors, start, end, resolution or 0)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    # A database error partway through propagates out of the stream and
+    # aborts the response, so the client sees an incomplete transfer
+    # instead of a short file that looks complete
+    body = encode_rows(rows, fmt)
+    headers = {
+        'Content-Disposition': f'attachment; filename=sensor-history-{start}-{end}.{fmt}',
+        'Vary': 'Accept-Encoding'
+    }
+    if accepts_gzip(request.headers.get('Accept-Encoding')):
+        body = iter_gzip(body)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(body, mimetype=FORMATS[fmt], headers=headers)
 
 # Light control API
 @app.route('/api/light-schedules', methods=['GET'])
@@ -172,76 +638,351 @@ def set_watering_settings():
 # Common manual control API for all systems
 @app.route('/api/manual-control', methods=['POST'])
 def manual_control():
-    """Process manual control commands"""
-    control = request.json
+    """Queue a manual control command, returning its id at once
     
-    try:
-        if control['type'] == 'light':
-            success = light_controller.manual_control(control['id'], control['state'])
-            return jsonify({"status": "success" if success else "error"})
-            
-        elif control['type'] == 'nutrient':
-            success = nutrient_controller.manual_control(control['pump_id'], control.get('duration', 5))
-            return jsonify({"status": "success" if success else "error"})
-            
-        elif control['type'] == 'environment':
-            success = environment_controller.manual_control(control['device_id'], control['state'])
-            return jsonify({"status": "success" if success else "error"})
-            
-        elif control['type'] == 'watering':
-            if control['command'] == 'start':
-                success = watering_controller.manual_control(True, control.get('duration'))
-                if not success:
-                    return jsonify({"status": "error", "message": "Daily watering limit reached"})
-            elif control['command'] == 'stop':
-                success = watering_controller.manual_control(False)
-            return jsonify({"status": "success" if success else "error"})
-        
-        else:
-            return jsonify({"status": "error", "message": "Unknown control type"})
+    An Idempotency-Key header (or idempotency_key field) makes retries
+    safe: a key already seen returns the original command. Follow the
+    command with /api/commands/<command_id> or 'command_update' events.
+    """
+    control = dict(request.json or {})
+    idempotency_key = request.headers.get('Idempotency-Key') or control.pop('idempotency_key', None)
+    
+    fields = MANUAL_CONTROL_FIELDS.get(control.get('type'))
+    if fields is None:
+        return jsonify({"status": "error", "message": "Unknown control type"}), 400
+    missing = [field for field in fields if field not in control]
+    if missing:
+        return jsonify({"status": "error", "message": f"Missing {', '.join(missing)}"}), 400
+    if control['type'] == 'watering' and control['command'] not in ('start', 'stop'):
+        return jsonify({"status": "error", "message": "Unknown watering command"}), 400
     
+    try:
+        record = command_queue.submit(control, idempotency_key)
     except Exception as e:
-        logger.error(f"Error in manual control: {str(e)}")
-        return jsonify({"status": "error", "message": str(e)})
+        logger.error(f"Error queuing manual control: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 503
+    
+    return jsonify({
+        "status": "success",
+        "command_id": record['id'],
+        "command_status": record['status'],
+        "coalesced": record['coalesced']
+    }), 202
+
+# API for following a queued command
+@app.route('/api/commands/<command_id>', methods=['GET'])
+def get_command(command_id):
+    """Get a manual control command's status and result"""
+    record = command_queue.get(command_id)
+    if record is None:
+        return jsonify({"status": "error", "message": "Unknown command"}), 404
+    return jsonify(record)
+
+# Growing profiles API
+@app.route('/api/profiles', methods=['GET'])
+def get_profiles():
+    """List growing profiles by name and metadata, without their stages"""
+    return jsonify(db.get_growing_profiles())
+
+@app.route('/api/profiles', methods=['POST'])
+def save_profile():
+    """Create a growing profile, or update the one whose id is given"""
+    profile = request.json
+    try:
+        validate_profile(profile)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    profile_id = db.save_growing_profile(profile)
+    if not profile_id:
+        return jsonify({"status": "error", "message": "Profile not saved"}), 404 if profile.get('id') else 500
+    profile_engine.profile_saved(profile_id)
+    return jsonify({"status": "success", "id": profile_id})
+
+@app.route('/api/profiles/<int:profile_id>', methods=['GET'])
+def get_profile_detail(profile_id):
+    """Get a growing profile with its stages"""
+    profile = db.get_growing_profile(profile_id)
+    if profile is None:
+        return jsonify({"status": "error", "message": "Unknown profile"}), 404
+    return jsonify(dict(profile, id=profile_id))
+
+@app.route('/api/profiles/<int:profile_id>', methods=['DELETE'])
+def delete_profile(profile_id):
+    """Delete a growing profile, stopping it first if it is running"""
+    if db.get_active_profile().get('profile_id') == profile_id:
+        profile_engine.deactivate()
+    if not db.delete_growing_profile(profile_id):
+        return jsonify({"status": "error", "message": "Unknown profile"}), 404
+    return jsonify({"status": "success"})
+
+@app.route('/api/profiles/<int:profile_id>/timeline', methods=['GET'])
+def get_profile_timeline(profile_id):
+    """Preview the setpoint changes of a profile started at start (default now)"""
+    profile = db.get_growing_profile(profile_id)
+    if profile is None:
+        return jsonify({"status": "error", "message": "Unknown profile"}), 404
+    try:
+        timeline = compile_profile(profile, request.args.get('start', time.time(), type=float), profile_id)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"start": timeline.start, "end": timeline.end, "points": timeline.points})
+
+@app.route('/api/active-profile', methods=['GET'])
+def get_active_profile():
+    """Get the running profile's stage, setpoints and next change"""
+    return jsonify(profile_engine.get_status())
+
+@app.route('/api/active-profile', methods=['POST'])
+def set_active_profile():
+    """Start running a profile, from started_at (epoch seconds) or now"""
+    data = request.json or {}
+    if db.get_growing_profile(data.get('profile_id')) is None:
+        return jsonify({"status": "error", "message": "Unknown profile"}), 404
+    profile_engine.activate(data['profile_id'], data.get('started_at'))
+    status = profile_engine.get_status()
+    if not status['active']:
+        return jsonify({"status": "error", "message": "Profile could not be compiled"}), 400
+    return jsonify(dict(status, status="success"))
+
+@app.route('/api/active-profile', methods=['DELETE'])
+def stop_active_profile():
+    """Stop running a profile; controllers keep their current settings"""
+    profile_engine.deactivate()
+    return jsonify({"status": "success"})
 
 # API for getting recent events
 @app.route('/api/events', methods=['GET'])
 def get_events():
-    """Get recent system events"""
-    event_type = request.args.get('type')
-    limit = request.args.get('limit', 20, type=int)
-    events = db.get_recent_events(event_type, limit)
-    return jsonify(events)
+    """Get a page of system events, newest first
+    
+    Filters: type, severity, source, zone, q (words in the details), start
+    and end. When more events follow, X-Next-Cursor holds the value to pass
+    as cursor for the next page.
+    """
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            timestamp, event_id = cursor.split(':')
+            cursor = (int(timestamp), int(event_id))
+        except ValueError:
+            return jsonify({"status": "error", "message": "Invalid cursor"}), 400
+    
+    events, next_cursor = db.get_events_page(
+        limit=request.args.get('limit', 20, type=int),
+        cursor=cursor,
+        event_type=request.args.get('type'),
+        severity=request.args.get('severity'),
+        source=request.args.get('source'),
+        zone=request.args.get('zone'),
+        search=request.args.get('q'),
+        start=request.args.get('start', type=int),
+        end=request.args.get('end', type=int)
+    )
+    
+    # Events arrive as JSON text from SQLite and are joined without decoding
+    response = Response('[' + ','.join(events) + ']', mimetype='application/json')
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = f'{next_cursor[0]}:{next_cursor[1]}'
+    return response
+
+# Control loop timings, overruns and sensor health
+@app.route('/api/loop-stats', methods=['GET'])
+def get_loop_stats():
+    """Get control loop statistics and per-stage timings of the last tick"""
+    stats = control_loop.get_stats()
+    stats['recording'] = {
+        'storage': storage_filter.get_stats(),
+        'broadcast': broadcast_filter.get_stats()
+    }
+    return jsonify(stats)
+
+# Sampling rate API
+@app.route('/api/sampling-settings', methods=['GET'])
+def get_sampling_settings_api():
+    """Get sensor and controller sampling periods"""
+    return jsonify(get_sampling_settings())
+
+@app.route('/api/sampling-settings', methods=['POST'])
+def set_sampling_settings():
+    """Update sensor and controller sampling periods"""
+    data = request.json
+    db.save_sampling_settings(data)
+    return jsonify({"status": "success"})
+
+# Change-based recording API
+@app.route('/api/deadband-settings', methods=['GET'])
+def get_deadband_settings():
+    """Get per-sensor deadband and heartbeat settings"""
+    return jsonify({
+        'default': storage_filter.default,
+        'sensors': storage_filter.sensors
+    })
+
+@app.route('/api/deadband-settings', methods=['POST'])
+def set_deadband_settings():
+    """Update per-sensor deadband and heartbeat settings"""
+    data = request.json
+    db.save_deadband_settings(data)
+    return jsonify({"status": "success"})
+
+# Data retention API
+@app.route('/api/retention', methods=['GET'])
+def get_retention():
+    """Get retention settings and the result of the last retention pass"""
+    return jsonify({
+        "settings": retention_manager.get_settings(),
+        "last_status": retention_manager.last_status
+    })
+
+@app.route('/api/retention', methods=['POST'])
+def set_retention():
+    """Update retention settings"""
+    data = request.json
+    retention_manager.update_settings(data)
+    return jsonify({"status": "success"})
+
+# Alerting API
+@app.route('/api/alerts', methods=['GET'])
+def get_alerts():
+    """Get the alerts currently firing and engine statistics"""
+    return jsonify({
+        "active": alert_engine.active(),
+        "stats": alert_engine.get_stats()
+    })
+
+@app.route('/api/alert-rules', methods=['GET'])
+def get_alert_rules():
+    """Get alert rules"""
+    return jsonify(db.get_alert_rules())
+
+@app.route('/api/alert-rules', methods=['POST'])
+def set_alert_rules():
+    """Replace the alert rules"""
+    data = request.json
+    db.save_alert_rules(data)
+    return jsonify({"status": "success"})
+
+# Multi-node replication API
+@app.route('/api/replication/ingest', methods=['POST'])
+def replication_ingest():
+    """Apply a batch of readings and events sent by a node"""
+    if replication_server is None:
+        return jsonify({"status": "error", "message": "This node is not an aggregator"}), 404
+    if not replication_server.authorized(request.headers.get(TOKEN_HEADER)):
+        return jsonify({"status": "error", "message": "Invalid replication token"}), 403
+    
+    try:
+        batch = decode_batch(request.get_data(), request.headers.get('Content-Encoding'))
+        ack = replication_server.ingest(batch)
+    except RuntimeError as e:
+        # Nothing was stored; the node keeps the batch and resends it
+        logger.error(f"Error storing replication batch: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 503
+    except (KeyError, TypeError, ValueError, OSError) as e:
+        logger.error(f"Error ingesting replication batch: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "success", "ack": ack})
+
+@app.route('/api/nodes', methods=['GET'])
+def get_nodes():
+    """Get this node's role and the replication status of the farm's nodes"""
+    return jsonify({
+        "role": replication_config['role'],
+        "node_id": replication_config['node_id'],
+        "nodes": replication_server.get_nodes() if replication_server else {},
+        "replication": replication_client.get_stats() if replication_client else None
+    })
+
+# Broadcast traffic API
+@app.route('/api/broadcast-stats', methods=['GET'])
+def get_broadcast_stats():
+    """Get bytes sent per client per minute against sending full updates"""
+    return jsonify(broadcaster.get_stats())
+
+# Readiness API for service managers and load balancers; the server
+# answers before the hardware is up
+@app.route('/api/ready', methods=['GET'])
+def get_ready():
+    """Get startup progress, with 503 until the control loop has published readings"""
+    status = get_readiness()
+    return jsonify(status), 200 if status['ready'] else 503
+
+# Prometheus metrics
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Get all metrics in the Prometheus text format"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+# Sampling profiler
+MAX_PROFILE_SECONDS = 120
+profile_lock = threading.Lock()
+
+@app.route('/debug/profile', methods=['GET'])
+def get_profile():
+    """Sample every thread's stack for N seconds and return collapsed stacks
+    
+    The output feeds flamegraph.pl or speedscope directly. Query
+    parameters: seconds (default 10), interval in milliseconds (default
+    10) and idle=1 to keep threads that were only waiting. Only served
+    when PROFILING_ENABLED is set.
+    """
+    if not app.config['PROFILING_ENABLED']:
+        return jsonify({"status": "error", "message": "Profiling is disabled"}), 404
+    seconds = min(request.args.get('seconds', 10, type=float), MAX_PROFILE_SECONDS)
+    interval = max(request.args.get('interval', 10, type=float), 1) / 1000
+    if not profile_lock.acquire(blocking=False):
+        return jsonify({"status": "error", "message": "A profile is already running"}), 409
+    try:
+        stacks, rounds = sample_stacks(seconds, interval, include_idle=request.args.get('idle') == '1')
+    finally:
+        profile_lock.release()
+    
+    response = Response(collapsed(stacks), mimetype='text/plain')
+    response.headers['X-Profile-Samples'] = str(rounds)
+    response.headers['X-Profile-Interval'] = str(interval)
+    return response
 
 # WebSocket events
+def get_initial_data():
+    """Get the readings and settings a newly connected dashboard starts from"""
+    return {
+        'sensors': dict(sensor_snapshot.current.data),
+        'light_schedules': light_controller.get_schedules(),
+        'nutrient_settings': nutrient_controller.get_settings(),
+        'environment_settings': environment_controller.get_settings(),
+        'watering_settings': watering_controller.get_settings()
+    }
+
 @socketio.on('connect')
 def handle_connect():
-    """Send initial data to client upon connection"""
+    """Register the client for sensor deltas and send it the initial data"""
+    if not startup.is_done():
+        start_background_tasks_async()
+    broadcaster.add_client(request.sid)
     try:
-        socketio.emit('initial_data', {
-            'sensors': sensor_manager.read_all_sensors(),
-            'light_schedules': light_controller.get_schedules(),
-            'nutrient_settings': nutrient_controller.get_settings(),
-            'environment_settings': environment_controller.get_settings(),
-            'watering_settings': watering_controller.get_settings()
-        })
+        socketio.emit('initial_data', get_initial_data(), to=request.sid)
     except Exception as e:
         logger.error(f"Error sending initial data: {str(e)}")
 
-# Start the background task when the application starts
-@socketio.on('connect')
-def start_background_task():
-    """Start the background task if not already running"""
-    global background_thread
-    if not background_thread or not background_thread.is_alive():
-        background_thread = socketio.start_background_task(background_task)
+@socketio.on('disconnect')
+def handle_disconnect():
+    """Stop sending sensor deltas to a client that left"""
+    broadcaster.remove_client(request.sid)
+
+@socketio.on('resync')
+def handle_resync():
+    """Send a keyframe to a client that missed a delta"""
+    broadcaster.request_resync(request.sid)
 
 # Main entry point
 if __name__ == '__main__':
-    # Create a background thread for sensor readings and control logic
-    background_thread = threading.Thread(target=background_task)
-    background_thread.daemon = True
-    background_thread.start()
+    # Build the controllers and start the control loop and broadcast pump
+    # in the background, so the server is listening straight away; a
+    # client connecting later finds them running
+    start_background_tasks_async()
+    
+    retention_manager.start()
     
     # Start the Flask application with Socket.IO
     socketio.run(app, host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,142 @@
+# coding=utf-8
+#
+# asgi_app.py - asyncio serving mode for the Vertical Farm Control System
+#
+# Serves the same routes and Socket.IO events as app.py from one asyncio
+# event loop under uvicorn, without eventlet or gevent:
+#
+#   - python-socketio's AsyncServer owns the websocket connections
+#   - Flask routes run in a small thread pool behind a2wsgi, so SQLite and
+#     controller calls never block the event loop
+#   - the controllers are built in a thread once the server is listening,
+#     then the control loop is scheduled on the event loop exactly once;
+#     its ticks (sensor reads, controllers, storage) run in a thread
+#     executor
+#   - sensor deltas are pumped from the event loop, and emits made from
+#     other threads (alerts, settings, commands, controllers) are handed
+#     to it thread-safely
+#
+# Run with: python3 asgi_app.py [--host 0.0.0.0] [--port 5000]
+# or:       uvicorn asgi_app:asgi --host 0.0.0.0 --port 5000
+# Use a single worker process: each one would drive the hardware.
+#
+import argparse
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import socketio
+import uvicorn
+from a2wsgi import WSGIMiddleware
+
+import app as farm
+
+logger = logging.getLogger(__name__)
+
+# Threads serving Flask requests
+HTTP_WORKERS = 8
+
+sio = socketio.AsyncServer(async_mode='asgi')
+
+# Ticks run one at a time here; the control loop's own pool reads sensors
+tick_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tick')
+
+event_loop = None
+background_tasks = []
+
+def emit_threadsafe(event, data=None, to=None, room=None, namespace=None, skip_sid=None, **kwargs):
+    """Emit through the AsyncServer from any thread, without waiting for delivery"""
+    if event_loop is None:
+        logger.warning(f'Dropping {event} emitted before the server started')
+        return
+    coroutine = sio.emit(event, data, to=to or room, namespace=namespace, skip_sid=skip_sid)
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is event_loop:
+        event_loop.create_task(coroutine)
+    else:
+        asyncio.run_coroutine_threadsafe(coroutine, event_loop)
+
+async def send_sensor_delta(sid, message):
+    with farm.SOCKETIO_EMIT_SECONDS.labels('sensor_delta').time():
+        await sio.emit('sensor_delta', message, to=sid)
+
+async def start_background_work():
+    """Build the controllers off the event loop, then start the control loop and workers"""
+    try:
+        await event_loop.run_in_executor(None, farm.initialize_hardware)
+    except Exception as e:
+        # Reported by /api/ready
+        logger.error(f'Error initializing hardware: {str(e)}')
+        return
+
+    with farm.startup.step('background_tasks'):
+        # run_async returns straight away if the loop is already running, so
+        # there is never more than one
+        background_tasks.append(event_loop.create_task(farm.control_loop.run_async(tick_executor)))
+        background_tasks.append(event_loop.create_task(farm.broadcaster.run_async(send_sensor_delta)))
+
+        # Blocking I/O workers keep their own threads
+        farm.command_queue.start()
+        if farm.replication_client:
+            farm.replication_client.start()
+    logger.info('Control loop and broadcasts running on the event loop')
+
+async def startup():
+    """Route emits through the AsyncServer and start the background work without waiting for the hardware"""
+    global event_loop
+    event_loop = asyncio.get_running_loop()
+    farm.set_emit_transport(emit_threadsafe)
+
+    background_tasks.append(event_loop.create_task(start_background_work()))
+    farm.retention_manager.start()
+
+async def shutdown():
+    """Stop the background work; app.py's exit handlers flush the database"""
+    farm.control_loop.stop()
+    farm.broadcaster.stop()
+    farm.retention_manager.stop()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    # Let a tick that was running finish its writes
+    await event_loop.run_in_executor(None, tick_executor.shutdown)
+
+# Socket.IO events, as in app.py
+@sio.event
+async def connect(sid, environ):
+    """Register the client for sensor deltas and send it the initial data"""
+    farm.broadcaster.add_client(sid)
+    try:
+        data = await asyncio.get_running_loop().run_in_executor(None, farm.get_initial_data)
+        await sio.emit('initial_data', data, to=sid)
+    except Exception as e:
+        logger.error(f'Error sending initial data: {str(e)}')
+
+@sio.event
+async def disconnect(sid):
+    """Stop sending sensor deltas to a client that left"""
+    farm.broadcaster.remove_client(sid)
+
+@sio.event
+async def resync(sid):
+    """Send a keyframe to a client that missed a delta"""
+    farm.broadcaster.request_resync(sid)
+
+asgi = socketio.ASGIApp(
+    sio,
+    other_asgi_app=WSGIMiddleware(farm.app, workers=HTTP_WORKERS),
+    on_startup=startup,
+    on_shutdown=shutdown
+)
+
+# Main entry point
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the farm controller under uvicorn')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+
+    uvicorn.run(asgi, host=args.host, port=args.port, workers=1, log_level='info')
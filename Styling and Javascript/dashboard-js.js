@@ -12,15 +12,26 @@ const phData = [];
 const ecData = [];
 const co2Data = [];
 
+// Chart series by sensor id, preloaded from the server on page load
+const chartSeries = {
+    temperature: tempData,
+    humidity: humidityData,
+    ph: phData,
+    ec: ecData,
+    co2: co2Data
+};
+
 // Initialize dashboard
 document.addEventListener('DOMContentLoaded', function() {
     initCharts();
+    loadChartHistory();
     setupDashboardControls();
     
     // Process initial data if available
     socket.on('initial_data', function(data) {
         if (data.sensors) {
-            updateSensorDisplays(data.sensors);
+            Object.assign(sensorData, data.sensors);
+            updateSensorDisplays(sensorData);
         }
         
         // Update environmental controls
@@ -45,8 +56,22 @@ document.addEventListener('DOMContentLoaded', function() {
     });
     
     // Update charts with new sensor data
-    socket.on('sensor_update', function(data) {
-        updateCharts(data);
+    document.addEventListener('sensordata', function() {
+        updateCharts(sensorData);
+    });
+    
+    // Refresh controls when settings are changed elsewhere
+    socket.on('settings_update', function(data) {
+        const handlers = {
+            light_schedules: updateLightControls,
+            nutrient_settings: updateNutrientControls,
+            environment_settings: updateEnvironmentControls,
+            watering_settings: updateWateringControls
+        };
+        
+        if (handlers[data.id]) {
+            handlers[data.id](data.value);
+        }
     });
 });
 
@@ -223,6 +248,42 @@ function initCharts() {
     });
 }
 
+// Fill the charts with the last hour of history so a reload doesn't start empty
+async function loadChartHistory() {
+    const sensors = Object.keys(chartSeries).join(',');
+    const history = await fetchAPI(`/api/history?sensors=${sensors}&hours=1&max_points=${MAX_DATA_POINTS}`);
+    if (!history) return;
+    
+    // All sensors come back at the same resolution, so their buckets line up
+    const timestamps = [...new Set(
+        Object.values(history.sensors).flatMap(series => series.points.map(point => point[0]))
+    )].sort((a, b) => a - b).slice(-MAX_DATA_POINTS);
+    if (timestamps.length === 0) return;
+    
+    // Readings are only stored when they change, so a value holds until the next one
+    Object.entries(chartSeries).forEach(([sensorId, data]) => {
+        const points = new Map((history.sensors[sensorId] || { points: [] }).points.map(p => [p[0], p[1]]));
+        let last = null;
+        const values = timestamps.map(timestamp => {
+            if (points.has(timestamp)) last = points.get(timestamp);
+            return last;
+        });
+        data.unshift(...values);
+        while (data.length > MAX_DATA_POINTS) data.shift();
+    });
+    
+    chartTimeLabels.unshift(...timestamps.map(timestamp => {
+        const time = new Date(timestamp * 1000);
+        return time.getHours().toString().padStart(2, '0') + ':' +
+               time.getMinutes().toString().padStart(2, '0');
+    }));
+    while (chartTimeLabels.length > MAX_DATA_POINTS) chartTimeLabels.shift();
+    
+    tempHumidityChart.update();
+    phEcChart.update();
+    co2Chart.update();
+}
+
 // Update charts with new data
 function updateCharts(data) {
     // Add current time to labels
@@ -346,7 +407,7 @@ function sendManualControl(type, id, state) {
         data.state = state;
     }
     
-    fetchAPI('/api/manual-control', 'POST', data);
+    return queueCommand(data);
 }
 
 // Send watering command
@@ -360,7 +421,7 @@ function sendWateringCommand(command, duration = null) {
         data.duration = duration;
     }
     
-    fetchAPI('/api/manual-control', 'POST', data);
+    return queueCommand(data);
 }
 
 // Update dashboard sections with settings
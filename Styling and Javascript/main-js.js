@@ -22,10 +22,45 @@ socket.on('disconnect', function() {
     showToast('System disconnected', 'danger');
 });
 
-// Handle sensor updates
-socket.on('sensor_update', function(data) {
-    sensorData = data;
-    updateSensorDisplays(data);
+// Handle sensor updates - the server sends a keyframe with every reading,
+// then deltas with only the readings that changed. Each delta names the
+// message it builds on; if one was missed, ask for a fresh keyframe
+let sensorSeq = null;
+
+socket.on('sensor_delta', function(message) {
+    if (message.type === 'keyframe') {
+        Object.keys(sensorData).forEach(key => delete sensorData[key]);
+        Object.assign(sensorData, message.state);
+    } else if (message.base !== sensorSeq) {
+        sensorSeq = null;
+        socket.emit('resync');
+        return;
+    } else {
+        Object.assign(sensorData, message.changes);
+        message.removed.forEach(key => delete sensorData[key]);
+    }
+    
+    sensorSeq = message.seq;
+    updateSensorDisplays(sensorData);
+    document.dispatchEvent(new CustomEvent('sensordata', { detail: sensorData }));
+});
+
+// Show alerts as they fire and clear
+socket.on('alert', function(alert) {
+    const text = alert.message || `${alert.sensor_id} ${alert.condition.replace('_', ' ')} ${alert.threshold}`;
+    if (alert.state === 'firing') {
+        showToast(`Alert: ${text}`, alert.severity === 'critical' ? 'danger' : 'warning');
+    } else {
+        showToast(`Cleared: ${text}`, 'success');
+    }
+});
+
+// Report manual control commands that didn't complete
+socket.on('command_update', function(record) {
+    if (record.status === 'failed' || record.status === 'expired') {
+        const message = (record.result && record.result.message) || 'Command failed';
+        showToast(`${record.command.type} control: ${message}`, 'danger');
+    }
 });
 
 // Update sensor displays if they exist on the current page
@@ -115,6 +150,51 @@ function updateSensorDisplays(data) {
             }
         }
     }
+    
+    updateNodeDisplays(data);
+}
+
+// On an aggregator, readings replicated from farm nodes arrive keyed
+// '<node_id>:<sensor_id>'; list them by node where the page has a table
+function updateNodeDisplays(data) {
+    const nodesContainer = document.getElementById('node-readings');
+    if (!nodesContainer) return;
+    
+    const nodes = {};
+    Object.entries(data).forEach(([key, value]) => {
+        const separator = key.indexOf(':');
+        if (separator < 0) return;
+        const nodeId = key.slice(0, separator);
+        (nodes[nodeId] = nodes[nodeId] || []).push([key.slice(separator + 1), value]);
+    });
+    
+    // The card stays hidden on standalone controllers and nodes
+    const nodesCard = document.getElementById('node-readings-card');
+    if (nodesCard) {
+        nodesCard.classList.toggle('d-none', Object.keys(nodes).length === 0);
+    }
+    
+    nodesContainer.innerHTML = '';
+    Object.keys(nodes).sort().forEach(nodeId => {
+        nodes[nodeId].sort(([a], [b]) => a.localeCompare(b)).forEach(([sensorId, value], i) => {
+            const row = document.createElement('tr');
+            
+            const nodeCell = document.createElement('td');
+            nodeCell.textContent = i === 0 ? nodeId : '';
+            
+            const sensorCell = document.createElement('td');
+            sensorCell.textContent = sensorId;
+            
+            const valueCell = document.createElement('td');
+            valueCell.textContent = typeof value === 'number' && !Number.isInteger(value)
+                ? value.toFixed(2) : String(value);
+            
+            row.appendChild(nodeCell);
+            row.appendChild(sensorCell);
+            row.appendChild(valueCell);
+            nodesContainer.appendChild(row);
+        });
+    });
 }
 
 // Utility function to format timestamp
@@ -203,6 +283,66 @@ async function fetchAPI(url, method = 'GET', data = null) {
     }
 }
 
+// Queue a manual control command. The idempotency key is made once per
+// click and sent with every retry, so a request that reached the server
+// before the connection dropped isn't queued twice; the command's outcome
+// arrives as a 'command_update' event
+const COMMAND_ATTEMPTS = 3;
+
+async function queueCommand(data) {
+    const command = Object.assign({}, data, {
+        idempotency_key: `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`
+    });
+    
+    for (let attempt = 1; ; attempt++) {
+        let response = null;
+        try {
+            response = await fetch('/api/manual-control', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(command)
+            });
+        } catch (error) {
+            // Network failure; the server may or may not have the command
+        }
+        if (response && response.ok) {
+            return await response.json();
+        }
+        
+        // Errors below 500 are answers about the command itself, so only
+        // server and network errors are retried
+        if ((response && response.status < 500) || attempt >= COMMAND_ATTEMPTS) {
+            const message = response ? `API error: ${response.status}` : 'Network error';
+            console.error('API error:', message);
+            showToast(`API Error: ${message}`, 'danger');
+            return null;
+        }
+        await new Promise(resolve => setTimeout(resolve, 500 * attempt));
+    }
+}
+
+// Fetch one page of events; pass the returned nextCursor to get the next
+// (older) page, until it comes back null
+async function fetchEventsPage(filters = {}, cursor = null) {
+    const params = new URLSearchParams(filters);
+    if (cursor) params.set('cursor', cursor);
+    
+    try {
+        const response = await fetch(`/api/events?${params}`);
+        if (!response.ok) {
+            throw new Error(`API error: ${response.status}`);
+        }
+        return {
+            events: await response.json(),
+            nextCursor: response.headers.get('X-Next-Cursor')
+        };
+    } catch (error) {
+        console.error('API error:', error);
+        showToast(`API Error: ${error.message}`, 'danger');
+        return { events: [], nextCursor: null };
+    }
+}
+
 // Load recent events
 function loadRecentEvents(limit = 5) {
     const eventsContainer = document.getElementById('recent-events');
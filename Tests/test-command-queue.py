@@ -0,0 +1,58 @@
+# File: tests/test_command_queue.py - Command journal pruning
+#
+# Finished commands are kept for JOURNAL_RETENTION so clients can poll
+# them, then pruned while the queue runs, not only when it starts.
+#
+# Usage: python3 -m pytest tests/test_command_queue.py
+
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import command_queue
+from utils.command_queue import JOURNAL_RETENTION, PRUNE_INTERVAL, SUCCEEDED, CommandQueue
+from utils.database import Database
+
+def finished(command_id, updated_at):
+    return {'id': command_id, 'idempotency_key': None, 'target': 'pump', 'command': {'on': True},
+            'status': SUCCEEDED, 'result': {'status': 'success'},
+            'created_at': updated_at, 'updated_at': updated_at}
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.01)
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(str(tmp_path / 'farm.db'))
+    yield database
+    database.close()
+
+def test_finished_commands_are_pruned_while_running(db, monkeypatch):
+    queue = CommandQueue(db, lambda command: {'status': 'success'})
+    queue.start()
+    try:
+        now = time.time()
+        db.save_command(finished('old', now - JOURNAL_RETENTION - 60))
+        db.save_command(finished('recent', now - 60))
+
+        # Pruned at start, so nothing more until PRUNE_INTERVAL has passed
+        queue.submit({'on': True})
+        wait_for(lambda: queue.get_stats()['succeeded'] == 1)
+        assert db.get_command(command_id='old')
+
+        later = now + PRUNE_INTERVAL
+        monkeypatch.setattr(command_queue.time, 'time', lambda: later)
+        queue.submit({'on': False})
+        wait_for(lambda: queue.get_stats()['succeeded'] == 2)
+        wait_for(lambda: db.get_command(command_id='old') is None)
+        assert db.get_command(command_id='recent')
+    finally:
+        queue.stop()
@@ -0,0 +1,50 @@
+# File: tests/test_event_search.py - Searching event details
+#
+# The events page searches details with FTS5 when SQLite has it, or a
+# LIKE substring match otherwise. Either way a blank search matches every
+# event, and the search text is matched as given, never as query syntax.
+#
+# Usage: python3 -m pytest tests/test_event_search.py
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.database import Database
+
+NOW = 1700000000
+NOTES = ['pump at 100% duty', 'pump at 1000 rpm', 'valve_2 opened', 'valve 22 opened']
+
+@pytest.fixture(params=['fts', 'like'])
+def db(request, tmp_path):
+    database = Database(str(tmp_path / 'farm.db'))
+    for i, note in enumerate(NOTES):
+        assert database.log_event('watering', {'note': note}, timestamp=NOW + i)
+    if request.param == 'like':
+        database.has_event_search = False
+    elif not database.has_event_search:
+        pytest.skip('SQLite built without FTS5')
+    yield database
+    database.close()
+
+def notes(db, search):
+    events, _ = db.get_events_page(50, search=search)
+    return sorted(json.loads(event)['details']['note'] for event in events)
+
+@pytest.mark.parametrize('search', ['', '   ', '\t\n'])
+def test_blank_search_matches_everything(db, search):
+    assert notes(db, search) == sorted(NOTES)
+
+def test_search_ignores_surrounding_whitespace(db):
+    assert notes(db, '  opened ') == ['valve 22 opened', 'valve_2 opened']
+
+def test_like_wildcards_are_literal(db):
+    if db.has_event_search:
+        pytest.skip('Full-text search matches words, not substrings')
+    assert notes(db, '100%') == ['pump at 100% duty']
+    assert notes(db, 'valve_2') == ['valve_2 opened']
+    assert notes(db, '%') == ['pump at 100% duty']
@@ -0,0 +1,121 @@
+# File: tests/test_history.py - Sample-and-hold history: rollups, raw windows and export
+#
+# Stored readings are change points (utils/deadband.py): a value holds
+# until the sensor's next reading. Rollup averages must weight each value
+# by how long it held, and raw windows must start with the value in force
+# at their start, whichever storage format holds the readings.
+#
+# Usage: python3 -m pytest tests/test_history.py
+
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.database import MAX_HOLD, Database
+from utils.ring_buffer import RingBufferStore
+
+SENSOR = 'zone1.temperature'
+# An hour boundary a day in the past, so chunks can be packed
+HOUR_START = 1700000000 - 1700000000 % 3600
+
+# 20.0 held for 50 minutes, then 30.0 for 10 minutes, then a reading that
+# ends the hold at the next hour
+READINGS = [(SENSOR, 20.0, HOUR_START), (SENSOR, 30.0, HOUR_START + 3000), (SENSOR, 30.0, HOUR_START + 3600)]
+
+@pytest.fixture(params=['rows', 'chunks'])
+def db(request, tmp_path):
+    database = Database(str(tmp_path / 'farm.db'))
+    database.save_sensor_readings(READINGS)
+    database.flush()
+    if request.param == 'chunks':
+        assert database.set_storage_format('chunks')
+    yield database
+    database.close()
+
+def hourly(db):
+    history = db.get_sensor_history(SENSOR, HOUR_START - 1, HOUR_START + 3599, resolution=3600)
+    return history['points']
+
+def test_rollup_average_is_time_weighted(db):
+    [point] = hourly(db)
+    assert point[0] == HOUR_START
+    # Two of the three points are 30.0, but 20.0 held five times as long
+    assert point[1] == pytest.approx((20.0 * 3000 + 30.0 * 600) / 3600)
+    assert point[2:] == [20.0, 30.0, 2]
+
+def test_rollups_across_batches(tmp_path):
+    db = Database(str(tmp_path / 'farm.db'))
+    for reading in READINGS:
+        db.save_sensor_readings([reading])
+        db.flush()
+    assert hourly(db)[0][1] == pytest.approx((20.0 * 3000 + 30.0 * 600) / 3600)
+    db.close()
+
+def test_rollups_after_reopening(tmp_path):
+    path = str(tmp_path / 'farm.db')
+    db = Database(path)
+    db.save_sensor_readings(READINGS[:2])
+    db.flush()
+    db.close()
+
+    # The reopened database finds the held value in the stored readings
+    db = Database(path)
+    db.save_sensor_readings(READINGS[2:])
+    db.flush()
+    assert hourly(db)[0][1] == pytest.approx((20.0 * 3000 + 30.0 * 600) / 3600)
+    db.close()
+
+def test_value_held_through_empty_buckets(db):
+    # 20.0 holds through minutes with no readings of their own
+    points = db.get_sensor_history(SENSOR, HOUR_START + 60, HOUR_START + 300, resolution=60)['points']
+    assert [p[0] for p in points] == [HOUR_START + 60 * i for i in range(1, 6)]
+    assert all(p[1:4] == [20.0, 20.0, 20.0] and p[4] == 0 for p in points)
+
+def test_long_gap_is_not_held(tmp_path):
+    db = Database(str(tmp_path / 'farm.db'))
+    db.save_sensor_readings([(SENSOR, 20.0, HOUR_START), (SENSOR, 20.0, HOUR_START + 3 * MAX_HOLD)])
+    db.flush()
+    history = db.get_sensor_history(SENSOR, HOUR_START - 1, HOUR_START + 3 * MAX_HOLD, resolution=3600)
+    assert [p[0] for p in history['points']] == [HOUR_START + i * 3600 for i in (0, 3)]
+    db.close()
+
+def test_rebuild_matches_incremental_rollups(db):
+    before = db.get_sensor_history(SENSOR, HOUR_START - 3600, HOUR_START + 7200, resolution=60)['points']
+    assert db.rebuild_rollups()
+    after = db.get_sensor_history(SENSOR, HOUR_START - 3600, HOUR_START + 7200, resolution=60)['points']
+    assert [p[0] for p in after] == [p[0] for p in before]
+    assert [v for p in after for v in p[1:]] == pytest.approx([v for p in before for v in p[1:]])
+
+def test_raw_history_carries_value_at_start(db):
+    points = db.get_sensor_history(SENSOR, HOUR_START + 600, HOUR_START + 3300, resolution=0)['points']
+    assert points == [[HOUR_START + 600, 20.0, 20.0, 20.0, 0], [HOUR_START + 3000, 30.0, 30.0, 30.0, 1]]
+
+def test_raw_history_without_earlier_reading(db):
+    points = db.get_sensor_history(SENSOR, HOUR_START - 600, HOUR_START, resolution=0)['points']
+    assert points == [[HOUR_START, 20.0, 20.0, 20.0, 1]]
+
+def test_export_carries_value_at_start(db):
+    rows = list(db.iter_sensor_history([SENSOR], HOUR_START + 3300, HOUR_START + 3600))
+    assert rows == [(SENSOR, HOUR_START + 3300, 30.0, 30.0, 30.0, 0), (SENSOR, HOUR_START + 3600, 30.0, 30.0, 30.0, 1)]
+
+def test_ring_buffer_raw_history_carries_value_at_start():
+    store = RingBufferStore()
+    for sensor_id, value, timestamp in READINGS:
+        store.append({sensor_id: value}, timestamp)
+    points = store.history(SENSOR, HOUR_START + 600, HOUR_START + 3300, resolution=0)['points']
+    assert points == [[HOUR_START + 600, 20.0, 20.0, 20.0, 0], [HOUR_START + 3000, 30.0, 30.0, 30.0, 1]]
+
+def test_export_error_is_raised(db, monkeypatch):
+    rows = db.iter_sensor_history([SENSOR, 'zone2.temperature'], HOUR_START + 3300, HOUR_START + 3600)
+    assert next(rows)[0] == SENSOR
+
+    # A failure partway must not look like the end of the export
+    def fail(cursor, sensor_id, start):
+        raise sqlite3.OperationalError('disk I/O error')
+    monkeypatch.setattr(db, '_carried_reading', fail)
+    with pytest.raises(sqlite3.OperationalError):
+        list(rows)
@@ -0,0 +1,60 @@
+# File: tests/test_migrations.py - Schema migrations apply all or nothing
+#
+# Each migration runs in one transaction with its schema_version update,
+# so one that fails partway leaves the database at the previous version
+# and the next start applies it again from the beginning.
+#
+# Usage: python3 -m pytest tests/test_migrations.py
+
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import database
+from utils.database import MIGRATIONS, SCHEMA_VERSION, Database
+
+def columns(path, table):
+    conn = sqlite3.connect(path)
+    try:
+        return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    finally:
+        conn.close()
+
+def failing_after(migration):
+    """Wrap a migration so it raises after its statements have run"""
+    def run(cursor):
+        if callable(migration):
+            migration(cursor)
+        else:
+            for statement in migration:
+                cursor.execute(statement)
+        raise RuntimeError('migration failed')
+    return run
+
+@pytest.mark.parametrize('failing_version', [3, 5, 7])
+def test_failed_migration_rolls_back_and_reopens(tmp_path, monkeypatch, failing_version):
+    path = str(tmp_path / 'farm.db')
+    patched = [(version, description, failing_after(migration) if version == failing_version else migration)
+               for version, description, migration in MIGRATIONS]
+    monkeypatch.setattr(database, 'MIGRATIONS', patched)
+    with pytest.raises(RuntimeError):
+        Database(path)
+
+    conn = sqlite3.connect(path)
+    stored = conn.execute("SELECT value FROM settings WHERE id = 'schema_version'").fetchone()
+    conn.close()
+    assert int(stored[0]) == failing_version - 1
+    if failing_version == 3:
+        assert 'severity' not in columns(path, 'events')
+    elif failing_version == 7:
+        assert 'held_sum' not in columns(path, 'sensor_rollups')
+
+    monkeypatch.setattr(database, 'MIGRATIONS', MIGRATIONS)
+    db = Database(path)
+    assert db.get_schema_version() == SCHEMA_VERSION
+    assert db.log_event('watering', {'zone': 'zone1'}, severity='warning')
+    db.close()
@@ -0,0 +1,277 @@
+# File: tests/test_query_plans.py - Query plan assertions for every Database query
+#
+# Each case calls a Database method against a fresh, populated database and
+# records every statement it runs through SQLite's trace callback, with its
+# parameters bound, so SQL assembled at run time (event filters and search,
+# retention selections, chunk reads) is covered as well as the constants in
+# QUERY_PLAN_EXPECTATIONS. Every data statement's EXPLAIN QUERY PLAN must
+# avoid full table scans and temporary sort trees unless the case allows
+# them, and must use the indexes the case names.
+#
+# Usage: python3 -m pytest tests/test_query_plans.py
+
+import os
+import re
+import sqlite3
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.database import Database
+
+NOW = int(time.time())
+HOUR = 3600
+DAY = 86400
+
+TABLES = ('sensor_readings', 'sensor_rollups', 'sensor_chunks', 'events', 'command_journal',
+          'growing_profiles', 'settings')
+
+DATA_STATEMENT = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+
+class TracedDatabase(Database):
+    """Database whose connections record every statement they run"""
+
+    def __init__(self, *args, **kwargs):
+        self.statements = []
+        super().__init__(*args, **kwargs)
+
+    def _create_connection(self):
+        conn = super()._create_connection()
+        conn.set_trace_callback(self.statements.append)
+        return conn
+
+def populate(db):
+    """Two days of readings from two sensors, some events, a command and a profile"""
+    rows = [(sensor_id, 20.0 + i % 50 / 10.0, NOW - 2 * DAY + i * 60)
+            for i in range(2 * DAY // 60) for sensor_id in ('zone1.temperature', 'zone1.humidity')]
+    db.save_sensor_readings(rows)
+    db.flush()
+    for i in range(200):
+        db.log_event('watering' if i % 2 else 'alert', {'zone': 'zone1', 'note': f'event {i}'},
+                     severity='warning' if i % 10 == 0 else 'info', source='test', zone='zone1',
+                     timestamp=NOW - DAY + i * 60)
+    db.save_command({'id': 'c1', 'idempotency_key': 'k1', 'target': 'pump', 'command': {'on': True},
+                     'status': 'queued', 'result': None, 'created_at': NOW, 'updated_at': NOW})
+    db.save_growing_profile({'name': 'Lettuce', 'crop': 'lettuce', 'stages': [{'name': 'Seedling', 'days': 7}]})
+
+@pytest.fixture
+def db(tmp_path):
+    database = TracedDatabase(str(tmp_path / 'farm.db'))
+    populate(database)
+    yield database
+    database.close()
+
+@pytest.fixture
+def chunk_db(tmp_path):
+    database = TracedDatabase(str(tmp_path / 'farm.db'))
+    populate(database)
+    assert database.set_storage_format('chunks')
+    yield database
+    database.close()
+
+def traced_plans(db, call):
+    """Run call(db) and get (sql, plan) for every data statement it ran"""
+    db.invalidate_settings_cache()
+    db.statements.clear()
+    call(db)
+
+    # Explained on a separate connection so the EXPLAINs aren't traced too
+    conn = sqlite3.connect(db.db_path)
+    try:
+        return [(sql, ' | '.join(row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}')))
+                for sql in list(db.statements) if DATA_STATEMENT.match(sql)]
+    finally:
+        conn.close()
+
+def check(db, call, expected=(), scans=(), temp_tree=False):
+    """Assert the plans of everything call(db) runs
+
+    expected lists text that must appear in some statement's plan, scans the
+    tables that may be read in full, and temp_tree whether a temporary
+    B-tree may be used for sorting or grouping.
+    """
+    plans = traced_plans(db, call)
+    assert plans, 'no statements were run'
+    for sql, plan in plans:
+        for table in TABLES:
+            if table not in scans:
+                assert not re.search(rf'\bSCAN {table}\b(?! USING)', plan), f'full scan of {table}: {sql} -> {plan}'
+        if not temp_tree:
+            assert 'TEMP B-TREE' not in plan, f'temporary B-tree: {sql} -> {plan}'
+
+    all_plans = ' || '.join(plan for _, plan in plans)
+    for text in expected:
+        assert text in all_plans, f'expected "{text}" in: {all_plans}'
+
+# (id, call, expected plan text, tables that may be scanned, temp B-tree allowed)
+CASES = [
+    ('get_setting', lambda db: db.get_sampling_settings(),
+     ['USING INDEX sqlite_autoindex_settings_1'], (), False),
+    ('save_setting', lambda db: db.save_sampling_settings({'default': 5}),
+     [], (), False),
+    ('flush', lambda db: (db.save_sensor_readings({'zone1.temperature': 21.5}), db.flush()),
+     [], (), False),
+    ('get_recent_sensor_readings', lambda db: db.get_recent_sensor_readings('zone1.temperature', 1),
+     ['USING COVERING INDEX idx_sensor_readings_sensor_time (sensor_id=? AND timestamp>?)'], (), False),
+    ('get_sensor_history raw',
+     lambda db: db.get_sensor_history('zone1.temperature', NOW - HOUR, NOW, resolution=0),
+     ['USING COVERING INDEX idx_sensor_readings_sensor_time (sensor_id=? AND timestamp<?)',
+      'USING COVERING INDEX idx_sensor_readings_sensor_time (sensor_id=? AND timestamp>? AND timestamp<?)'],
+     (), False),
+    # Buckets are regrouped by an expression, so the grouping sorts the
+    # window's buckets, at most a few times the point budget
+    ('get_sensor_history rollup', lambda db: db.get_sensor_history('zone1.temperature', NOW - 2 * DAY, NOW),
+     ['USING PRIMARY KEY (resolution=? AND sensor_id=? AND bucket>? AND bucket<?)'], (), True),
+    ('iter_sensor_history raw',
+     lambda db: list(db.iter_sensor_history(['zone1.temperature', 'zone1.humidity'], NOW - HOUR, NOW)),
+     ['USING COVERING INDEX idx_sensor_readings_sensor_time'], (), False),
+    ('iter_sensor_history rollup',
+     lambda db: list(db.iter_sensor_history(['zone1.temperature'], NOW - DAY, NOW, resolution=900)),
+     ['USING PRIMARY KEY (resolution=? AND sensor_id=? AND bucket>? AND bucket<?)'], (), True),
+    # Rebuilding reads every reading and rollup by design
+    ('rebuild_rollups', lambda db: db.rebuild_rollups(),
+     [], ('sensor_readings', 'sensor_rollups', 'sensor_chunks'), True),
+    ('rebuild_rollups sensor', lambda db: db.rebuild_rollups('zone1.temperature'),
+     ['USING COVERING INDEX idx_sensor_readings_sensor_time (sensor_id=?'], ('sensor_rollups', 'sensor_chunks'),
+     True),
+    ('log_event', lambda db: db.log_event('watering', {'zone': 'zone1'}),
+     [], (), False),
+    ('apply_replication_batch',
+     lambda db: db.apply_replication_batch([('node1:zone1.temperature', 21.0, NOW)],
+                                           [(NOW, 'watering', '{}', 'info', 'node1', 'zone1')],
+                                           {'node1': {'last_seq': 1}}),
+     [], (), False),
+    ('get_recent_events', lambda db: db.get_recent_events(limit=10),
+     ['USING INDEX idx_events_timestamp'], (), False),
+    ('get_recent_events by type', lambda db: db.get_recent_events('alert', limit=10),
+     ['USING INDEX idx_events_type_time (event_type=?)'], (), False),
+    ('get_events_page', lambda db: db.get_events_page(20),
+     ['USING INDEX idx_events_timestamp'], (), False),
+    ('get_events_page next', lambda db: db.get_events_page(20, cursor=(NOW - HOUR, 100)),
+     ['USING INDEX idx_events_timestamp'], (), False),
+    ('get_events_page by type', lambda db: db.get_events_page(20, event_type='alert'),
+     ['USING INDEX idx_events_type_time (event_type=?'], (), False),
+    ('get_events_page by severity', lambda db: db.get_events_page(20, severity='warning'),
+     ['USING INDEX idx_events_'], (), False),
+    ('get_events_page by source and zone', lambda db: db.get_events_page(20, source='test', zone='zone1'),
+     ['USING INDEX idx_events_timestamp'], (), False),
+    ('get_events_page by type and time', lambda db: db.get_events_page(20, event_type='alert', start=NOW - HOUR),
+     ['USING INDEX idx_events_'], (), False),
+    # Full-text matches come back in rowid order and are sorted by time
+    ('get_events_page search', lambda db: db.get_events_page(20, search='event 10'),
+     ['VIRTUAL TABLE INDEX', 'USING INTEGER PRIMARY KEY (rowid=?)'], (), True),
+    ('get_command', lambda db: db.get_command('c1'),
+     ['USING INDEX sqlite_autoindex_command_journal_1 (id=?)'], (), False),
+    ('get_command by key', lambda db: db.get_command(idempotency_key='k1'),
+     ['USING INDEX sqlite_autoindex_command_journal_2 (idempotency_key=?)'], (), False),
+    ('update_command', lambda db: db.update_command('c1', 'done', {'ok': True}),
+     ['USING INDEX sqlite_autoindex_command_journal_1 (id=?)'], (), False),
+    # The journal only holds a handful of unfinished commands; the two status
+    # ranges are merged with a small sort
+    ('get_unfinished_commands', lambda db: db.get_unfinished_commands(),
+     ['USING INDEX idx_command_journal_status (status=?)'], (), True),
+    ('delete_finished_commands_before', lambda db: db.delete_finished_commands_before(NOW - DAY),
+     [], ('command_journal',), False),
+    ('save_growing_profile', lambda db: db.save_growing_profile(
+        {'id': 1, 'name': 'Lettuce', 'crop': 'lettuce', 'stages': [{'name': 'Seedling', 'days': 10}]}),
+     ['USING INTEGER PRIMARY KEY (rowid=?)'], (), False),
+    ('get_growing_profiles', lambda db: db.get_growing_profiles(),
+     ['USING COVERING INDEX idx_growing_profiles_name'], (), False),
+    ('get_growing_profiles with data', lambda db: db.get_growing_profiles(include_data=True),
+     [], ('growing_profiles',), True),
+    ('get_growing_profile', lambda db: db.get_growing_profile(1),
+     ['USING INTEGER PRIMARY KEY (rowid=?)'], (), False),
+    ('delete_growing_profile', lambda db: db.delete_growing_profile(1),
+     ['USING INTEGER PRIMARY KEY (rowid=?)'], (), False),
+    ('delete_sensor_readings_before', lambda db: db.delete_sensor_readings_before(NOW - DAY),
+     ['USING COVERING INDEX idx_sensor_readings_timestamp (timestamp<?)'], (), False),
+    ('delete_sensor_readings_before sensor',
+     lambda db: db.delete_sensor_readings_before(NOW - DAY, sensor_id='zone1.temperature'),
+     ['USING COVERING INDEX idx_sensor_readings_sensor_time (sensor_id=? AND timestamp<?)'], (), False),
+    ('delete_sensor_readings_before excluding',
+     lambda db: db.delete_sensor_readings_before(NOW - DAY, exclude_sensor_ids=('zone1.humidity',)),
+     ['USING INDEX idx_sensor_readings_timestamp (timestamp<?)'], (), False),
+    ('delete_rollups_before', lambda db: db.delete_rollups_before(60, NOW - DAY),
+     ['USING PRIMARY KEY (resolution=?)'], (), False),
+    ('delete_events_before', lambda db: db.delete_events_before(NOW - HOUR),
+     ['USING COVERING INDEX idx_events_timestamp (timestamp<?)'], (), False),
+    ('get_oldest_timestamp readings', lambda db: db.get_oldest_timestamp('sensor_readings'),
+     ['USING COVERING INDEX idx_sensor_readings_timestamp'], (), False),
+    ('get_oldest_timestamp events', lambda db: db.get_oldest_timestamp('events'),
+     ['USING COVERING INDEX idx_events_timestamp'], (), False),
+    ('get_sensor_readings_between', lambda db: db.get_sensor_readings_between(NOW - DAY, NOW - DAY + HOUR),
+     ['USING INDEX idx_sensor_readings_timestamp (timestamp>? AND timestamp<?)'], (), False),
+    ('get_sensor_readings_between sensor',
+     lambda db: db.get_sensor_readings_between(NOW - DAY, NOW, sensor_id='zone1.temperature'),
+     ['USING COVERING INDEX idx_sensor_readings_sensor_time (sensor_id=? AND timestamp>? AND timestamp<?)'],
+     (), False),
+    ('get_sensor_readings_between excluding',
+     lambda db: db.get_sensor_readings_between(NOW - DAY, NOW, exclude_sensor_ids=('zone1.humidity',)),
+     ['USING INDEX idx_sensor_readings_timestamp (timestamp>? AND timestamp<?)'], (), False),
+    ('get_events_between', lambda db: db.get_events_between(NOW - DAY, NOW),
+     ['USING INDEX idx_events_timestamp (timestamp>? AND timestamp<?)'], (), False),
+    # Counting rows reads every index entry by design
+    ('get_storage_stats', lambda db: db.get_storage_stats(),
+     [], ('sensor_chunks',), False)
+]
+
+CHUNK_CASES = [
+    ('compact_sensor_readings', lambda db: (db.save_sensor_readings([('zone1.temperature', 30.0, NOW - DAY)]),
+                                            db.compact_sensor_readings()),
+     ['USING PRIMARY KEY (sensor_id=? AND hour=?)'], (), False),
+    ('get_recent_sensor_readings', lambda db: db.get_recent_sensor_readings('zone1.temperature', 24),
+     ['USING PRIMARY KEY (sensor_id=? AND hour>? AND hour<?)'], (), False),
+    ('get_sensor_history raw',
+     lambda db: db.get_sensor_history('zone1.temperature', NOW - DAY, NOW, resolution=0),
+     ['USING PRIMARY KEY (sensor_id=? AND hour<?)', 'USING PRIMARY KEY (sensor_id=? AND hour>? AND hour<?)'],
+     (), False),
+    ('iter_sensor_history raw',
+     lambda db: list(db.iter_sensor_history(['zone1.temperature'], NOW - 2 * DAY, NOW)),
+     ['USING PRIMARY KEY (sensor_id=? AND hour>? AND hour<?)'], (), False),
+    ('get_sensor_readings_between', lambda db: db.get_sensor_readings_between(NOW - DAY, NOW),
+     ['USING INDEX idx_sensor_chunks_hour (hour>? AND hour<?)'], (), False),
+    ('get_sensor_readings_between sensor',
+     lambda db: db.get_sensor_readings_between(NOW - DAY, NOW, sensor_id='zone1.temperature'),
+     ['USING PRIMARY KEY (sensor_id=? AND hour>? AND hour<?)'], (), False),
+    ('delete_sensor_readings_before', lambda db: db.delete_sensor_readings_before(NOW - DAY - 1800),
+     ['USING INDEX idx_sensor_chunks_hour (hour<?)'], (), False),
+    ('get_oldest_timestamp', lambda db: db.get_oldest_timestamp('sensor_readings'),
+     ['USING COVERING INDEX idx_sensor_chunks_hour (hour=?)'], (), False),
+    # Converting back reads every chunk by design
+    ('set_storage_format rows', lambda db: db.set_storage_format('rows'),
+     [], ('sensor_chunks',), False)
+]
+
+@pytest.mark.parametrize('call, expected, scans, temp_tree',
+                         [case[1:] for case in CASES], ids=[case[0] for case in CASES])
+def test_row_storage_plans(db, call, expected, scans, temp_tree):
+    check(db, call, expected, scans, temp_tree)
+
+@pytest.mark.parametrize('call, expected, scans, temp_tree',
+                         [case[1:] for case in CHUNK_CASES], ids=[case[0] for case in CHUNK_CASES])
+def test_chunk_storage_plans(chunk_db, call, expected, scans, temp_tree):
+    check(chunk_db, call, expected, scans, temp_tree)
+
+def test_like_search_plan(db):
+    # Without full-text search, search falls back to a substring match
+    # walking the timestamp index
+    db.has_event_search = False
+    check(db, lambda db: db.get_events_page(20, search='event 10'), ['USING INDEX idx_events_timestamp'])
+
+def test_query_plan_expectations(db):
+    assert db.check_query_plans() == []
+
+def test_query_plan_expectations_existing_database(db):
+    # An existing database skips the migration path on open; its plans
+    # must hold all the same
+    db.close()
+    reopened = TracedDatabase(db.db_path)
+    try:
+        assert reopened.check_query_plans() == []
+        check(reopened, lambda db: db.get_recent_sensor_readings('zone1.temperature', 1),
+              ['USING COVERING INDEX idx_sensor_readings_sensor_time'])
+    finally:
+        reopened.close()
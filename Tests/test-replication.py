@@ -0,0 +1,112 @@
+# File: tests/test_replication.py - Replication from nodes to the aggregator
+#
+# An acknowledged batch must be on the aggregator's disk, a batch that
+# failed to store must leave nothing behind, and a node must only treat a
+# batch as delivered when the aggregator's ack covers it.
+#
+# Usage: python3 -m pytest tests/test_replication.py
+
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.database import Database
+from utils.replication import SEQ_STEP, ReplicationClient, ReplicationServer, decode_batch
+
+NOW = 1700000000
+
+def batch(seq, readings=2, events=1):
+    return {
+        'node_id': 'node1',
+        'seq': seq,
+        'sent_at': NOW,
+        'readings': [[NOW + i, 'zone1.temperature', 20.0 + i] for i in range(readings)],
+        'events': [[NOW + i, 'watering', '{"zone": "zone1"}', 'info', 'scheduler', 'zone1'] for i in range(events)]
+    }
+
+def stored(path):
+    """Count readings and events and read the node's last batch with a fresh connection"""
+    conn = sqlite3.connect(path)
+    try:
+        readings = conn.execute("SELECT count(*) FROM sensor_readings WHERE sensor_id LIKE 'node1:%'").fetchone()[0]
+        events = conn.execute("SELECT count(*) FROM events WHERE source LIKE 'node1%'").fetchone()[0]
+        nodes = conn.execute("SELECT value FROM settings WHERE id = 'replication_nodes'").fetchone()
+        return readings, events, nodes[0] if nodes else None
+    finally:
+        conn.close()
+
+def client(spool, server):
+    """A node client whose requests go straight to the server"""
+    node = ReplicationClient('node1', 'http://aggregator', spool_path=spool)
+    node._post = lambda body: (200, server.ingest(decode_batch(body)))
+    return node
+
+@pytest.fixture
+def aggregator(tmp_path):
+    db = Database(str(tmp_path / 'aggregator.db'))
+    yield ReplicationServer(db), str(tmp_path / 'aggregator.db')
+    db.close()
+
+def test_acknowledged_batch_is_on_disk(aggregator):
+    server, path = aggregator
+    assert server.ingest(batch(5)) == 5
+    readings, events, nodes = stored(path)
+    assert (readings, events) == (2, 1)
+    assert '"last_seq": 5' in nodes
+
+def test_replayed_batch_is_not_stored_twice(aggregator):
+    server, path = aggregator
+    server.ingest(batch(5))
+    assert server.ingest(batch(5)) == 5
+    assert stored(path)[:2] == (2, 1)
+
+def test_failed_batch_stores_nothing(aggregator, monkeypatch):
+    server, path = aggregator
+    server.ingest(batch(5))
+
+    # Fail inside the transaction, after the readings were inserted
+    def fail(conn, rows):
+        raise sqlite3.OperationalError('disk I/O error')
+    with monkeypatch.context() as patch:
+        patch.setattr(server.db, '_update_rollups', fail)
+        with pytest.raises(RuntimeError):
+            server.ingest(batch(6))
+    readings, events, nodes = stored(path)
+    assert (readings, events) == (2, 1)
+    assert '"last_seq": 5' in nodes
+
+    # The resent batch is applied in full
+    assert server.ingest(batch(6)) == 6
+    assert stored(path)[:2] == (4, 2)
+
+def test_numbering_survives_restart_with_earlier_clock(aggregator, tmp_path, monkeypatch):
+    server, path = aggregator
+    spool = str(tmp_path / 'spool')
+    node = client(spool, server)
+    node.capture('readings', [[NOW, 'zone1.temperature', 20.0]])
+    assert node.send_pending()
+    sent = server.nodes['node1']['last_seq']
+
+    # The spool is empty and the clock is a day behind
+    monkeypatch.setattr('time.time', lambda: NOW - 86400)
+    node = client(spool, server)
+    node.capture('readings', [[NOW + 1, 'zone1.temperature', 21.0]])
+    assert node.send_pending()
+    assert server.nodes['node1']['last_seq'] == sent + SEQ_STEP
+    assert stored(path)[0] == 2
+
+def test_batch_behind_ack_is_renumbered(aggregator, tmp_path):
+    server, path = aggregator
+    # The aggregator has later batches from an earlier install of the node
+    ahead = 10 ** 18
+    server.ingest(batch(ahead))
+
+    node = client(str(tmp_path / 'spool'), server)
+    node.capture('readings', [[NOW + 5, 'zone1.temperature', 25.0]])
+    assert node.send_pending()
+    assert server.nodes['node1']['last_seq'] == ahead + SEQ_STEP
+    assert stored(path)[0] == 3
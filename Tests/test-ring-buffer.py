@@ -0,0 +1,82 @@
+# File: tests/test_ring_buffer.py - Ring buffer history against the database's
+#
+# /api/history answers recent windows from utils/ring_buffer.py and older
+# ones from the database. The rings hold every reading, before deadband
+# filtering, while the database stores changes and heartbeats, so the two
+# must agree on resolutions and averages but not on raw points or counts.
+#
+# Usage: python3 -m pytest tests/test_ring_buffer.py
+
+import math
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.database import Database
+from utils.deadband import DeadbandFilter
+from utils.ring_buffer import RingBufferStore
+
+SENSOR = 'zone1.temperature'
+START = 1700000000 - 1700000000 % 3600
+PERIOD = 5
+TOLERANCE = 0.1
+
+@pytest.fixture
+def sources(tmp_path):
+    """A ring buffer and a database fed the same two hours of readings, as the app feeds them"""
+    ring_buffer = RingBufferStore()
+    db = Database(str(tmp_path / 'farm.db'))
+    storage_filter = DeadbandFilter({'sensors': {SENSOR: {'absolute': TOLERANCE}}})
+    for timestamp in range(START, START + 2 * 3600 + 1, PERIOD):
+        reading = {SENSOR: round(22.0 + 2.0 * math.sin(timestamp / 900.0), 3)}
+        ring_buffer.append(reading, timestamp)
+        db.save_sensor_readings(storage_filter.filter(reading, timestamp))
+    db.flush()
+    yield ring_buffer, db
+    db.close()
+
+@pytest.mark.parametrize('resolution', [-60, 1, 90, 3601])
+def test_rejects_resolutions_the_database_rejects(sources, resolution):
+    ring_buffer, db = sources
+    with pytest.raises(ValueError):
+        db.get_sensor_history(SENSOR, START, START + 3600, resolution=resolution)
+    with pytest.raises(ValueError):
+        ring_buffer.history(SENSOR, START, START + 3600, resolution=resolution)
+
+@pytest.mark.parametrize('span,max_points', [(1800, 500), (7200, 500), (7200, 50)])
+def test_picks_the_database_resolution(sources, span, max_points):
+    ring_buffer, db = sources
+    end = START + 2 * 3600
+    ring = ring_buffer.history(SENSOR, end - span, end, max_points)
+    stored = db.get_sensor_history(SENSOR, end - span, end, max_points)
+    assert ring['resolution'] == stored['resolution']
+
+def test_raw_points_are_every_sample(sources):
+    ring_buffer, db = sources
+    end = START + 600
+    ring = ring_buffer.history(SENSOR, START, end, resolution=0)['points']
+    stored = db.get_sensor_history(SENSOR, START, end, resolution=0)['points']
+    # Every sample after start, and the value at start carried in
+    assert len(ring) == 600 // PERIOD + 1
+    assert len(stored) < len(ring)
+    # Each stored point is one of the samples
+    samples = {p[0]: p[1] for p in ring}
+    assert all(samples[p[0]] == p[1] for p in stored)
+
+def test_bucket_averages_agree(sources):
+    ring_buffer, db = sources
+    # Up to just before the last sample, which would open a bucket of its own
+    end = START + 2 * 3600 - 1
+    ring = ring_buffer.history(SENSOR, START + 300, end, resolution=300)['points']
+    stored = db.get_sensor_history(SENSOR, START + 300, end, resolution=300)['points']
+    assert [p[0] for p in ring] == [p[0] for p in stored]
+    # The newest stored value's hold is only credited once the next point
+    # is stored, so the last bucket can differ by more
+    for ring_point, stored_point in zip(ring[:-1], stored[:-1]):
+        assert ring_point[1] == pytest.approx(stored_point[1], abs=TOLERANCE)
+    # Counts are samples in memory but stored points in the database
+    assert all(p[4] == 300 // PERIOD for p in ring[1:])
+    assert sum(p[4] for p in stored) < sum(p[4] for p in ring)
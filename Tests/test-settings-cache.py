@@ -0,0 +1,45 @@
+# File: tests/test_settings_cache.py - Settings are read from the cache once known
+#
+# Every setting value, JSON null included, is served from the settings
+# cache after the first read or write, as is a setting known to be absent.
+#
+# Usage: python3 -m pytest tests/test_settings_cache.py
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.database import Database
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(str(tmp_path / 'farm.db'))
+    yield database
+    database.close()
+
+def offline(db, monkeypatch):
+    """Make any database access fail, so only cached settings can be read"""
+    def fail():
+        raise AssertionError('settings cache missed')
+    monkeypatch.setattr(db, '_connection', fail)
+
+@pytest.mark.parametrize('value', [None, 0, '', [], {'zone': 'zone1'}])
+def test_saved_value_is_cached(db, monkeypatch, value):
+    assert db._save_setting('test_setting', value)
+    offline(db, monkeypatch)
+    assert db._get_setting('test_setting', default='default') == value
+
+def test_stored_null_is_cached_after_first_read(db, monkeypatch):
+    assert db._save_setting('test_setting', None)
+    db.invalidate_settings_cache()
+    assert db._get_setting('test_setting', default='default') is None
+    offline(db, monkeypatch)
+    assert db._get_setting('test_setting', default='default') is None
+
+def test_missing_setting_is_cached(db, monkeypatch):
+    assert db._get_setting('no_such_setting', default='default') == 'default'
+    offline(db, monkeypatch)
+    assert db._get_setting('no_such_setting', default='default') == 'default'